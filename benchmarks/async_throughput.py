@@ -0,0 +1,137 @@
+"""Concurrent-request throughput of the /qa/ask pattern, blocking vs async.
+
+The "blocking" endpoint reproduces the old request path, which called
+``qa_system.invoke`` and Firebase ``ref.get()`` directly inside ``async def``.
+The "async" endpoint uses ``ainvoke`` and ``run_blocking`` like the current
+routes. Both share a fake LLM and fake context store with fixed latencies, so
+the difference is purely how the event loop is used.
+
+    python -m benchmarks.async_throughput --requests 200 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, List, Optional
+
+import httpx
+from fastapi import FastAPI
+from langchain.chains.retrieval_qa.base import RetrievalQA
+from langchain.llms.base import LLM
+from langchain.schema import BaseRetriever, Document
+
+from qasys.utils.concurrency import run_blocking
+
+
+class SlowFakeLLM(LLM):
+    latency: float = 0.05
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow-fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs) -> str:
+        time.sleep(self.latency)
+        return "fake answer"
+
+    async def _acall(
+        self, prompt: str, stop: Optional[List[str]] = None, **kwargs
+    ) -> str:
+        await asyncio.sleep(self.latency)
+        return "fake answer"
+
+
+class StaticRetriever(BaseRetriever):
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        return [Document(page_content="The pump error code is ERR-1234.")]
+
+
+def fetch_context(latency: float) -> List[str]:
+    # Stand-in for the synchronous Firebase ``ref.get()``
+    time.sleep(latency)
+    return ["previous question"]
+
+
+def create_app(llm_latency: float, context_latency: float) -> FastAPI:
+    app = FastAPI()
+    qa_system = RetrievalQA.from_chain_type(
+        SlowFakeLLM(latency=llm_latency),
+        chain_type="stuff",
+        retriever=StaticRetriever(),
+    )
+
+    @app.post("/blocking")
+    async def blocking(question: dict):
+        context = "\n".join(fetch_context(context_latency))
+        return qa_system.invoke(f"{context}\n\n{question['question']}")
+
+    @app.post("/async")
+    async def non_blocking(question: dict):
+        context = "\n".join(await run_blocking(fetch_context, context_latency))
+        return await qa_system.ainvoke(f"{context}\n\n{question['question']}")
+
+    return app
+
+
+async def measure(
+    app: FastAPI, path: str, requests: int, concurrency: int
+) -> dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+
+        async def one() -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(
+                    path, json={"question": "What is ERR-1234?"}
+                )
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "mode": path.strip("/"),
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--context-latency", type=float, default=0.02)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    app = create_app(args.llm_latency, args.context_latency)
+    results = [
+        await measure(app, path, args.requests, args.concurrency)
+        for path in ("/blocking", "/async")
+    ]
+    for result in results:
+        print(
+            f"{result['mode']:>8}: {result['requests_per_second']:8.1f} req/s"
+            f"  p50 {result['p50_ms']:7.1f}ms  p95 {result['p95_ms']:7.1f}ms"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
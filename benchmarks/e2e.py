@@ -0,0 +1,597 @@
+"""End-to-end ingestion throughput, QA latency and memory of the full API.
+
+Runs the application built by ``qasys.main.create_app`` in-process, through
+httpx's ASGI transport, with everything external replaced by a local
+stand-in:
+
+- deterministic fake LLM and embedding models with configurable latency,
+  registered in the app's ``ModelRegistry`` (embeddings still go through the
+  embedding cache, as in production)
+- local storage, vector store, manifest and caches in a temporary directory
+- a local token issuer: a self-signed key whose certificate is served to the
+  ``SigningKeyCache`` from a ``file://`` URL, so every request is
+  authenticated exactly as in production
+- an in-memory stand-in for the Firebase Realtime Database
+
+PDFs are generated with a fixed seed, so two runs over the same arguments
+ingest and query the same corpus. Results are written as JSON; passing a
+previous result to ``--compare`` reports the change of each tracked metric
+and exits with status 1 if one regressed by more than ``--tolerance``.
+
+    python -m benchmarks.e2e --documents 20 --pages 10 --output before.json
+    python -m benchmarks.e2e --documents 20 --pages 10 --compare before.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+PROJECT_ID = "qasys-bench"
+USER_ID = "bench-user"
+
+VOCABULARY = [f"term{i}" for i in range(3000)]
+ERROR_CODES = [f"ERR-{i}" for i in range(500)]
+
+# (section, metric, True if higher is better)
+TRACKED = [
+    ("ingestion", "pages_per_second", True),
+    ("ingestion", "chunks_per_second", True),
+    ("qa", "requests_per_second", True),
+    ("qa", "p50_ms", False),
+    ("qa", "p95_ms", False),
+    ("qa", "p99_ms", False),
+    ("memory", "peak_rss_mb", False),
+]
+
+
+class LocalIssuer:
+    """Stand-in for Google's token service, backed by a self-signed key"""
+
+    def __init__(self, project_id: str = PROJECT_ID, kid: str = "bench-key"):
+        self.project_id = project_id
+        self.kid = kid
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "local-issuer")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(self._key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(self._key, hashes.SHA256())
+        )
+        self.cert_pem = cert.public_bytes(serialization.Encoding.PEM).decode()
+        self.key_pem = self._key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+        self.signer = crypt.RSASigner.from_string(self.key_pem, key_id=kid)
+
+    def service_account(self) -> dict:
+        # Only parsed by firebase_admin at startup; never used to call Google
+        return {
+            "type": "service_account",
+            "project_id": self.project_id,
+            "private_key_id": self.kid,
+            "private_key": self.key_pem,
+            "client_email": f"bench@{self.project_id}.iam.gserviceaccount.com",
+            "client_id": "0",
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }
+
+    def token(self, uid: str = USER_ID) -> str:
+        now = int(time.time())
+        payload = {
+            "iss": f"https://securetoken.google.com/{self.project_id}",
+            "aud": self.project_id,
+            "sub": uid,
+            "iat": now,
+            "exp": now + 3600,
+            "auth_time": now,
+        }
+        return jwt.encode(self.signer, payload).decode()
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors, so retrieval still finds matching chunks"""
+
+    def __init__(self, dimensions: int = 384, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for word in text.split():
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            vector[int.from_bytes(digest, "little") % self.dimensions] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeLLM(LLM):
+    latency: float = 0.05
+
+    @property
+    def _llm_type(self) -> str:
+        return "bench-fake"
+
+    def _answer(self, prompt: str) -> str:
+        codes = sorted({word for word in prompt.split() if word.startswith("ERR-")})
+        return "Relevant codes: " + ", ".join(codes[:5])
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs) -> str:
+        time.sleep(self.latency)
+        return self._answer(prompt)
+
+    async def _acall(
+        self, prompt: str, stop: Optional[List[str]] = None, **kwargs
+    ) -> str:
+        await asyncio.sleep(self.latency)
+        return self._answer(prompt)
+
+
+class _Pushed:
+    def __init__(self, key: str):
+        self.key = key
+
+
+class FakeReference:
+    """The subset of the Firebase Realtime Database API that the app uses"""
+
+    def __init__(self, data: Dict[str, Any], path: str, latency: float):
+        self._data = data
+        self._path = path
+        self._latency = latency
+        self._start_at: Optional[str] = None
+        self._first: Optional[int] = None
+        self._limit: Optional[int] = None
+
+    def _query(self, **changes) -> "FakeReference":
+        query = FakeReference(self._data, self._path, self._latency)
+        query._start_at, query._first = self._start_at, self._first
+        query._limit = self._limit
+        for name, value in changes.items():
+            setattr(query, name, value)
+        return query
+
+    def order_by_key(self) -> "FakeReference":
+        return self._query()
+
+    def start_at(self, key: str) -> "FakeReference":
+        return self._query(_start_at=key)
+
+    def limit_to_first(self, limit: int) -> "FakeReference":
+        return self._query(_first=limit)
+
+    def limit_to_last(self, limit: int) -> "FakeReference":
+        return self._query(_limit=limit)
+
+    def get(self) -> Any:
+        time.sleep(self._latency)
+        value = self._data.get(self._path)
+        if not isinstance(value, dict):
+            return value
+        items = sorted(
+            (key, item)
+            for key, item in value.items()
+            if self._start_at is None or key >= self._start_at
+        )
+        if self._first is not None:
+            items = items[: self._first]
+        if self._limit is not None:
+            items = items[-self._limit :]
+        return dict(items)
+
+    def push(self, value: Any) -> _Pushed:
+        time.sleep(self._latency)
+        messages = self._data.setdefault(self._path, {})
+        key = f"{time.time_ns():020d}"
+        messages[key] = value
+        return _Pushed(key)
+
+    def set(self, value: Any) -> None:
+        time.sleep(self._latency)
+        self._data[self._path] = value
+
+
+def make_pdf(pages: List[str]) -> bytes:
+    """A minimal PDF with one Helvetica text page per entry of ``pages``"""
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages))), len(pages)
+        ),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, text in enumerate(pages):
+        lines = " ".join(f"({line}) '" for line in text.split("\n"))
+        stream = f"BT /F1 9 Tf 40 760 Td 11 TL {lines} ET"
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792]"
+            f" /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode()
+    return out
+
+
+def build_corpus(
+    documents: int, pages: int, words_per_page: int, seed: int = 0
+) -> List[Tuple[str, bytes]]:
+    rng = random.Random(seed)
+    corpus = []
+    for document in range(documents):
+        texts = []
+        for _ in range(pages):
+            words = rng.choices(VOCABULARY, k=words_per_page)
+            for position in rng.sample(range(words_per_page), 3):
+                words[position] = rng.choice(ERROR_CODES)
+            texts.append(
+                "\n".join(
+                    " ".join(words[start : start + 14])
+                    for start in range(0, words_per_page, 14)
+                )
+            )
+        corpus.append((f"doc-{document:04d}.pdf", make_pdf(texts)))
+    return corpus
+
+
+def configure(directory: str, args: argparse.Namespace) -> LocalIssuer:
+    """Point the settings at ``directory``; must run before qasys is imported"""
+    issuer = LocalIssuer()
+    credentials_path = os.path.join(directory, "service-account.json")
+    with open(credentials_path, "w") as f:
+        json.dump(issuer.service_account(), f)
+    certs_path = os.path.join(directory, "certs.json")
+    with open(certs_path, "w") as f:
+        json.dump({issuer.kid: issuer.cert_pem}, f)
+
+    os.environ.pop("VECTOR_DB_SERVER_HOST", None)
+    os.environ.update(
+        {
+            "PROJECT_ID": PROJECT_ID,
+            "FIREBASE_CREDENTIALS_FILENAME": credentials_path,
+            "FIREBASE_MESSAGES_PATH": "messages/{uid}",
+            "FIREBASE_CERTS_URL": f"file://{certs_path}",
+            "MODEL_PROVIDER": "ollama",
+            "STORAGE_TYPE": "local",
+            "PDF_STORAGE_PATH": os.path.join(directory, "pdfs"),
+            "VECTOR_DB_PATH": os.path.join(directory, "vector_db"),
+            "EMBEDDING_CACHE_PATH": os.path.join(directory, "embeddings.sqlite"),
+            "ANSWER_CACHE_ENABLED": str(int(args.answer_cache)),
+            "ANSWER_CACHE_PATH": os.path.join(directory, "answers.sqlite"),
+            "STORAGE_CACHE_PATH": os.path.join(directory, "blobs"),
+            "INFERENCE_SERVER_ENABLED": "0",
+            "WARM_UP_MODELS": "0",
+            "METRICS_ENABLED": "1",
+            "CONVERSATION_RECORD_TURNS": str(int(args.record_turns)),
+        }
+    )
+    return issuer
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def zip_corpus(corpus: List[Tuple[str, bytes]]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for filename, content in corpus:
+            archive.writestr(filename, content)
+    return buffer.getvalue()
+
+
+async def ingest(
+    client: httpx.AsyncClient,
+    corpus: List[Tuple[str, bytes]],
+    pages: int,
+    bulk: bool = False,
+) -> dict:
+    start = time.perf_counter()
+    status_urls = []
+    if bulk:
+        archive = ("corpus.zip", zip_corpus(corpus), "application/zip")
+        response = await client.post("/pdf/upload/bulk", files=[("files", archive)])
+        response.raise_for_status()
+        status_urls.append(response.json()["status_url"])
+    for filename, content in corpus if not bulk else []:
+        response = await client.post(
+            "/pdf/upload", files={"file": (filename, content, "application/pdf")}
+        )
+        response.raise_for_status()
+        status_urls.append(response.json()["status_url"])
+
+    jobs = []
+    for status_url in status_urls:
+        while True:
+            job = (await client.get(status_url)).json()
+            if job["stage"] in ("completed", "failed"):
+                jobs.append(job)
+                break
+            await asyncio.sleep(0.02)
+    elapsed = time.perf_counter() - start
+
+    chunks = sum(job["chunks_processed"] for job in jobs)
+    total_pages = pages * len(corpus)
+    return {
+        "documents": len(corpus),
+        "pages": total_pages,
+        "chunks": chunks,
+        "failed_jobs": sum(
+            job.get("files_failed", 0) or job["stage"] == "failed" for job in jobs
+        ),
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(total_pages / elapsed, 2),
+        "chunks_per_second": round(chunks / elapsed, 2),
+    }
+
+
+async def ask(
+    client: httpx.AsyncClient, requests: int, concurrency: int, warmup: int, seed: int
+) -> dict:
+    rng = random.Random(seed)
+    questions = [
+        f"What does {rng.choice(ERROR_CODES)} mean for {rng.choice(VOCABULARY)}?"
+        for _ in range(warmup + requests)
+    ]
+    for question in questions[:warmup]:
+        (await client.post("/qa/ask", json={"question": question})).raise_for_status()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(question: str) -> None:
+        nonlocal errors
+        async with semaphore:
+            request_start = time.perf_counter()
+            response = await client.post("/qa/ask", json={"question": question})
+            if response.status_code != 200:
+                errors += 1
+                return
+            latencies.append((time.perf_counter() - request_start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(question) for question in questions[warmup:]))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5), 1),
+        "p90_ms": round(percentile(latencies, 0.9), 1),
+        "p95_ms": round(percentile(latencies, 0.95), 1),
+        "p99_ms": round(percentile(latencies, 0.99), 1),
+    }
+
+
+async def run(args: argparse.Namespace, issuer: LocalIssuer) -> dict:
+    # Imported here so that the settings pick up the environment from configure
+    from qasys.dependencies import create_cached_embedding_model
+    from qasys.main import create_app, lifespan
+    from qasys.utils import metrics
+
+    corpus = build_corpus(args.documents, args.pages, args.words_per_page, args.seed)
+    app = create_app()
+    database: Dict[str, Any] = {}
+    async with lifespan(app):
+        registry = app.state.model_registry
+        registry.register("llm", lambda: FakeLLM(latency=args.llm_latency_ms / 1000))
+        registry.register(
+            "embeddings",
+            lambda: create_cached_embedding_model(
+                FakeEmbeddings(args.dimensions, args.embedding_latency_ms / 1000)
+            ),
+        )
+        # Stand-in for firebase_admin.db.reference
+        app.state.conversation_memory._reference = lambda path: FakeReference(
+            database, path, args.database_latency_ms / 1000
+        )
+        startup_rss = peak_rss_mb()
+
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://bench",
+            headers={"Authorization": f"Bearer {issuer.token()}"},
+            timeout=None,
+        ) as client:
+            ingestion = await ingest(client, corpus, args.pages, args.bulk)
+            ingestion_rss = peak_rss_mb()
+            qa = await ask(
+                client, args.requests, args.concurrency, args.warmup, args.seed
+            )
+
+    stages = {
+        labels[0]: {"count": count, "mean_ms": round(total / count * 1000, 2)}
+        for labels, (count, total) in sorted(metrics.stage_seconds.totals().items())
+        if count
+    }
+    return {
+        "ingestion": ingestion,
+        "qa": qa,
+        "memory": {
+            "startup_rss_mb": startup_rss,
+            "after_ingestion_rss_mb": ingestion_rss,
+            "peak_rss_mb": peak_rss_mb(),
+        },
+        "stages": stages,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """Print the change of every tracked metric; return the regressed ones"""
+    regressions = []
+    for section, metric, higher_is_better in TRACKED:
+        before = baseline.get(section, {}).get(metric)
+        after = current[section][metric]
+        if not before:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(f"{section}.{metric}")
+        print(
+            f"{section + '.' + metric:<30} {before:>10} -> {after:>10}"
+            f"  {change:+7.1%}{flag}"
+        )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10, help="Pages per document")
+    parser.add_argument("--words-per-page", type=int, default=300)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--embedding-latency-ms", type=float, default=5)
+    parser.add_argument("--database-latency-ms", type=float, default=5)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument(
+        "--answer-cache",
+        action="store_true",
+        help="Keep the answer cache on (questions may then repeat as hits)",
+    )
+    parser.add_argument("--record-turns", action="store_true")
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Upload the corpus as one ZIP through /pdf/upload/bulk",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="A previous result to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative change counted as a regression by --compare",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        issuer = configure(directory, args)
+        result = asyncio.run(run(args, issuer))
+    result = {
+        "revision": git_revision(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ("output", "compare", "tolerance")
+        },
+        **result,
+    }
+
+    ingestion, qa = result["ingestion"], result["qa"]
+    print(
+        f"ingestion: {ingestion['pages']} pages, {ingestion['chunks']} chunks in"
+        f" {ingestion['seconds']}s ({ingestion['pages_per_second']} pages/s,"
+        f" {ingestion['chunks_per_second']} chunks/s)"
+    )
+    print(
+        f"qa: {qa['requests_per_second']} req/s  p50 {qa['p50_ms']}ms"
+        f"  p95 {qa['p95_ms']}ms  p99 {qa['p99_ms']}ms  errors {qa['errors']}"
+    )
+    print(f"peak rss: {result['memory']['peak_rss_mb']} MB")
+    for stage, timing in result["stages"].items():
+        print(f"  {stage:<24} {timing['count']:>6} x {timing['mean_ms']:>9.2f}ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\ncompared with {baseline.get('revision') or args.compare}:")
+        if baseline.get("config") != result["config"]:
+            print("warning: the baseline was run with different arguments")
+        if compare(baseline, result, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""QA throughput of the full API with 1 vs N uvicorn workers.
+
+The API is launched through ``qasys.main.main``, as in production: shared
+services first (a Chroma server when there is more than one worker), then
+uvicorn workers built by an app factory. The factory here wraps
+``qasys.main.create_app`` and, once a worker's lifespan has started, swaps in
+the stand-ins of ``benchmarks.e2e``: fake models with configurable latency
+and an in-memory Realtime Database. Requests are authenticated by the local
+token issuer. A small corpus is ingested over HTTP before ``/qa/ask`` is
+measured, and every worker count runs over a fresh data directory.
+
+    python -m benchmarks.workers_throughput --workers 1 4 --requests 400
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+import httpx
+
+from benchmarks.e2e import (
+    FakeEmbeddings,
+    FakeLLM,
+    FakeReference,
+    LocalIssuer,
+    ask,
+    build_corpus,
+    configure,
+    ingest,
+)
+
+LLM_LATENCY_ENV = "BENCH_LLM_LATENCY_MS"
+EMBEDDING_LATENCY_ENV = "BENCH_EMBEDDING_LATENCY_MS"
+DIMENSIONS_ENV = "BENCH_DIMENSIONS"
+
+
+def create_app():
+    """App factory of every worker: ``qasys.main.create_app`` with the fakes"""
+    # Imported here, in the worker, so the settings come from its environment
+    from qasys.dependencies import create_cached_embedding_model
+    from qasys.main import create_app as create_qasys_app
+
+    llm_latency = float(os.environ.get(LLM_LATENCY_ENV, "0")) / 1000
+    embedding_latency = float(os.environ.get(EMBEDDING_LATENCY_ENV, "0")) / 1000
+    dimensions = int(os.environ.get(DIMENSIONS_ENV, "384"))
+    database: Dict[str, Any] = {}
+
+    app = create_qasys_app()
+    lifespan = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan_with_fakes(app):
+        async with lifespan(app):
+            registry = app.state.model_registry
+            registry.register("llm", lambda: FakeLLM(latency=llm_latency))
+            registry.register(
+                "embeddings",
+                lambda: create_cached_embedding_model(
+                    FakeEmbeddings(dimensions, embedding_latency)
+                ),
+            )
+            app.state.conversation_memory._reference = lambda path: FakeReference(
+                database, path, 0
+            )
+            yield
+
+    app.router.lifespan_context = lifespan_with_fakes
+    return app
+
+
+def serve() -> None:
+    from qasys.main import main as launch
+
+    launch("benchmarks.workers_throughput:create_app")
+
+
+def start_server(port: int, env: dict) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.workers_throughput", "--serve"], env=env
+    )
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Benchmark server exited")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/openapi.json").raise_for_status()
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise TimeoutError("Benchmark server did not start")
+
+
+async def measure(
+    port: int, workers: int, issuer: LocalIssuer, args: argparse.Namespace
+) -> dict:
+    corpus = build_corpus(args.documents, args.pages, args.words_per_page, args.seed)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}",
+        headers={"Authorization": f"Bearer {issuer.token()}"},
+        limits=httpx.Limits(max_connections=args.concurrency),
+        timeout=120,
+    ) as client:
+        ingestion = await ingest(client, corpus, args.pages)
+        qa = await ask(client, args.requests, args.concurrency, args.warmup, args.seed)
+    return {"workers": workers, "ingestion": ingestion, "qa": qa}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count()])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=5, help="Pages per document")
+    parser.add_argument("--words-per-page", type=int, default=300)
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--embedding-latency-ms", type=float, default=5)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve()
+        return
+
+    # Every question is distinct work, as with the answer cache off
+    args.answer_cache = False
+    args.record_turns = False
+    results = []
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            issuer = configure(directory, args)
+            env = {
+                **os.environ,
+                "HOST": "127.0.0.1",
+                "PORT": str(args.port),
+                "WORKERS": str(workers),
+                "VECTOR_DB_SERVER_PORT": str(args.port + 1),
+                LLM_LATENCY_ENV: str(args.llm_latency_ms),
+                EMBEDDING_LATENCY_ENV: str(args.embedding_latency_ms),
+                DIMENSIONS_ENV: str(args.dimensions),
+            }
+            process = start_server(args.port, env)
+            try:
+                results.append(asyncio.run(measure(args.port, workers, issuer, args)))
+            finally:
+                process.terminate()
+                process.wait(timeout=60)
+
+    for result in results:
+        qa = result["qa"]
+        print(
+            f"{result['workers']:>3} workers: {qa['requests_per_second']:8.1f}"
+            f" req/s  p50 {qa['p50_ms']:7.1f}ms  p95 {qa['p95_ms']:7.1f}ms"
+            f"  errors {qa['errors']}"
+            f"  ingestion {result['ingestion']['pages_per_second']} pages/s"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
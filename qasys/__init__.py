@@ -1,5 +1,39 @@
-from qasys.config import *
-from qasys.core import *
-from qasys.dependencies import *
-from qasys.routes import *
-from qasys.utils import *
+"""Subpackages are imported on first attribute access (PEP 562).
+
+``from qasys import X`` and ``from qasys import *`` keep working, but
+importing a single module such as ``qasys.main`` no longer loads every
+subpackage and its dependencies up front.
+"""
+
+import importlib
+
+_SUBMODULES = (
+    "qasys.config",
+    "qasys.core",
+    "qasys.dependencies",
+    "qasys.routes",
+    "qasys.utils",
+)
+
+
+def _public_names(module) -> list:
+    names = getattr(module, "__all__", None)
+    if names is None:
+        names = [name for name in vars(module) if not name.startswith("_")]
+    return list(names)
+
+
+def __getattr__(name: str):
+    if name == "__all__":
+        names = []
+        for submodule in _SUBMODULES:
+            names.extend(_public_names(importlib.import_module(submodule)))
+        globals()["__all__"] = names
+        return names
+    for submodule in _SUBMODULES:
+        module = importlib.import_module(submodule)
+        if name in _public_names(module):
+            value = getattr(module, name)
+            globals()[name] = value
+            return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import Dict, Optional
 
 from pydantic import Field, SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -24,16 +25,117 @@ class Settings(BaseSettings):
     APP_NAME: str = Field("LangChain Q&A FastAPI")
     DEBUG: bool = Field(False)
     PROJECT_ID: str
+    BLOCKING_POOL_SIZE: int = Field(32)
+    # Per-stage latency histograms on /metrics
+    METRICS_ENABLED: bool = Field(True)
+    # Return each request's stage breakdown in a Server-Timing header
+    METRICS_DEBUG_TIMINGS: bool = Field(False)
+
+    # Server configurations
+    HOST: str = Field("127.0.0.1")
+    PORT: int = Field(8000)
+    WORKERS: int = Field(1)
+    # Host the local LLM and embedding model in one process shared by all
+    # workers instead of loading a copy per worker
+    INFERENCE_SERVER_ENABLED: bool = Field(False)
+    INFERENCE_SOCKET_PATH: str = Field("cache/inference.sock")
+    # Generated by the launcher when unset
+    INFERENCE_AUTHKEY: Optional[SecretStr] = Field(None)
+    INFERENCE_CONNECTIONS: int = Field(8)
+    INFERENCE_STARTUP_TIMEOUT: float = Field(600)
 
     # Database configurations
     FIREBASE_CREDENTIALS_FILENAME: SecretStr
     FIREBASE_MESSAGES_PATH: str
+    FIREBASE_CERTS_URL: str = Field(
+        "https://www.googleapis.com/robot/v1/metadata/x509/"
+        "securetoken@system.gserviceaccount.com"
+    )
+    # Defaults to https://securetoken.google.com/<PROJECT_ID>
+    FIREBASE_TOKEN_ISSUER: Optional[str] = Field(None)
+    AUTH_TOKEN_CACHE_SIZE: int = Field(10_000)
+
+    # Conversation memory configurations
+    CONVERSATION_MAX_TURNS: int = Field(20)
+    CONVERSATION_MAX_TOKENS: int = Field(512)
+    CONVERSATION_SUMMARY_ENABLED: bool = Field(True)
+    CONVERSATION_SUMMARY_PATH: str = Field("conversation_summaries/{uid}")
+    CONVERSATION_SUMMARY_MAX_TOKENS: int = Field(128)
+    CONVERSATION_REFRESH_SECONDS: float = Field(30)
+    CONVERSATION_CACHE_SIZE: int = Field(1024)
+    # Push answered turns to FIREBASE_MESSAGES_PATH; leave off if the client
+    # already records them
+    CONVERSATION_RECORD_TURNS: bool = Field(False)
 
     # Vector DB configurations
     VECTOR_DB_TYPE: str = Field("chroma")
+    VECTOR_DB_PATH: str = Field("vector_db")
+    VECTOR_STORE_CACHE_SIZE: int = Field(128)
+    VECTOR_STORE_IDLE_SECONDS: int = Field(900)
+    # Chroma server shared by all workers; with WORKERS > 1 and no host set,
+    # the launcher starts one on 127.0.0.1 over VECTOR_DB_PATH
+    VECTOR_DB_SERVER_HOST: Optional[str] = Field(None)
+    VECTOR_DB_SERVER_PORT: int = Field(8001)
+    # Defaults to <VECTOR_DB_PATH>/manifest.sqlite
+    DOCUMENT_MANIFEST_PATH: Optional[str] = Field(None)
+
+    # Retrieval configurations
+    HYBRID_SEARCH_ENABLED: bool = Field(True)
+    RETRIEVAL_K: int = Field(4)
+    RETRIEVAL_DENSE_K: int = Field(20)
+    RETRIEVAL_SPARSE_K: int = Field(20)
+    RETRIEVAL_RRF_K: int = Field(60)
+    # Cross-encoder re-ranking of RERANK_CANDIDATES down to RERANK_TOP_N chunks
+    RERANK_ENABLED: bool = Field(False)
+    RERANK_MODEL_NAME: str = Field("cross-encoder/ms-marco-MiniLM-L-6-v2")
+    RERANK_CANDIDATES: int = Field(20)
+    RERANK_TOP_N: int = Field(4)
+    RERANK_BATCH_SIZE: int = Field(16)
+
+    # Prompt configurations
+    PROMPT_MAX_TOKENS: int = Field(3000)
+    # Per-model overrides of PROMPT_MAX_TOKENS, e.g. {"llama3-chatqa": 8192}
+    PROMPT_TOKEN_BUDGETS: Dict[str, int] = Field({})
+    PROMPT_ANSWER_TOKENS: int = Field(512)
+
+    # Ingestion configurations
+    EMBEDDING_BATCH_SIZE: int = Field(64)
+    EMBEDDING_MAX_CONCURRENCY: int = Field(4)
+    EMBEDDING_MAX_RETRIES: int = Field(3)
+    EMBEDDING_CACHE_ENABLED: bool = Field(True)
+    EMBEDDING_CACHE_PATH: str = Field("cache/embeddings.sqlite")
+    EMBEDDING_CACHE_MAX_ENTRIES: int = Field(200_000)
+    CHUNK_SIZE_TOKENS: int = Field(256)
+    CHUNK_OVERLAP_TOKENS: int = Field(32)
+    PDF_PARSE_WORKERS: int = Field(4)
+    PDF_PARALLEL_MIN_PAGES: int = Field(64)
+    PDF_PAGES_PER_TASK: int = Field(16)
+    INGESTION_MAX_CONCURRENT_JOBS: int = Field(4)
+    INGESTION_MAX_JOBS_PER_USER: int = Field(2)
+    INGESTION_JOB_RETENTION_SECONDS: int = Field(3600)
+    # Status of ingestion jobs shared by all workers; defaults to
+    # <VECTOR_DB_PATH>/jobs.sqlite
+    INGESTION_JOB_STORE_PATH: Optional[str] = Field(None)
+    # Limits of /pdf/upload/bulk: PDFs per upload (ZIP entries included),
+    # their total uncompressed size, and uploads running at once per user
+    BULK_UPLOAD_MAX_FILES: int = Field(5000)
+    BULK_UPLOAD_MAX_BYTES: int = Field(2 * 1024**3)
+    BULK_UPLOAD_MAX_JOBS_PER_USER: int = Field(1)
 
     # Storage configurations
     STORAGE_TYPE: StorageType = StorageType.LOCAL
+    # S3-compatible endpoint (MinIO, LocalStack) instead of AWS
+    S3_ENDPOINT_URL: Optional[str] = Field(None)
+    STORAGE_MAX_POOL_CONNECTIONS: int = Field(32)
+    STORAGE_MULTIPART_THRESHOLD: int = Field(8 * 1024 * 1024)
+    STORAGE_MULTIPART_CHUNK_SIZE: int = Field(8 * 1024 * 1024)
+    STORAGE_TRANSFER_CONCURRENCY: int = Field(4)
+    STORAGE_SPOOL_MAX_BYTES: int = Field(32 * 1024 * 1024)
+    # Local read-through cache in front of cloud storage
+    STORAGE_CACHE_ENABLED: bool = Field(True)
+    STORAGE_CACHE_PATH: str = Field("cache/blobs")
+    STORAGE_CACHE_MAX_BYTES: int = Field(2 * 1024**3)
+    STORAGE_CACHE_VALIDATE_SECONDS: float = Field(30)
     match STORAGE_TYPE:
         case StorageType.LOCAL:
             PDF_STORAGE_PATH: str = Field()
@@ -42,8 +144,20 @@ class Settings(BaseSettings):
         case StorageType.AZURE:
             AZURE_CONNECTION_STRING: str = Field()
 
+    # Answer cache configurations
+    ANSWER_CACHE_ENABLED: bool = Field(True)
+    ANSWER_CACHE_BACKEND: str = Field("memory")
+    ANSWER_CACHE_PATH: str = Field("cache/answers.sqlite")
+    ANSWER_CACHE_TTL_SECONDS: int = Field(3600)
+    ANSWER_CACHE_MAX_ENTRIES: int = Field(10_000)
+
     # LangChain configurations
     MODEL_PROVIDER: ModelProvider = ModelProvider.OLLAMA
+    WARM_UP_MODELS: bool = Field(False)
+    # Concurrent calls to local (HuggingFace) models are run as one batch of
+    # up to MODEL_BATCH_MAX_SIZE inputs, collected for up to this long
+    MODEL_BATCH_MAX_SIZE: int = Field(16)
+    MODEL_BATCH_MAX_WAIT_MS: float = Field(5)
 
     match MODEL_PROVIDER:
         case MODEL_PROVIDER.OPENAI:
@@ -1,3 +1,53 @@
-from qasys.core.pdf_processor import *
-from qasys.core.qa_system import *
-from qasys.core.vector_store import *
+"""Core modules are imported on first attribute access (PEP 562), like the
+top-level package, so importing one of them does not load the others and
+their model and vector store dependencies.
+"""
+
+import importlib
+
+_SUBMODULES = (
+    "qasys.core.answer_cache",
+    "qasys.core.batching",
+    "qasys.core.bulk_upload",
+    "qasys.core.chunking",
+    "qasys.core.conversation",
+    "qasys.core.embedding_cache",
+    "qasys.core.inference",
+    "qasys.core.ingestion",
+    "qasys.core.job_store",
+    "qasys.core.manifest",
+    "qasys.core.model_registry",
+    "qasys.core.pdf_processor",
+    "qasys.core.prompt",
+    "qasys.core.qa_system",
+    "qasys.core.reranker",
+    "qasys.core.retrieval",
+    "qasys.core.sparse_index",
+    "qasys.core.tokens",
+    "qasys.core.vector_store",
+)
+
+
+def _public_names(module) -> list:
+    names = getattr(module, "__all__", None)
+    if names is None:
+        names = [name for name in vars(module) if not name.startswith("_")]
+    return list(names)
+
+
+def __getattr__(name: str):
+    if name == "__all__":
+        names = []
+        for submodule in _SUBMODULES:
+            names.extend(_public_names(importlib.import_module(submodule)))
+        globals()["__all__"] = names
+        return names
+    if f"{__name__}.{name}" in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    for submodule in _SUBMODULES:
+        module = importlib.import_module(submodule)
+        if name in _public_names(module):
+            value = getattr(module, name)
+            globals()[name] = value
+            return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
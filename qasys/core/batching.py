@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM, BaseLLM
+from langchain.schema.output import GenerationChunk
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_STOP = object()
+
+
+class MicroBatcher(Generic[T, R]):
+    """Collects concurrent requests into batches for one model call.
+
+    Callers submit a list of items and get a future for their results. A
+    single scheduler thread takes the first waiting request, keeps collecting
+    for up to ``max_wait_ms`` (or until ``max_batch_size`` items are
+    gathered), runs ``process`` over all items at once and hands each caller
+    its slice of the output. A request larger than ``max_batch_size`` is run
+    on its own rather than split. Because only the scheduler thread calls
+    ``process``, the model never sees concurrent calls.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[T]], List[R]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5,
+        name: str = "model",
+        log_every: int = 500,
+    ):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.log_every = log_every
+        self.requests = 0
+        self.items = 0
+        self.batches = 0
+        self.busy_seconds = 0.0
+        self.batch_sizes: Counter = Counter()
+        self._waits: deque = deque(maxlen=1024)
+        self._pending: Optional[Tuple[Any, Future, float]] = None
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name=f"qasys-batcher-{name}", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, items: Sequence[T]) -> "Future[List[R]]":
+        future: Future = Future()
+        if not items:
+            future.set_result([])
+        else:
+            self._queue.put((list(items), future, time.perf_counter()))
+        return future
+
+    def run(self, items: Sequence[T]) -> List[R]:
+        return self.submit(items).result()
+
+    async def arun(self, items: Sequence[T]) -> List[R]:
+        return await asyncio.wrap_future(self.submit(items))
+
+    def _next(self, timeout: Optional[float]) -> Any:
+        if self._pending is not None:
+            request, self._pending = self._pending, None
+            return request
+        if timeout is None:
+            return self._queue.get()
+        if timeout <= 0:
+            return self._queue.get_nowait()
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self) -> Optional[List[Tuple[list, Future, float]]]:
+        request = self._next(None)
+        if request is _STOP:
+            return None
+        batch = [request]
+        size = len(request[0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            try:
+                # Past the deadline only requests already queued are taken
+                request = self._next(deadline - time.perf_counter())
+            except queue.Empty:
+                break
+            if request is _STOP or size + len(request[0]) > self.max_batch_size:
+                self._pending = request
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            batch = [r for r in batch if r[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            items = [item for request_items, _, _ in batch for item in request_items]
+            try:
+                results = self.process(items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f"{self.name} returned {len(results)} results"
+                        f" for {len(items)} inputs"
+                    )
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                offset = 0
+                for request_items, future, _ in batch:
+                    future.set_result(results[offset : offset + len(request_items)])
+                    offset += len(request_items)
+            self._record(batch, len(items), started)
+
+    def _record(self, batch: list, items: int, started: float) -> None:
+        finished = time.perf_counter()
+        self.requests += len(batch)
+        self.items += items
+        self.batches += 1
+        self.busy_seconds += finished - started
+        self.batch_sizes[items] += 1
+        self._waits.extend(started - enqueued for _, _, enqueued in batch)
+        if self.log_every and self.batches % self.log_every == 0:
+            stats = self.stats()
+            logger.info(
+                "%s batching: mean batch %.1f, queue wait p95 %.1fms,"
+                " %.1f items/s while busy",
+                self.name,
+                stats["mean_batch_size"],
+                stats["queue_wait_p95_ms"],
+                stats["items_per_second"],
+            )
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+
+        def percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return round(waits[min(int(len(waits) * p), len(waits) - 1)] * 1000, 2)
+
+        return {
+            "requests": self.requests,
+            "items": self.items,
+            "batches": self.batches,
+            "mean_batch_size": (
+                round(self.items / self.batches, 2) if self.batches else 0.0
+            ),
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queue_wait_p50_ms": percentile(0.5),
+            "queue_wait_p95_ms": percentile(0.95),
+            "items_per_second": (
+                round(self.items / self.busy_seconds, 2) if self.busy_seconds else 0.0
+            ),
+        }
+
+    def close(self) -> None:
+        self._queue.put(_STOP)
+        self._thread.join()
+
+
+class BatchedEmbeddings(Embeddings):
+    """Embeds concurrent queries and documents in shared model batches"""
+
+    def __init__(
+        self, embeddings: Embeddings, max_batch_size: int = 16, max_wait_ms: float = 5
+    ):
+        self.embeddings = embeddings
+        self.batcher = MicroBatcher(
+            embeddings.embed_documents, max_batch_size, max_wait_ms, name="embeddings"
+        )
+
+    @property
+    def client(self) -> Any:
+        # Lets the model registry measure the wrapped model's weights
+        return getattr(self.embeddings, "client", None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.batcher.run(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.batcher.run([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.batcher.arun(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.batcher.arun([text]))[0]
+
+    def stats(self) -> dict:
+        return self.batcher.stats()
+
+    def close(self) -> None:
+        self.batcher.close()
+
+
+def _generate_batch(llm: BaseLLM, requests: List[Tuple[str, tuple]]) -> List[str]:
+    # Prompts are only batched with others that use the same stop sequences
+    groups = defaultdict(list)
+    for position, (_, stop) in enumerate(requests):
+        groups[stop].append(position)
+    texts: List[str] = [""] * len(requests)
+    for stop, positions in groups.items():
+        result = llm.generate(
+            [requests[position][0] for position in positions], stop=list(stop) or None
+        )
+        for position, generations in zip(positions, result.generations):
+            texts[position] = generations[0].text
+    return texts
+
+
+class BatchedLLM(LLM):
+    """Generates concurrent prompts as one padded batch of ``llm``.
+
+    Streamed prompts are not batched: they go straight to ``llm``, so that
+    tokens reach the client as they are generated.
+    """
+
+    llm: BaseLLM
+    batcher: Any
+
+    @classmethod
+    def wrap(
+        cls, llm: BaseLLM, max_batch_size: int = 16, max_wait_ms: float = 5, **kwargs
+    ) -> "BatchedLLM":
+        if hasattr(llm, "batch_size"):
+            # HuggingFacePipeline otherwise splits the batch up again
+            llm.batch_size = max_batch_size
+        batcher = MicroBatcher(
+            lambda requests: _generate_batch(llm, requests),
+            max_batch_size,
+            max_wait_ms,
+            name="llm",
+        )
+        return cls(llm=llm, batcher=batcher, **kwargs)
+
+    @property
+    def _llm_type(self) -> str:
+        return f"batched-{self.llm._llm_type}"
+
+    @property
+    def pipeline(self) -> Any:
+        # Lets the model registry measure the wrapped model's weights
+        return getattr(self.llm, "pipeline", None)
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return self.batcher.run([(prompt, tuple(stop or ()))])[0]
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return (await self.batcher.arun([(prompt, tuple(stop or ()))]))[0]
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        for text in self.llm.stream(prompt, stop=stop, **kwargs):
+            chunk = GenerationChunk(text=text)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        async for text in self.llm.astream(prompt, stop=stop, **kwargs):
+            chunk = GenerationChunk(text=text)
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    def stats(self) -> dict:
+        return self.batcher.stats()
+
+    def close(self) -> None:
+        self.batcher.close()
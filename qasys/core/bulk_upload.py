@@ -0,0 +1,136 @@
+import posixpath
+import tempfile
+import threading
+import zipfile
+from typing import IO, BinaryIO, Callable, List, Optional
+
+from qasys.core.ingestion import BulkSource
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class BulkUploadError(ValueError):
+    """Raised when an upload exceeds the bulk upload limits"""
+
+
+def upload_filename(filename: Optional[str]) -> Optional[str]:
+    """The name an uploaded file is stored under, or None if it is unusable"""
+    # Clients may send a path; only its last part is kept, from either OS
+    name = posixpath.basename((filename or "").replace("\\", "/"))
+    if not name or name.startswith("."):
+        return None
+    return name
+
+
+def _is_pdf(file: IO[bytes]) -> bool:
+    file.seek(0)
+    return file.read(5) == b"%PDF-"
+
+
+class BulkUpload:
+    """The PDFs of one bulk upload, read lazily from temporary copies.
+
+    Every uploaded file is copied once to a temporary file, since the
+    request's files are closed as soon as the response is sent; a copy stops
+    once it would take the upload over ``max_bytes``. ZIP archives
+    are never extracted: their directory is read up front to apply the limits
+    to the declared sizes, and each entry is decompressed only when the
+    ingestion job reads it. A ``ZipFile`` never returns more than an entry's
+    declared size, so the limits also hold for archives that lie about it.
+    """
+
+    def __init__(self, max_files: int, max_bytes: int):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.sources: List[BulkSource] = []
+        self.skipped: List[dict] = []
+        self.total_bytes = 0
+        self._files: List[IO[bytes]] = []
+        self._archives: List[zipfile.ZipFile] = []
+        self._names: set = set()
+        self._lock = threading.Lock()
+
+    def add(self, filename: Optional[str], file: BinaryIO) -> None:
+        """Add an uploaded PDF or ZIP archive of PDFs"""
+        name = upload_filename(filename)
+        if name is None:
+            self.skipped.append({"filename": filename, "reason": "invalid filename"})
+            return
+        copy = tempfile.TemporaryFile()
+        self._files.append(copy)
+        size = self._copy(file, copy)
+        if zipfile.is_zipfile(copy):
+            self._add_archive(name, copy)
+        elif _is_pdf(copy):
+            self._add_source(name, size, self._reader(copy))
+        else:
+            self.skipped.append({"filename": name, "reason": "not a PDF or ZIP"})
+
+    def _copy(self, file: BinaryIO, copy: IO[bytes]) -> int:
+        # Stops as soon as the file alone is over what is left of the limit,
+        # rather than copying all of an oversized upload first
+        remaining = self.max_bytes - self.total_bytes
+        size = 0
+        while chunk := file.read(_COPY_CHUNK_SIZE):
+            size += len(chunk)
+            if size > remaining:
+                raise BulkUploadError(f"Upload exceeds {self.max_bytes} bytes of PDFs")
+            copy.write(chunk)
+        return size
+
+    def _reader(self, file: IO[bytes]) -> Callable[[], bytes]:
+        def read() -> bytes:
+            with self._lock:
+                file.seek(0)
+                return file.read()
+
+        return read
+
+    def _add_archive(self, archive_name: str, file: IO[bytes]) -> None:
+        archive = zipfile.ZipFile(file)
+        self._archives.append(archive)
+        for info in archive.infolist():
+            name = posixpath.basename(info.filename)
+            if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                continue
+            if not name or name.startswith("."):
+                continue
+            entry = f"{archive_name}:{info.filename}"
+            if not name.lower().endswith(".pdf"):
+                self.skipped.append({"filename": entry, "reason": "not a PDF"})
+            elif info.flag_bits & 0x1:
+                self.skipped.append({"filename": entry, "reason": "encrypted"})
+            else:
+                # ZipFile serialises reads of the shared archive file itself
+                self._add_source(
+                    name,
+                    info.file_size,
+                    lambda info=info: archive.read(info),
+                    label=entry,
+                )
+
+    def _add_source(
+        self,
+        filename: str,
+        size: int,
+        read: Callable[[], bytes],
+        label: Optional[str] = None,
+    ) -> None:
+        if filename in self._names:
+            self.skipped.append(
+                {"filename": label or filename, "reason": "duplicate filename"}
+            )
+            return
+        if len(self.sources) >= self.max_files:
+            raise BulkUploadError(f"More than {self.max_files} files in one upload")
+        self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            raise BulkUploadError(f"Upload exceeds {self.max_bytes} bytes of PDFs")
+        self._names.add(filename)
+        self.sources.append(BulkSource(filename=filename, read=read))
+
+    def close(self) -> None:
+        for archive in self._archives:
+            archive.close()
+        for file in self._files:
+            file.close()
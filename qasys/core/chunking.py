@@ -0,0 +1,168 @@
+import copy
+import hashlib
+import re
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional
+
+from langchain.schema import Document
+from langchain.text_splitter import TextSplitter
+
+# A sentence runs up to terminal punctuation followed by whitespace, or to the
+# end of the paragraph.
+_SENTENCE = re.compile(r"\S.*?(?:[.!?]+(?=\s)|$)", re.S)
+_NUMBERED_HEADING = re.compile(r"^(?:\d+(?:\.\d+)*\.?|[IVX]+\.)\s+[A-Z]")
+_NAMED_HEADING = re.compile(r"^(?:chapter|section|part|appendix)\b", re.I)
+_MAX_HEADING_CHARS = 80
+
+
+@dataclass
+class _Segment:
+    offset: int
+    text: str
+    tokens: int
+    heading: bool = False
+
+
+def _is_heading(line: str) -> bool:
+    if len(line) > _MAX_HEADING_CHARS or line[-1] in ".,;:!?":
+        return False
+    if _NUMBERED_HEADING.match(line) or _NAMED_HEADING.match(line):
+        return True
+    letters = [c for c in line if c.isalpha()]
+    return len(letters) >= 3 and all(c.isupper() for c in letters)
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class TokenChunker(TextSplitter):
+    """Packs sentences into chunks of at most ``chunk_size`` tokens.
+
+    Chunks never cross a heading, and consecutive chunks within a section
+    share up to ``chunk_overlap`` tokens of whole sentences. Every chunk
+    keeps the metadata of its page and adds its character ``offset`` within
+    the page, ``chunk_index``, ``tokens``, ``content_hash`` and, when known,
+    the enclosing ``section`` heading.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 256,
+        chunk_overlap: int = 32,
+        length_function: Callable[[str], int] = len,
+    ):
+        super().__init__(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=length_function,
+        )
+
+    def _segments(self, text: str) -> Iterator[_Segment]:
+        paragraph_start: Optional[int] = None
+        paragraph_end = 0
+        position = 0
+        for line in text.splitlines(keepends=True):
+            start, position = position, position + len(line)
+            stripped = line.strip()
+            if stripped and not _is_heading(stripped):
+                if paragraph_start is None:
+                    paragraph_start = start
+                paragraph_end = position
+                continue
+            if paragraph_start is not None:
+                yield from self._sentences(text, paragraph_start, paragraph_end)
+                paragraph_start = None
+            if stripped:
+                yield _Segment(
+                    offset=start + line.index(stripped[0]),
+                    text=stripped,
+                    tokens=self._length_function(stripped),
+                    heading=True,
+                )
+        if paragraph_start is not None:
+            yield from self._sentences(text, paragraph_start, paragraph_end)
+
+    def _sentences(self, text: str, start: int, end: int) -> Iterator[_Segment]:
+        for match in _SENTENCE.finditer(text, start, end):
+            # PDF extraction hard-wraps lines; collapse them back into prose
+            sentence = " ".join(match.group().split())
+            if not sentence:
+                continue
+            tokens = self._length_function(sentence)
+            if tokens <= self._chunk_size:
+                yield _Segment(match.start(), sentence, tokens)
+            else:
+                yield from self._split_long(match.start(), sentence)
+
+    def _split_long(self, offset: int, sentence: str) -> Iterator[_Segment]:
+        words: List[str] = []
+        for word in sentence.split(" "):
+            candidate = " ".join(words + [word])
+            if words and self._length_function(candidate) > self._chunk_size:
+                piece = " ".join(words)
+                yield _Segment(offset, piece, self._length_function(piece))
+                offset += len(piece) + 1
+                words = []
+            words.append(word)
+        if words:
+            piece = " ".join(words)
+            yield _Segment(offset, piece, self._length_function(piece))
+
+    def _pack(self, text: str) -> Iterator[tuple]:
+        current: List[_Segment] = []
+        current_tokens = 0
+        has_body = False
+        section: Optional[str] = None
+        for segment in self._segments(text):
+            if segment.heading:
+                if has_body:
+                    yield current, section
+                    current, current_tokens, has_body = [], 0, False
+                section = segment.text
+            elif has_body and current_tokens + segment.tokens > self._chunk_size:
+                yield current, section
+                overlap: List[_Segment] = []
+                overlap_tokens = 0
+                overlap_budget = min(
+                    self._chunk_overlap, self._chunk_size - segment.tokens
+                )
+                for previous in reversed(current):
+                    if previous.heading:
+                        break
+                    if overlap_tokens + previous.tokens > overlap_budget:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_tokens += previous.tokens
+                current, current_tokens = overlap, overlap_tokens
+            current.append(segment)
+            current_tokens += segment.tokens
+            has_body = has_body or not segment.heading
+        if has_body:
+            yield current, section
+
+    def split_text(self, text: str) -> List[str]:
+        return [
+            " ".join(segment.text for segment in segments)
+            for segments, _ in self._pack(text)
+        ]
+
+    def create_documents(
+        self, texts: List[str], metadatas: Optional[List[dict]] = None
+    ) -> List[Document]:
+        metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for text, base_metadata in zip(texts, metadatas):
+            for index, (segments, section) in enumerate(self._pack(text)):
+                content = " ".join(segment.text for segment in segments)
+                metadata = copy.deepcopy(base_metadata)
+                metadata.update(
+                    offset=segments[0].offset,
+                    chunk_index=index,
+                    tokens=sum(segment.tokens for segment in segments),
+                    content_hash=_content_hash(content),
+                )
+                if section:
+                    metadata["section"] = section
+                documents.append(Document(page_content=content, metadata=metadata))
+        return documents
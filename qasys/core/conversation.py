@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Summarise the conversation below in at most {max_words} words. Keep names, "
+    "numbers and open questions; drop pleasantries.\n\n"
+    "Earlier summary:\n{summary}\n\nNew messages:\n{messages}\n\nSummary:"
+)
+
+
+@dataclass
+class _Message:
+    key: str
+    text: str
+    tokens: int
+
+
+@dataclass
+class _Conversation:
+    messages: Deque[_Message] = field(default_factory=deque)
+    summary: str = ""
+    summary_tokens: int = 0
+    # Messages pushed out of the window but not yet folded into the summary
+    pending: List[_Message] = field(default_factory=list)
+    last_key: Optional[str] = None
+    fetched_at: float = 0.0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    summarizing: Optional[asyncio.Task] = None
+
+
+def _message_text(value: Any) -> str:
+    if isinstance(value, dict):
+        value = value.get("content") or value.get("text") or ""
+    return str(value) if value is not None else ""
+
+
+def _ordered_items(messages: Any) -> List[tuple]:
+    # Firebase returns arrays as lists and push()-ed children as dicts that a
+    # key-ordered query already sorts chronologically.
+    if not messages:
+        return []
+    if isinstance(messages, list):
+        return [(str(i), m) for i, m in enumerate(messages) if m is not None]
+    return list(messages.items())
+
+
+class ConversationMemory:
+    """Bounded, incrementally refreshed view of a user's conversation.
+
+    Only the last ``max_turns`` messages are ever fetched from Firebase; after
+    the first load a user's window is refreshed by fetching only messages
+    newer than the last one seen. ``context`` packs the newest messages into
+    ``max_tokens`` (including the summary), so the prompt stays the same size
+    however long the history grows. Messages that fall out of the window are
+    folded into a rolling summary by the LLM in a background task.
+    """
+
+    def __init__(
+        self,
+        reference: Callable[[str], Any],
+        messages_path: str,
+        summary_path: Optional[str] = None,
+        count_tokens: Callable[[str], int] = len,
+        llm_provider: Optional[Callable[[], Any]] = None,
+        max_turns: int = 20,
+        max_tokens: int = 512,
+        summary_max_tokens: int = 128,
+        refresh_seconds: float = 30,
+        cache_size: int = 1024,
+    ):
+        self._reference = reference
+        self.messages_path = messages_path
+        self.summary_path = summary_path
+        self._count_tokens = count_tokens
+        self._llm_provider = llm_provider
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.refresh_seconds = refresh_seconds
+        self.cache_size = cache_size
+        self._conversations: OrderedDict[str, _Conversation] = OrderedDict()
+
+    def _conversation(self, user_id: str) -> _Conversation:
+        conversation = self._conversations.get(user_id)
+        if conversation is None:
+            conversation = self._conversations[user_id] = _Conversation()
+            while len(self._conversations) > self.cache_size:
+                self._conversations.popitem(last=False)
+        self._conversations.move_to_end(user_id)
+        return conversation
+
+    def _append(self, conversation: _Conversation, key: str, value: Any) -> None:
+        text = _message_text(value)
+        if not text:
+            return
+        conversation.messages.append(_Message(key, text, self._count_tokens(text)))
+        conversation.last_key = key
+        while len(conversation.messages) > self.max_turns:
+            conversation.pending.append(conversation.messages.popleft())
+
+    def _fetch(self, user_id: str, since: Optional[str]) -> tuple:
+        reference = self._reference(self.messages_path.format(uid=user_id))
+        if since is not None:
+            return self._fetch_since(reference, since), None
+        messages = _ordered_items(
+            reference.order_by_key().limit_to_last(self.max_turns).get()
+        )
+        summary = None
+        if self.summary_path:
+            summary = self._reference(self.summary_path.format(uid=user_id)).get()
+        return messages, summary
+
+    def _fetch_since(self, reference: Any, since: str) -> List[tuple]:
+        # Every newer message, in pages of max_turns: those beyond the window
+        # still have to be folded into the summary
+        messages: List[tuple] = []
+        cursor = since
+        while True:
+            page = _ordered_items(
+                reference.order_by_key()
+                .start_at(cursor)
+                .limit_to_first(self.max_turns + 1)
+                .get()
+            )
+            # start_at includes the cursor itself
+            messages.extend(item for item in page if item[0] != cursor)
+            if len(page) <= self.max_turns:
+                return messages
+            cursor = page[-1][0]
+
+    async def _refresh(self, user_id: str, conversation: _Conversation) -> None:
+        if time.monotonic() - conversation.fetched_at < self.refresh_seconds:
+            return
+        async with conversation.lock:
+            if time.monotonic() - conversation.fetched_at < self.refresh_seconds:
+                return
+            since = conversation.last_key
+            messages, summary = await run_blocking(self._fetch, user_id, since)
+            if summary:
+                conversation.summary = str(summary)
+                conversation.summary_tokens = self._count_tokens(conversation.summary)
+            for key, value in messages:
+                if key != since:
+                    self._append(conversation, key, value)
+            conversation.fetched_at = time.monotonic()
+        self._schedule_summary(user_id, conversation)
+
+    async def context(self, user_id: str) -> str:
+        """Summary plus the newest messages that fit in ``max_tokens``"""
+        if not user_id:
+            return ""
+        conversation = self._conversation(user_id)
+        try:
+            with metrics.span("conversation.fetch"):
+                await self._refresh(user_id, conversation)
+        except Exception as e:
+            logger.warning("Failed to refresh conversation of %s: %s", user_id, e)
+
+        budget = self.max_tokens
+        parts: List[str] = []
+        if conversation.summary and conversation.summary_tokens <= budget:
+            parts.append(f"Summary of earlier conversation: {conversation.summary}")
+            budget -= conversation.summary_tokens
+        recent: List[str] = []
+        for message in reversed(conversation.messages):
+            if message.tokens > budget:
+                break
+            recent.append(message.text)
+            budget -= message.tokens
+        parts.extend(reversed(recent))
+        return "\n".join(parts)
+
+    async def add_turn(self, user_id: str, question: str, answer: str) -> None:
+        """Write a question/answer turn through to Firebase and the local window"""
+        text = f"Q: {question}\nA: {answer}"
+        reference = self._reference(self.messages_path.format(uid=user_id))
+        key = (await run_blocking(reference.push, text)).key
+        conversation = self._conversation(user_id)
+        async with conversation.lock:
+            # A window that was never loaded picks the turn up on its first fetch
+            if conversation.fetched_at:
+                self._append(conversation, key, text)
+        self._schedule_summary(user_id, conversation)
+
+    def forget(self, user_id: str) -> None:
+        conversation = self._conversations.pop(user_id, None)
+        if conversation is not None and conversation.summarizing is not None:
+            conversation.summarizing.cancel()
+
+    def _schedule_summary(self, user_id: str, conversation: _Conversation) -> None:
+        if not conversation.pending or self._llm_provider is None:
+            return
+        if conversation.summarizing is not None and not conversation.summarizing.done():
+            return
+        conversation.summarizing = asyncio.create_task(
+            self._summarize(user_id, conversation)
+        )
+
+    async def _summarize(self, user_id: str, conversation: _Conversation) -> None:
+        pending, conversation.pending = conversation.pending, []
+        prompt = SUMMARY_PROMPT.format(
+            max_words=max(self.summary_max_tokens * 3 // 4, 1),
+            summary=conversation.summary or "(none)",
+            messages="\n".join(message.text for message in pending),
+        )
+        try:
+            llm = await run_blocking(self._llm_provider)
+            result = await llm.ainvoke(prompt)
+            summary = _message_text(getattr(result, "content", result)).strip()
+            tokens = self._count_tokens(summary)
+            if tokens > self.summary_max_tokens:
+                words = summary.split()
+                keep = len(words) * self.summary_max_tokens // tokens
+                summary = " ".join(words[:keep])
+                tokens = self._count_tokens(summary)
+            conversation.summary, conversation.summary_tokens = summary, tokens
+            if self.summary_path:
+                reference = self._reference(self.summary_path.format(uid=user_id))
+                await run_blocking(reference.set, summary)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Keep the messages so the next attempt folds them in
+            conversation.pending = (pending + conversation.pending)[-self.max_turns :]
+            logger.warning("Failed to summarise conversation of %s: %s", user_id, e)
+
+    async def close(self) -> None:
+        tasks = [
+            c.summarizing
+            for c in self._conversations.values()
+            if c.summarizing is not None
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._conversations),
+            "messages": sum(len(c.messages) for c in self._conversations.values()),
+        }
@@ -0,0 +1,260 @@
+import logging
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+from langchain.schema.output import GenerationChunk
+
+from qasys.core.model_registry import ModelRegistry
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceError(RuntimeError):
+    """Raised by the client when the inference server reports a failure"""
+
+
+def _text(output: Any) -> str:
+    # Chat models return a message, plain LLMs a string
+    return getattr(output, "content", output)
+
+
+class InferenceServer:
+    """Serves the models of a ``ModelRegistry`` over a local socket.
+
+    Run in its own process so that every API worker shares one copy of the
+    (local) LLM and embedding model instead of loading its own. Each client
+    connection is handled on its own thread, so concurrent calls reach the
+    model together; local models are wrapped in a ``MicroBatcher`` that
+    batches them and is the only caller of the underlying pipeline.
+
+    Streaming methods send one ``("chunk", ...)`` message per chunk before
+    the final reply, and stop generating once the client closes the
+    connection.
+    """
+
+    def __init__(self, registry: ModelRegistry, address: str, authkey: bytes):
+        self.registry = registry
+        self.address = address
+        self.authkey = authkey
+        self._handlers: Dict[str, Callable[..., Any]] = {
+            "ping": lambda: "pong",
+            "embed_documents": self._embed_documents,
+            "embed_query": self._embed_query,
+            "generate": self._generate,
+        }
+        self._streams: Dict[str, Callable[..., Iterator[Any]]] = {
+            "stream": self._stream,
+        }
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.registry.get("embeddings").embed_documents(texts)
+
+    def _embed_query(self, text: str) -> List[float]:
+        return self.registry.get("embeddings").embed_query(text)
+
+    def _generate(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return _text(self.registry.get("llm").invoke(prompt, stop=stop))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None) -> Iterator[str]:
+        for chunk in self.registry.get("llm").stream(prompt, stop=stop):
+            yield _text(chunk)
+
+    def _handle(self, conn: Connection) -> None:
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if method in self._streams:
+                        for chunk in self._streams[method](*args):
+                            conn.send(("chunk", chunk))
+                        result = None
+                    else:
+                        result = self._handlers[method](*args)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading a stream
+                    return
+                except Exception as e:
+                    logger.exception("Inference call %s failed", method)
+                    conn.send(("error", f"{type(e).__name__}: {e}"))
+                    continue
+                conn.send(("ok", result))
+
+    def serve_forever(self) -> None:
+        if os.path.exists(self.address):
+            # Left behind by a server that did not shut down cleanly
+            os.remove(self.address)
+        directory = os.path.dirname(self.address)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with Listener(self.address, family="AF_UNIX", authkey=self.authkey) as listener:
+            logger.info("Inference server listening on %s", self.address)
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # A client that fails the handshake must not stop the server
+                    logger.warning("Rejected inference connection: %s", e)
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+class InferenceClient:
+    """Thread-safe client of an ``InferenceServer``.
+
+    Keeps up to ``max_connections`` open connections; each call borrows one,
+    so that many requests can be in flight at once.
+    """
+
+    def __init__(self, address: str, authkey: bytes, max_connections: int = 8):
+        self.address = address
+        self.authkey = authkey
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _connection(self) -> Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return Client(self.address, family="AF_UNIX", authkey=self.authkey)
+
+    def call(self, method: str, *args) -> Any:
+        with self._slots:
+            conn = self._connection()
+            try:
+                conn.send((method, args))
+                status, result = conn.recv()
+            except BaseException:
+                # The connection may be mid-message; never reuse it
+                conn.close()
+                raise
+            self._idle.put(conn)
+        if status == "error":
+            raise InferenceError(result)
+        return result
+
+    def stream(self, method: str, *args) -> Iterator[Any]:
+        """Chunks of a streaming method; closing the iterator early drops the
+        connection, which stops the server generating"""
+        with self._slots:
+            conn = self._connection()
+            try:
+                conn.send((method, args))
+                while True:
+                    status, result = conn.recv()
+                    if status != "chunk":
+                        break
+                    yield result
+            except BaseException:
+                conn.close()
+                raise
+            self._idle.put(conn)
+        if status == "error":
+            raise InferenceError(result)
+
+    def wait_ready(self, timeout: float) -> None:
+        """Block until the server answers; it may still be loading models"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.call("ping")
+                return
+            except (FileNotFoundError, ConnectionError):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(
+                        f"Inference server at {self.address} did not start"
+                    )
+                time.sleep(0.2)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class RemoteEmbeddings(Embeddings):
+    """Embeddings computed by the shared inference server"""
+
+    def __init__(self, client: InferenceClient):
+        self.client = client
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.client.call("embed_documents", list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.client.call("embed_query", text)
+
+
+class RemoteLLM(LLM):
+    """LLM hosted by the shared inference server"""
+
+    client: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "qasys-remote"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return self.client.call("generate", prompt, stop)
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        for text in self.client.stream("stream", prompt, stop):
+            chunk = GenerationChunk(text=text)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        texts = self.client.stream("stream", prompt, stop)
+        # A cancelled read keeps running in its thread; close() waits for it
+        lock = threading.Lock()
+
+        def read() -> Optional[str]:
+            with lock:
+                return next(texts, None)
+
+        def close() -> None:
+            with lock:
+                texts.close()
+
+        try:
+            while (text := await run_blocking(read)) is not None:
+                chunk = GenerationChunk(text=text)
+                if run_manager is not None:
+                    await run_manager.on_llm_new_token(text, chunk=chunk)
+                yield chunk
+        finally:
+            await run_blocking(close)
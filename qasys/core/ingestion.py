@@ -0,0 +1,671 @@
+import asyncio
+import contextvars
+import hashlib
+import io
+import logging
+import mmap
+import multiprocessing
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import AsyncIterator, BinaryIO, Callable, Dict, List, Optional, Set, Tuple
+
+from langchain.schema import Document
+from langchain.text_splitter import TextSplitter
+from pypdf import PdfReader
+
+from qasys.core.job_store import JobStore
+from qasys.core.manifest import DocumentManifest
+from qasys.core.pdf_processor import (
+    PDFSource,
+    aiter_pdf_pages,
+    asplit_documents,
+    open_pdf,
+)
+from qasys.core.vector_store import IngestionPipeline, IngestionStats, chunk_id
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
+from qasys.utils.storage import AuthenticatedStorage
+
+logger = logging.getLogger(__name__)
+
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash(content: PDFSource) -> str:
+    if isinstance(content, (bytes, mmap.mmap)):
+        # Hashed in place; a mapping is paged in as the digest reaches it
+        return hashlib.sha256(content).hexdigest()
+    digest = hashlib.sha256()
+    content.seek(0)
+    while chunk := content.read(_HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def _open_file(storage: AuthenticatedStorage, filename: str) -> BinaryIO:
+    # Local and cached storage return a read-only mapping of the file, which
+    # is hashed and parsed without copying it into memory
+    with metrics.span("storage.read"):
+        return storage.get_file(filename)
+
+
+class TooManyJobsError(RuntimeError):
+    """Raised when a user already has the maximum number of jobs running"""
+
+
+class JobStage(str, Enum):
+    QUEUED = "queued"
+    LOADING = "loading"
+    STORING = "storing"
+    PARSING = "parsing"
+    EMBEDDING = "embedding"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+@dataclass
+class IngestionJob:
+    user_id: str
+    filename: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    stage: JobStage = JobStage.QUEUED
+    pages_total: int = 0
+    pages_processed: int = 0
+    chunks_processed: int = 0
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    parsing_started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    ingestion: Optional[dict] = None
+
+    @property
+    def done(self) -> bool:
+        return self.stage in (JobStage.COMPLETED, JobStage.FAILED)
+
+    def record_progress(self, batch: List[Document]) -> None:
+        self.chunks_processed += len(batch)
+        pages = [doc.metadata.get("page") for doc in batch]
+        last_page = max((page for page in pages if page is not None), default=None)
+        if last_page is not None:
+            self.pages_processed = max(self.pages_processed, last_page + 1)
+
+    def eta_seconds(self) -> Optional[float]:
+        if self.done:
+            return 0.0
+        if not self.parsing_started_at or not self.pages_processed:
+            return None
+        elapsed = time.time() - self.parsing_started_at
+        remaining = self.pages_total - self.pages_processed
+        return elapsed / self.pages_processed * remaining
+
+    def to_dict(self) -> dict:
+        eta = self.eta_seconds()
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "stage": self.stage.value,
+            "pages_total": self.pages_total,
+            "pages_processed": self.pages_processed,
+            "chunks_processed": self.chunks_processed,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "ingestion": self.ingestion,
+        }
+
+
+@dataclass
+class BulkSource:
+    """A file of a bulk upload; ``read`` runs in a worker thread"""
+
+    filename: str
+    read: Callable[[], bytes]
+
+
+@dataclass
+class BulkIngestionJob:
+    """Many files ingested as one job, with a result per file"""
+
+    user_id: str
+    files: List[IngestionJob]
+    skipped: List[dict] = field(default_factory=list)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    stage: JobStage = JobStage.QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    ingestion: Optional[dict] = None
+
+    @property
+    def done(self) -> bool:
+        return self.stage in (JobStage.COMPLETED, JobStage.FAILED)
+
+    def to_dict(self) -> dict:
+        stages = Counter(job.stage for job in self.files)
+        return {
+            "job_id": self.id,
+            "stage": self.stage.value,
+            "files_total": len(self.files),
+            "files_completed": stages[JobStage.COMPLETED],
+            "files_failed": stages[JobStage.FAILED],
+            "pages_total": sum(job.pages_total for job in self.files),
+            "pages_processed": sum(job.pages_processed for job in self.files),
+            "chunks_processed": sum(job.chunks_processed for job in self.files),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "ingestion": self.ingestion,
+            "files": [
+                {
+                    "filename": job.filename,
+                    "stage": job.stage.value,
+                    "pages_total": job.pages_total,
+                    "chunks_processed": job.chunks_processed,
+                    "error": job.error,
+                    "ingestion": job.ingestion,
+                }
+                for job in self.files
+            ],
+            "skipped": self.skipped,
+        }
+
+
+class IngestionQueue:
+    """In-process queue that stores, parses and indexes uploads in the background.
+
+    Pages are parsed lazily and streamed into ``IngestionPipeline`` as they
+    are produced, so a document is never fully materialised as ``Document``
+    objects. Documents with at least ``parallel_min_pages`` pages have their
+    page ranges extracted across a process pool of ``parse_workers``. At most ``max_concurrent_jobs`` jobs
+    run at once, and at most ``max_jobs_per_user`` of them for a single user;
+    the rest wait queued. A user may have at most ``max_bulk_jobs_per_user``
+    bulk jobs unfinished; further bulk submissions are rejected.
+
+    With a ``manifest``, an upload whose content hash matches the indexed
+    version is skipped, and chunks a file no longer produces are removed
+    through ``delete_chunks`` once it has been re-indexed.
+
+    Jobs run in the process that accepted them. With a ``store`` their status
+    is also written there every ``sync_seconds``, so that every worker sharing
+    the store can report it.
+    """
+
+    def __init__(
+        self,
+        pipeline_factory: Callable[[str], IngestionPipeline],
+        storage_factory: Callable[[str], AuthenticatedStorage],
+        text_splitter: Optional[TextSplitter] = None,
+        parse_workers: int = 4,
+        parallel_min_pages: int = 64,
+        pages_per_task: int = 16,
+        max_concurrent_jobs: int = 4,
+        max_jobs_per_user: int = 2,
+        max_bulk_jobs_per_user: int = 1,
+        retention_seconds: float = 3600,
+        on_corpus_changed: Optional[Callable[[str], None]] = None,
+        manifest: Optional[DocumentManifest] = None,
+        delete_chunks: Optional[Callable[[str, List[str]], None]] = None,
+        store: Optional[JobStore] = None,
+        sync_seconds: float = 1.0,
+    ):
+        self._pipeline_factory = pipeline_factory
+        self._storage_factory = storage_factory
+        self.text_splitter = text_splitter
+        self.parse_workers = parse_workers
+        self.parallel_min_pages = parallel_min_pages
+        self.pages_per_task = pages_per_task
+        self._parse_pool = (
+            ProcessPoolExecutor(
+                max_workers=parse_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            if parse_workers > 1
+            else None
+        )
+        self._slots = asyncio.Semaphore(max_concurrent_jobs)
+        self.max_jobs_per_user = max_jobs_per_user
+        # Only users with queued or running jobs have a slot, with a count of
+        # those jobs
+        self._user_slots: Dict[str, Tuple[asyncio.Semaphore, int]] = {}
+        self.max_bulk_jobs_per_user = max_bulk_jobs_per_user
+        self.retention_seconds = retention_seconds
+        self._on_corpus_changed = on_corpus_changed
+        self.manifest = manifest
+        self._delete_chunks = delete_chunks
+        self._jobs: Dict[str, IngestionJob | BulkIngestionJob] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.store = store
+        self.sync_seconds = sync_seconds
+        self._sync_task: Optional[asyncio.Task] = None
+        self._submit_lock = asyncio.Lock()
+
+    async def submit(
+        self,
+        user_id: str,
+        filename: str,
+        content: Optional[bytes] = None,
+        force: bool = False,
+    ) -> IngestionJob:
+        """Queue an upload; without ``content`` the stored file is re-indexed"""
+        self._prune()
+        job = IngestionJob(user_id=user_id, filename=filename)
+        await self._add(job, "file")
+        # A fresh context, so the job's stages are not added to the timing
+        # breakdown of the request that submitted it
+        task = asyncio.create_task(
+            self._run(job, content, force or content is None),
+            context=contextvars.Context(),
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def submit_bulk(
+        self,
+        user_id: str,
+        sources: List[BulkSource],
+        skipped: Optional[List[dict]] = None,
+        cleanup: Optional[Callable[[], None]] = None,
+    ) -> BulkIngestionJob:
+        """Queue many files as one job; ``cleanup`` runs once it has finished.
+
+        Raises ``TooManyJobsError`` if the user already has
+        ``max_bulk_jobs_per_user`` bulk jobs unfinished, counting those of
+        every worker sharing the store.
+        """
+        self._prune()
+        job = BulkIngestionJob(
+            user_id=user_id,
+            files=[IngestionJob(user_id=user_id, filename=s.filename) for s in sources],
+            skipped=skipped or [],
+        )
+        async with self._submit_lock:
+            local = sum(
+                isinstance(other, BulkIngestionJob)
+                and other.user_id == user_id
+                and not other.done
+                for other in self._jobs.values()
+            )
+            if local >= self.max_bulk_jobs_per_user or not await self._add(
+                job, "bulk", max_active=self.max_bulk_jobs_per_user
+            ):
+                raise TooManyJobsError("Too many bulk uploads in progress")
+        task = asyncio.create_task(
+            self._run_bulk(job, sources, cleanup), context=contextvars.Context()
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob | BulkIngestionJob]:
+        return self._jobs.get(job_id)
+
+    async def status(self, job_id: str, user_id: str) -> Optional[dict]:
+        """Status of one of a user's jobs, whichever worker is running it"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict() if job.user_id == user_id else None
+        if self.store is None:
+            return None
+        return await run_blocking(self.store.get, job_id, user_id)
+
+    async def _add(
+        self,
+        job: IngestionJob | BulkIngestionJob,
+        kind: str,
+        max_active: Optional[int] = None,
+    ) -> bool:
+        if self.store is not None:
+            # Waits for the store's write lock, which other workers may hold
+            added = await run_blocking(
+                self.store.add,
+                job.id,
+                job.user_id,
+                kind,
+                job.to_dict(),
+                max_active=max_active,
+            )
+            if not added:
+                return False
+            if self._sync_task is None:
+                self._sync_task = asyncio.create_task(
+                    self._sync(), context=contextvars.Context()
+                )
+        self._jobs[job.id] = job
+        return True
+
+    async def _finish(self, job: IngestionJob | BulkIngestionJob) -> None:
+        if self.store is None:
+            return
+        if not job.done:
+            # Cancelled when the worker shut down
+            job.stage = JobStage.FAILED
+            job.error = job.error or "Cancelled"
+        try:
+            await run_blocking(
+                self.store.finish, job.id, job.to_dict(), job.finished_at
+            )
+        except Exception:
+            logger.exception("Failed to save the status of job %s", job.id)
+
+    async def _sync(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_seconds)
+            # Snapshots are taken here, on the loop that updates the jobs
+            running = [
+                (job.id, job.to_dict()) for job in self._jobs.values() if not job.done
+            ]
+            try:
+                if running:
+                    await run_blocking(self.store.update, running)
+                await run_blocking(
+                    self.store.prune, time.time() - self.retention_seconds
+                )
+            except Exception:
+                logger.exception("Failed to save the status of running jobs")
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.retention_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.done and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+    @asynccontextmanager
+    async def _user_slot(self, user_id: str) -> AsyncIterator[None]:
+        semaphore, jobs = self._user_slots.get(
+            user_id, (asyncio.Semaphore(self.max_jobs_per_user), 0)
+        )
+        self._user_slots[user_id] = (semaphore, jobs + 1)
+        try:
+            async with semaphore:
+                yield
+        finally:
+            semaphore, jobs = self._user_slots[user_id]
+            if jobs == 1:
+                del self._user_slots[user_id]
+            else:
+                self._user_slots[user_id] = (semaphore, jobs - 1)
+
+    async def _run(
+        self, job: IngestionJob, content: Optional[bytes], force: bool
+    ) -> None:
+        async with self._user_slot(job.user_id), self._slots:
+            job.started_at = time.time()
+            stats = IngestionStats()
+            stale: List[str] = []
+            try:
+                storage = self._storage_factory(job.user_id)
+                prepared = await self._prepare(job, storage, content, force)
+                if prepared is None:
+                    return
+                content, file_hash, reader = prepared
+                chunks = self._chunks(job, content, reader)
+
+                job.stage = JobStage.EMBEDDING
+                pipeline = await run_blocking(self._pipeline_factory, job.user_id)
+                await pipeline.run(chunks, on_progress=job.record_progress, stats=stats)
+                stale = await self._update_manifest(job, stats, file_hash)
+                job.ingestion = dict(stats.to_dict(), stale_chunks_removed=len(stale))
+                job.stage = JobStage.COMPLETED
+            except Exception as e:
+                logger.exception("Ingestion job %s failed", job.id)
+                job.error = str(e)
+                job.stage = JobStage.FAILED
+                if stats.chunk_ids:
+                    await self._update_manifest(job, stats, None)
+            finally:
+                job.finished_at = time.time()
+                if content is not None and not isinstance(content, bytes):
+                    content.close()
+                await self._finish(job)
+                # Even a failed job may have written some chunks
+                if self._on_corpus_changed and (job.chunks_processed or stale):
+                    self._on_corpus_changed(job.user_id)
+
+    async def _run_bulk(
+        self,
+        bulk: BulkIngestionJob,
+        sources: List[BulkSource],
+        cleanup: Optional[Callable[[], None]],
+    ) -> None:
+        try:
+            # The whole upload takes a single job slot of the user
+            async with self._user_slot(bulk.user_id), self._slots:
+                bulk.started_at = time.time()
+                bulk.stage = JobStage.PARSING
+                await self._ingest_bulk(bulk, sources)
+                bulk.stage = JobStage.COMPLETED
+        except Exception as e:
+            logger.exception("Bulk ingestion job %s failed", bulk.id)
+            bulk.error = str(e)
+            bulk.stage = JobStage.FAILED
+        finally:
+            bulk.finished_at = time.time()
+            await self._finish(bulk)
+            if cleanup is not None:
+                cleanup()
+            if self._on_corpus_changed and any(
+                job.chunks_processed for job in bulk.files
+            ):
+                self._on_corpus_changed(bulk.user_id)
+
+    async def _ingest_bulk(
+        self, bulk: BulkIngestionJob, sources: List[BulkSource]
+    ) -> None:
+        """Parse up to ``parse_workers`` files at a time into one pipeline.
+
+        Chunks of all files go through a single ``IngestionPipeline``, so
+        embedding batches are filled across files instead of ending with
+        every (typically small) file. Files are recorded in the manifest once
+        the pipeline has finished, each only if all of its chunks were written.
+        """
+        storage = self._storage_factory(bulk.user_id)
+        pipeline = await run_blocking(self._pipeline_factory, bulk.user_id)
+        chunks: asyncio.Queue = asyncio.Queue(
+            maxsize=pipeline.batch_size * pipeline.max_concurrency
+        )
+        file_slots = asyncio.Semaphore(max(self.parse_workers, 1))
+        jobs = {job.filename: job for job in bulk.files}
+        produced: Dict[str, int] = {}
+        hashes: Dict[str, str] = {}
+        chunk_ids: Dict[str, Set[str]] = defaultdict(set)
+
+        async def produce(job: IngestionJob, source: BulkSource) -> None:
+            async with file_slots:
+                job.started_at = time.time()
+                try:
+                    job.stage = JobStage.LOADING
+                    content = await run_blocking(source.read)
+                    prepared = await self._prepare(job, storage, content, False)
+                    if prepared is None:
+                        job.finished_at = time.time()
+                        return
+                    content, hashes[job.filename], reader = prepared
+                    count = 0
+                    async for chunk in self._chunks(job, content, reader):
+                        await chunks.put(chunk)
+                        count += 1
+                    produced[job.filename] = count
+                    job.stage = JobStage.EMBEDDING
+                except Exception as e:
+                    logger.warning("Failed to parse %s: %s", job.filename, e)
+                    job.error = str(e)
+                    job.stage = JobStage.FAILED
+                    job.finished_at = time.time()
+
+        async def produce_all() -> None:
+            # produce() handles its own errors, so only cancellation ends this
+            # early, and then nothing reads the queue any more
+            await asyncio.gather(*(produce(jobs[s.filename], s) for s in sources))
+            bulk.stage = JobStage.EMBEDDING
+            await chunks.put(None)
+
+        async def stream() -> AsyncIterator[Document]:
+            while (chunk := await chunks.get()) is not None:
+                yield chunk
+
+        def record_progress(batch: List[Document]) -> None:
+            by_file: Dict[str, List[Document]] = defaultdict(list)
+            for document in batch:
+                by_file[document.metadata["source"]].append(document)
+            for filename, documents in by_file.items():
+                jobs[filename].record_progress(documents)
+                chunk_ids[filename].update(
+                    chunk_id(bulk.user_id, document) for document in documents
+                )
+
+        stats = IngestionStats()
+        producer = asyncio.create_task(produce_all())
+        pipeline_error = None
+        try:
+            await pipeline.run(stream(), on_progress=record_progress, stats=stats)
+        except Exception as e:
+            # Files whose chunks were all written are still complete
+            logger.warning("Bulk ingestion job %s: %s", bulk.id, e)
+            pipeline_error = str(e)
+        finally:
+            if not producer.done():
+                producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+        bulk.ingestion = stats.to_dict()
+
+        for job in bulk.files:
+            if job.filename not in hashes:
+                # Unchanged, or failed before anything was written
+                continue
+            ids = chunk_ids.get(job.filename, set())
+            file_stats = IngestionStats(chunks=job.chunks_processed, chunk_ids=ids)
+            complete = (
+                job.stage == JobStage.EMBEDDING
+                and job.chunks_processed == produced.get(job.filename)
+            )
+            try:
+                if not complete:
+                    if job.stage != JobStage.FAILED:
+                        job.error = f"Not all chunks were indexed: {pipeline_error}"
+                        job.stage = JobStage.FAILED
+                    if ids:
+                        await self._update_manifest(job, file_stats, None)
+                    continue
+                stale = await self._update_manifest(
+                    job, file_stats, hashes[job.filename]
+                )
+                job.ingestion = {
+                    "chunks": job.chunks_processed,
+                    "unique_chunks": len(ids),
+                    "stale_chunks_removed": len(stale),
+                }
+                job.stage = JobStage.COMPLETED
+            except Exception as e:
+                logger.exception("Failed to record %s", job.filename)
+                job.error = str(e)
+                job.stage = JobStage.FAILED
+            finally:
+                job.finished_at = time.time()
+
+    async def _prepare(
+        self,
+        job: IngestionJob,
+        storage: AuthenticatedStorage,
+        content: Optional[bytes],
+        force: bool,
+    ) -> Optional[Tuple[PDFSource, str, PdfReader]]:
+        """Load, hash and store a file; None if it is indexed with this content"""
+        uploaded = content is not None
+        if not uploaded:
+            job.stage = JobStage.LOADING
+            content = await run_blocking(_open_file, storage, job.filename)
+        file_hash = await run_blocking(_hash, content)
+        if not force and self.manifest is not None:
+            indexed_hash = await run_blocking(
+                self.manifest.file_hash, job.user_id, job.filename
+            )
+            if indexed_hash == file_hash:
+                job.ingestion = {"unchanged": True}
+                job.stage = JobStage.COMPLETED
+                return None
+
+        if uploaded:
+            job.stage = JobStage.STORING
+            with metrics.span("storage.write"):
+                await run_blocking(storage.save_file, job.filename, io.BytesIO(content))
+
+        job.stage = JobStage.PARSING
+        job.parsing_started_at = time.time()
+        reader = await run_blocking(open_pdf, content)
+        job.pages_total = len(reader.pages)
+        return content, file_hash, reader
+
+    def _chunks(
+        self, job: IngestionJob, content: PDFSource, reader: PdfReader
+    ) -> AsyncIterator[Document]:
+        pages = aiter_pdf_pages(
+            content,
+            reader,
+            source=job.filename,
+            executor=self._parse_pool,
+            min_parallel_pages=self.parallel_min_pages,
+            pages_per_task=self.pages_per_task,
+            max_in_flight=2 * self.parse_workers,
+        )
+        return asplit_documents(pages, self.text_splitter)
+
+    async def _update_manifest(
+        self, job: IngestionJob, stats: IngestionStats, file_hash: Optional[str]
+    ) -> List[str]:
+        if self.manifest is None:
+            return []
+        try:
+            stale = await run_blocking(
+                self.manifest.replace,
+                job.user_id,
+                job.filename,
+                stats.chunk_ids,
+                file_hash,
+            )
+            if stale and self._delete_chunks is not None:
+                await run_blocking(self._delete_chunks, job.user_id, stale)
+            return stale
+        except Exception:
+            if file_hash is None:
+                logger.exception("Failed to record chunks of job %s", job.id)
+                return []
+            raise
+
+    async def delete_file(self, user_id: str, filename: str) -> dict:
+        """Remove a file's chunks and its stored copy, leaving other files alone"""
+        chunk_ids: List[str] = []
+        if self.manifest is not None:
+            chunk_ids = await run_blocking(self.manifest.remove, user_id, filename)
+        if chunk_ids and self._delete_chunks is not None:
+            await run_blocking(self._delete_chunks, user_id, chunk_ids)
+        storage = self._storage_factory(user_id)
+        try:
+            file_deleted = await run_blocking(storage.delete_file, user_id, filename)
+        except Exception as e:
+            logger.warning("Failed to delete stored file %s: %s", filename, e)
+            file_deleted = False
+        if chunk_ids and self._on_corpus_changed:
+            self._on_corpus_changed(user_id)
+        return {"chunks_removed": len(chunk_ids), "file_deleted": bool(file_deleted)}
+
+    async def close(self) -> None:
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(wait=False, cancel_futures=True)
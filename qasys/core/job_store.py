@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+
+class JobStore:
+    """Status of ingestion jobs, shared by all workers on a host.
+
+    Every worker runs its own jobs and writes their status here, so a job can
+    be polled through whichever worker a request lands on. Running jobs are
+    rewritten periodically; a job whose row has not been rewritten for
+    ``stale_seconds`` belonged to a worker that stopped, and is reported as
+    failed and no longer counted as active.
+    """
+
+    def __init__(self, path: str, stale_seconds: float = 60):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " user_id TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " done INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " finished_at REAL);"
+            "CREATE INDEX IF NOT EXISTS jobs_active ON jobs (user_id, kind, done);"
+            "CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);"
+        )
+
+    def add(
+        self,
+        job_id: str,
+        user_id: str,
+        kind: str,
+        status: dict,
+        max_active: Optional[int] = None,
+    ) -> bool:
+        """Record a new job; False if the user already has ``max_active`` of ``kind``"""
+        now = time.time()
+        with self._lock, self._conn:
+            # Takes the write lock first, so no other worker can add a job
+            # between the count and the insert
+            self._conn.execute("BEGIN IMMEDIATE")
+            if max_active is not None:
+                active = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND kind = ?"
+                    " AND done = 0 AND updated_at >= ?",
+                    (user_id, kind, now - self.stale_seconds),
+                ).fetchone()[0]
+                if active >= max_active:
+                    return False
+            self._conn.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, 0, ?, NULL)",
+                (job_id, user_id, kind, json.dumps(status), now),
+            )
+        return True
+
+    def update(self, statuses: Iterable[Tuple[str, dict]]) -> None:
+        """Rewrite the status of running jobs"""
+        now = time.time()
+        rows = [(json.dumps(status), now, job_id) for job_id, status in statuses]
+        with self._lock, self._conn:
+            # Never overwrites the final status written by finish()
+            self._conn.executemany(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND done = 0",
+                rows,
+            )
+
+    def finish(self, job_id: str, status: dict, finished_at: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, done = 1, updated_at = ?, finished_at = ?"
+                " WHERE id = ?",
+                (json.dumps(status), time.time(), finished_at, job_id),
+            )
+
+    def get(self, job_id: str, user_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, done, updated_at FROM jobs"
+                " WHERE id = ? AND user_id = ?",
+                (job_id, user_id),
+            ).fetchone()
+        if row is None:
+            return None
+        status, done, updated_at = json.loads(row[0]), row[1], row[2]
+        if not done and updated_at < time.time() - self.stale_seconds:
+            status["stage"] = "failed"
+            status["error"] = "The worker running this job stopped"
+        return status
+
+    def prune(self, before: float) -> None:
+        """Delete jobs that finished, or were last seen running, before ``before``"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE (done = 1 AND finished_at < ?)"
+                " OR (done = 0 AND updated_at < ?)",
+                (before, before),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
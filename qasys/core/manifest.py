@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional
+
+
+class DocumentManifest:
+    """Records which chunk ids each of a user's files contributed.
+
+    Lets a single file be re-indexed or deleted without touching the rest of
+    the user's collection, and lets an unchanged re-upload be skipped by
+    comparing file hashes.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " user_id TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " file_hash TEXT,"
+            " chunks INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (user_id, filename)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS file_chunks ("
+            " user_id TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " chunk_id TEXT NOT NULL,"
+            " PRIMARY KEY (user_id, filename, chunk_id)) WITHOUT ROWID;"
+        )
+
+    def file_hash(self, user_id: str, filename: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_hash FROM files WHERE user_id = ? AND filename = ?",
+                (user_id, filename),
+            ).fetchone()
+        return row[0] if row else None
+
+    def files(self, user_id: str) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename, file_hash, chunks, updated_at FROM files"
+                " WHERE user_id = ? ORDER BY filename",
+                (user_id,),
+            ).fetchall()
+        return [
+            {"filename": f, "file_hash": h, "chunks": c, "updated_at": u}
+            for f, h, c, u in rows
+        ]
+
+    def chunk_ids(self, user_id: str, filename: str) -> List[str]:
+        with self._lock:
+            return self._chunk_ids(user_id, filename)
+
+    def _chunk_ids(self, user_id: str, filename: str) -> List[str]:
+        return [
+            row[0]
+            for row in self._conn.execute(
+                "SELECT chunk_id FROM file_chunks WHERE user_id = ? AND filename = ?",
+                (user_id, filename),
+            )
+        ]
+
+    def replace(
+        self,
+        user_id: str,
+        filename: str,
+        chunk_ids: Iterable[str],
+        file_hash: Optional[str],
+    ) -> List[str]:
+        """Make ``chunk_ids`` the file's chunks; returns the ids it no longer has.
+
+        Pass ``file_hash=None`` after a partial ingestion: the written ids are
+        added to the old ones (nothing is reported stale) and the next upload
+        of the file is never skipped as unchanged.
+        """
+        chunk_ids = set(chunk_ids)
+        with self._lock, self._conn:
+            previous = set(self._chunk_ids(user_id, filename))
+            stale = sorted(previous - chunk_ids) if file_hash is not None else []
+            self._conn.executemany(
+                "DELETE FROM file_chunks"
+                " WHERE user_id = ? AND filename = ? AND chunk_id = ?",
+                [(user_id, filename, chunk_id) for chunk_id in stale],
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO file_chunks VALUES (?, ?, ?)",
+                [(user_id, filename, chunk_id) for chunk_id in chunk_ids - previous],
+            )
+            total = len(previous | chunk_ids) - len(stale)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (user_id, filename, file_hash, total, time.time()),
+            )
+        return stale
+
+    def remove(self, user_id: str, filename: str) -> List[str]:
+        """Forget a file; returns the chunk ids that belonged to it"""
+        with self._lock, self._conn:
+            chunk_ids = self._chunk_ids(user_id, filename)
+            self._conn.execute(
+                "DELETE FROM file_chunks WHERE user_id = ? AND filename = ?",
+                (user_id, filename),
+            )
+            self._conn.execute(
+                "DELETE FROM files WHERE user_id = ? AND filename = ?",
+                (user_id, filename),
+            )
+        return chunk_ids
+
+    def remove_user(self, user_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM file_chunks WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM files WHERE user_id = ?", (user_id,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
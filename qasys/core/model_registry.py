@@ -0,0 +1,134 @@
+import logging
+import os
+import resource
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ModelStats:
+    name: str
+    loaded: bool = False
+    load_seconds: Optional[float] = None
+    memory_bytes: Optional[int] = None
+    batching: Optional[dict] = None
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _parameter_bytes(instance: Any) -> Optional[int]:
+    """Size of the torch weights behind a HuggingFace pipeline, if any"""
+    pipe = getattr(instance, "pipeline", None)
+    model = (
+        getattr(pipe, "model", None)
+        or getattr(instance, "client", None)
+        or getattr(instance, "model", None)
+    )
+    parameters = getattr(model, "parameters", None)
+    if not callable(parameters):
+        return None
+    try:
+        return sum(p.numel() * p.element_size() for p in parameters())
+    except Exception:
+        return None
+
+
+def _batcher(instance: Any) -> Any:
+    """The ``MicroBatcher`` behind a model, looking through cache wrappers"""
+    while instance is not None:
+        batcher = getattr(instance, "batcher", None)
+        if batcher is not None:
+            return batcher
+        instance = getattr(instance, "embeddings", None)
+    return None
+
+
+class ModelRegistry:
+    """Process-wide holder for warm LLM, embedding and HTTP clients.
+
+    Factories are registered by name and only invoked on first use (or on
+    ``warm_up``); every later ``get`` returns the same instance.
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._stats: Dict[str, ModelStats] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        self._factories[name] = factory
+        self._stats[name] = ModelStats(name=name)
+        self._locks[name] = threading.Lock()
+
+    def get(self, name: str) -> Any:
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        if name not in self._factories:
+            raise KeyError(f"No model registered under '{name}'")
+        with self._locks[name]:
+            instance = self._instances.get(name)
+            if instance is None:
+                instance = self._load(name)
+        return instance
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._instances
+
+    def _load(self, name: str) -> Any:
+        rss_before = _rss_bytes()
+        start = time.perf_counter()
+        instance = self._factories[name]()
+        elapsed = time.perf_counter() - start
+        memory = _parameter_bytes(instance)
+        if memory is None:
+            memory = max(_rss_bytes() - rss_before, 0)
+        self._stats[name] = ModelStats(
+            name=name, loaded=True, load_seconds=elapsed, memory_bytes=memory
+        )
+        self._instances[name] = instance
+        logger.info(
+            "Loaded %s in %.2fs (%.1f MiB)", name, elapsed, memory / (1024 * 1024)
+        )
+        return instance
+
+    def warm_up(self, names: Optional[Iterable[str]] = None) -> None:
+        for name in names or list(self._factories):
+            self.get(name)
+
+    async def awarm_up(self, names: Optional[Iterable[str]] = None) -> None:
+        await run_blocking(self.warm_up, names)
+
+    def stats(self) -> List[dict]:
+        result = []
+        for name, stats in self._stats.items():
+            batcher = _batcher(self._instances.get(name))
+            if batcher is not None:
+                stats.batching = batcher.stats()
+            result.append(asdict(stats))
+        return result
+
+    def close(self) -> None:
+        for name, instance in list(self._instances.items()):
+            close = getattr(instance, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception as e:
+                    logger.warning("Failed to close %s: %s", name, e)
+        self._instances.clear()
+        for name in self._stats:
+            self._stats[name] = ModelStats(name=name)
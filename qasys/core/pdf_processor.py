@@ -1,18 +1,159 @@
+import asyncio
+import functools
+import io
+import mmap
 import os
+import shutil
 import tempfile
-from typing import BinaryIO, List
+from collections import deque
+from concurrent.futures import Executor
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    BinaryIO,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
 
 from langchain.schema import Document
-from langchain_community.document_loaders import PyPDFLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
+from pypdf import PdfReader
+from starlette.concurrency import iterate_in_threadpool
 
-from qasys.utils.storage import AuthenticatedStorage
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
 
+PDFSource = Union[bytes, BinaryIO]
 
-def process_pdf(pdf_content: BinaryIO) -> List[Document]:
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        temp_file.write(pdf_content)
-        temp_file_path = temp_file.name
-    loader = PyPDFLoader(temp_file_path)
-    pages = loader.load_and_split()
-    os.remove(temp_file_path)
-    return pages
+
+def open_pdf(pdf_content: PDFSource) -> PdfReader:
+    # BytesIO shares the buffer of a bytes object instead of copying it, and
+    # file-like sources (including mmap objects) are read in place.
+    if isinstance(pdf_content, bytes):
+        pdf_content = io.BytesIO(pdf_content)
+    return PdfReader(pdf_content)
+
+
+def iter_pdf_pages(reader: PdfReader, source: str = "") -> Iterator[Document]:
+    for page_number, page in enumerate(reader.pages):
+        with metrics.span("pdf.parse"):
+            text = page.extract_text()
+        yield Document(
+            page_content=text, metadata={"source": source, "page": page_number}
+        )
+
+
+def _write_temp_pdf(pdf_content: PDFSource) -> str:
+    with tempfile.NamedTemporaryFile(
+        prefix="qasys-", suffix=".pdf", delete=False
+    ) as file:
+        if isinstance(pdf_content, (bytes, mmap.mmap)):
+            file.write(pdf_content)
+        else:
+            pdf_content.seek(0)
+            shutil.copyfileobj(pdf_content, file)
+    return file.name
+
+
+@functools.lru_cache(maxsize=2)
+def _open_mapped_pdf(path: str, inode: int, mtime_ns: int) -> PdfReader:
+    # Keyed by inode and mtime too, since a temporary path can be reused. The
+    # mapping outlives both the file object and the file's deletion.
+    with open(path, "rb") as file:
+        return open_pdf(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def extract_page_texts(path: str, start: int, stop: int) -> List[str]:
+    """Extract the text of pages ``[start, stop)``; runs inside a worker process.
+
+    The file is memory-mapped rather than read, and each worker opens a
+    document once and reuses the reader for its later ranges.
+    """
+    stat = os.stat(path)
+    reader = _open_mapped_pdf(path, stat.st_ino, stat.st_mtime_ns)
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+async def aiter_pdf_pages(
+    pdf_content: PDFSource,
+    reader: PdfReader,
+    source: str = "",
+    executor: Optional[Executor] = None,
+    min_parallel_pages: int = 64,
+    pages_per_task: int = 16,
+    max_in_flight: int = 8,
+) -> AsyncIterator[Document]:
+    """Yield pages in order, extracting page ranges in ``executor`` for large files.
+
+    Small documents (or no executor) are extracted serially in a thread, since
+    handing the PDF to worker processes costs more than it saves. In parallel
+    mode the PDF is written once to a temporary file that the workers map,
+    instead of being pickled with every range, and at most ``max_in_flight``
+    ranges are outstanding so finished pages do not pile up ahead of the
+    consumer.
+    """
+    page_count = len(reader.pages)
+    if executor is None or page_count < min_parallel_pages:
+        async for page in iterate_in_threadpool(iter_pdf_pages(reader, source)):
+            yield page
+        return
+
+    loop = asyncio.get_running_loop()
+    ranges = iter(range(0, page_count, pages_per_task))
+    in_flight = deque()
+    path = await run_blocking(_write_temp_pdf, pdf_content)
+
+    def submit_next() -> None:
+        start = next(ranges, None)
+        if start is not None:
+            stop = min(start + pages_per_task, page_count)
+            future = loop.run_in_executor(
+                executor, extract_page_texts, path, start, stop
+            )
+            in_flight.append((start, future))
+
+    try:
+        for _ in range(max_in_flight):
+            submit_next()
+        while in_flight:
+            start, future = in_flight.popleft()
+            # Time spent waiting on the parse workers, not their CPU time
+            with metrics.span("pdf.parse"):
+                texts = await future
+            submit_next()
+            for offset, text in enumerate(texts):
+                yield Document(
+                    page_content=text,
+                    metadata={"source": source, "page": start + offset},
+                )
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+        # Workers still mapping the file keep reading it after the unlink
+        os.unlink(path)
+
+
+def iter_pdf_chunks(
+    reader: PdfReader,
+    source: str = "",
+    text_splitter: Optional[TextSplitter] = None,
+) -> Iterator[Document]:
+    text_splitter = text_splitter or RecursiveCharacterTextSplitter()
+    for page in iter_pdf_pages(reader, source):
+        yield from text_splitter.split_documents([page])
+
+
+async def asplit_documents(
+    documents: AsyncIterable[Document], text_splitter: Optional[TextSplitter] = None
+) -> AsyncIterator[Document]:
+    text_splitter = text_splitter or RecursiveCharacterTextSplitter()
+    async for document in documents:
+        chunks = await run_blocking(text_splitter.split_documents, [document])
+        for chunk in chunks:
+            yield chunk
+
+
+def process_pdf(pdf_content: PDFSource, source: str = "") -> List[Document]:
+    return list(iter_pdf_chunks(open_pdf(pdf_content), source))
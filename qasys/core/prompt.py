@@ -0,0 +1,120 @@
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR
+from langchain.llms.base import BaseLanguageModel
+from langchain.schema import Document
+from langchain.schema.prompt import PromptValue
+
+from qasys.core.sparse_index import tokenize
+
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+_SEPARATOR = "\n\n"
+
+
+@dataclass
+class AssembledPrompt:
+    prompt: PromptValue
+    documents: List[Document]
+    tokens: int
+    compressed: bool = False
+    dropped_documents: int = 0
+
+
+class PromptBuilder:
+    """Assembles the "stuff" prompt within a token budget.
+
+    Sentences already present in a higher-ranked chunk (duplicates and the
+    overlap between neighbouring chunks) are removed first. Chunks are then
+    added whole in rank order; the first chunk that does not fit is reduced to
+    its sentences that share the most terms with the question, and anything
+    after the budget runs out is dropped. ``answer_tokens`` of the model's
+    window are left free for the answer.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_tokens: int = 3000,
+        answer_tokens: int = 512,
+    ):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.answer_tokens = answer_tokens
+
+    def _unique_sentences(self, documents: List[Document]) -> List[List[str]]:
+        seen = set()
+        unique = []
+        for document in documents:
+            sentences = []
+            for sentence in _SENTENCE_BREAK.split(document.page_content.strip()):
+                key = " ".join(sentence.lower().split())
+                if key and key not in seen:
+                    seen.add(key)
+                    sentences.append(sentence)
+            unique.append(sentences)
+        return unique
+
+    def _extract(self, sentences: List[str], terms: set, budget: int) -> List[str]:
+        scored = []
+        for position, sentence in enumerate(sentences):
+            overlap = len(terms.intersection(tokenize(sentence)))
+            if overlap:
+                scored.append((overlap, position, sentence))
+        kept = []
+        for _, position, sentence in sorted(scored, key=lambda s: (-s[0], s[1])):
+            tokens = self.count_tokens(sentence) + 1
+            if tokens <= budget:
+                kept.append((position, sentence))
+                budget -= tokens
+        return [sentence for _, sentence in sorted(kept)]
+
+    def build(
+        self,
+        llm: BaseLanguageModel,
+        question: str,
+        documents: List[Document],
+        relevance_query: Optional[str] = None,
+    ) -> AssembledPrompt:
+        """``relevance_query`` (default ``question``) picks sentences to keep"""
+        template = PROMPT_SELECTOR.get_prompt(llm)
+        overhead = self.count_tokens(
+            template.format_prompt(context="", question=question).to_string()
+        )
+        budget = self.max_tokens - self.answer_tokens - overhead
+        separator_tokens = self.count_tokens(_SEPARATOR)
+        terms = set(tokenize(relevance_query or question))
+
+        kept: List[Document] = []
+        compressed = False
+        for document, sentences in zip(documents, self._unique_sentences(documents)):
+            if not sentences:
+                continue
+            if budget <= separator_tokens:
+                break
+            text = " ".join(sentences)
+            tokens = self.count_tokens(text) + separator_tokens
+            if tokens > budget:
+                sentences = self._extract(sentences, terms, budget - separator_tokens)
+                if not sentences:
+                    continue
+                text = " ".join(sentences)
+                tokens = self.count_tokens(text) + separator_tokens
+                compressed = True
+            elif text != document.page_content.strip():
+                compressed = True
+            kept.append(Document(page_content=text, metadata=document.metadata))
+            budget -= tokens
+
+        prompt = template.format_prompt(
+            context=_SEPARATOR.join(document.page_content for document in kept),
+            question=question,
+        )
+        return AssembledPrompt(
+            prompt=prompt,
+            documents=kept,
+            tokens=self.count_tokens(prompt.to_string()),
+            compressed=compressed,
+            dropped_documents=len(documents) - len(kept),
+        )
@@ -1,9 +1,57 @@
-from langchain.chains.retrieval_qa.base import RetrievalQA
+from dataclasses import dataclass
+from typing import List, Literal, Optional
+
+from langchain.chains.question_answering import load_qa_chain
 from langchain.llms.base import BaseLanguageModel
-from langchain.vectorstores.base import VectorStore
+from langchain.schema import Document
+
+from qasys.core.prompt import PromptBuilder
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
+
+ChainType = Literal["stuff", "map_reduce", "refine"]
+
+
+@dataclass
+class QAResult:
+    answer: str
+    documents: List[Document]
+    # Only known for the budgeted "stuff" prompt
+    prompt_tokens: Optional[int] = None
+    compressed: bool = False
+
 
+async def aanswer(
+    llm: BaseLanguageModel,
+    question: str,
+    documents: List[Document],
+    prompt_builder: PromptBuilder,
+    chain_type: ChainType = "stuff",
+    relevance_query: Optional[str] = None,
+) -> QAResult:
+    """Answer ``question`` from already retrieved ``documents``.
 
-def create_qa_system(retriever: VectorStore, llm: BaseLanguageModel) -> RetrievalQA:
-    return RetrievalQA.from_chain_type(
-        llm, chain_type="stuff", retriever=retriever.as_retriever()
-    )
+    "stuff" sends one prompt assembled within the builder's token budget.
+    "map_reduce" and "refine" make one LLM call per document, which suits
+    large documents that would otherwise be compressed heavily.
+    """
+    if chain_type == "stuff":
+        with metrics.span("prompt.build"):
+            assembled = await run_blocking(
+                prompt_builder.build, llm, question, documents, relevance_query
+            )
+        metrics.count_tokens("prompt", assembled.tokens)
+        with metrics.span("llm.generate"):
+            output = await llm.ainvoke(assembled.prompt)
+        return QAResult(
+            answer=getattr(output, "content", output),
+            documents=assembled.documents,
+            prompt_tokens=assembled.tokens,
+            compressed=assembled.compressed,
+        )
+    chain = load_qa_chain(llm, chain_type=chain_type)
+    with metrics.span("llm.generate"):
+        output = await chain.ainvoke(
+            {"input_documents": documents, "question": question}
+        )
+    return QAResult(answer=output["output_text"], documents=documents)
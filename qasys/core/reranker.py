@@ -0,0 +1,104 @@
+import logging
+import time
+from typing import List
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import BaseRetriever, Document
+
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+class CrossEncoderReranker:
+    """Scores (query, passage) pairs with a local sequence-classification model.
+
+    Pairs are scored jointly, which ranks far better than comparing separate
+    embeddings, so it is only run over a small candidate set.
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 16, max_length: int = 512):
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self._torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.eval()
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        scores: List[float] = []
+        with self._torch.inference_mode():
+            for start in range(0, len(texts), self.batch_size):
+                batch = texts[start : start + self.batch_size]
+                inputs = self.tokenizer(
+                    [query] * len(batch),
+                    batch,
+                    padding=True,
+                    truncation="only_second",
+                    max_length=self.max_length,
+                    return_tensors="pt",
+                )
+                logits = self.model(**inputs).logits
+                # Single-logit models score relevance directly; two-class
+                # models put "relevant" last.
+                scores.extend(logits[:, -1].tolist())
+        return scores
+
+
+class RerankingRetriever(BaseRetriever):
+    """Over-fetches candidates from ``base_retriever`` and keeps the ``top_n``
+    the cross-encoder scores highest."""
+
+    base_retriever: BaseRetriever
+    reranker: CrossEncoderReranker
+    top_n: int = 4
+
+    def _rerank(
+        self, query: str, candidates: List[Document], retrieve_ms: float
+    ) -> List[Document]:
+        start = time.perf_counter()
+        with metrics.span("retrieval.rerank"):
+            scores = self.reranker.score(
+                query, [document.page_content for document in candidates]
+            )
+        ranked = sorted(zip(scores, candidates), key=lambda pair: pair[0], reverse=True)
+        documents = []
+        for score, document in ranked[: self.top_n]:
+            document.metadata["rerank_score"] = score
+            documents.append(document)
+        logger.info(
+            "Retrieved %d candidates in %.0fms, reranked to %d in %.0fms",
+            len(candidates),
+            retrieve_ms,
+            len(documents),
+            (time.perf_counter() - start) * 1000,
+        )
+        return documents
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        start = time.perf_counter()
+        candidates = self.base_retriever.invoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+        retrieve_ms = (time.perf_counter() - start) * 1000
+        return self._rerank(query, candidates, retrieve_ms)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        start = time.perf_counter()
+        candidates = await self.base_retriever.ainvoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+        retrieve_ms = (time.perf_counter() - start) * 1000
+        return await run_blocking(self._rerank, query, candidates, retrieve_ms)
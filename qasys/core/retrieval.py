@@ -0,0 +1,97 @@
+import asyncio
+from typing import Dict, List, Sequence
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import BaseRetriever, Document
+from langchain_community.vectorstores import Chroma
+
+from qasys.core.sparse_index import SparseIndex
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[str]], k: int = 60
+) -> List[tuple]:
+    """Fuse ranked id lists into ``(id, score)`` pairs, best first.
+
+    Each list contributes ``1 / (k + rank)`` per id, so only ranks matter and
+    BM25 and cosine scores never need to be put on the same scale.
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """Combines dense (Chroma) and sparse (BM25) retrieval with RRF.
+
+    ``dense_k`` and ``sparse_k`` candidates are fetched from each stage and
+    the best ``k`` fused chunks are returned.
+    """
+
+    vector_store: Chroma
+    sparse_index: SparseIndex
+    k: int = 4
+    dense_k: int = 20
+    sparse_k: int = 20
+    rrf_k: int = 60
+
+    def _dense(self, embedding: List[float]) -> Dict[str, Document]:
+        with metrics.span("retrieval.dense"):
+            result = self.vector_store._collection.query(
+                query_embeddings=[embedding],
+                n_results=self.dense_k,
+                include=["documents", "metadatas"],
+            )
+        return {
+            chunk_id: Document(page_content=text, metadata=metadata or {})
+            for chunk_id, text, metadata in zip(
+                result["ids"][0], result["documents"][0], result["metadatas"][0]
+            )
+        }
+
+    def _sparse(self, query: str) -> List[tuple]:
+        with metrics.span("retrieval.sparse"):
+            return self.sparse_index.search(query, self.sparse_k)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        with metrics.span("retrieval.embed_query"):
+            return await self.vector_store.embeddings.aembed_query(query)
+
+    def _fuse(self, dense: Dict[str, Document], sparse: List[tuple]) -> List[Document]:
+        fused = reciprocal_rank_fusion(
+            [list(dense), [chunk_id for chunk_id, _ in sparse]], self.rrf_k
+        )[: self.k]
+        missing = [chunk_id for chunk_id, _ in fused if chunk_id not in dense]
+        if missing:
+            result = self.vector_store._collection.get(
+                ids=missing, include=["documents", "metadatas"]
+            )
+            for chunk_id, text, metadata in zip(
+                result["ids"], result["documents"], result["metadatas"]
+            ):
+                dense[chunk_id] = Document(page_content=text, metadata=metadata or {})
+        # A chunk can be missing if it was deleted after the sparse lookup
+        return [dense[chunk_id] for chunk_id, _ in fused if chunk_id in dense]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with metrics.span("retrieval.embed_query"):
+            embedding = self.vector_store.embeddings.embed_query(query)
+        return self._fuse(self._dense(embedding), self._sparse(query))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        embedding, sparse = await asyncio.gather(
+            self._aembed_query(query), run_blocking(self._sparse, query)
+        )
+        dense = await run_blocking(self._dense, embedding)
+        return await run_blocking(self._fuse, dense, sparse)
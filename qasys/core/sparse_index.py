@@ -0,0 +1,197 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from heapq import nlargest
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Words plus identifiers that keep their inner separators, so part numbers and
+# error codes such as "AB-1234/5" or "0x1F.E2" survive as one term.
+_TERM = re.compile(r"[^\W_]+(?:[-_./:#][^\W_]+)*")
+_SEPARATORS = re.compile(r"[-_./:#]")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased terms of ``text``; compound identifiers also yield their parts"""
+    terms = []
+    for match in _TERM.finditer(text.lower()):
+        term = match.group()
+        terms.append(term)
+        if _SEPARATORS.search(term):
+            terms.extend(part for part in _SEPARATORS.split(term) if part)
+    return terms
+
+
+class SparseIndex:
+    """BM25 inverted index for one user's chunks, stored in SQLite.
+
+    Terms and chunks are interned to integer ids so each posting is three
+    integers, and chunks are added or removed in place without rebuilding.
+    Only chunk ids are stored; the text lives in the vector store.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS terms ("
+            " id INTEGER PRIMARY KEY,"
+            " term TEXT UNIQUE NOT NULL,"
+            " df INTEGER NOT NULL DEFAULT 0);"
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " id INTEGER PRIMARY KEY,"
+            " chunk_id TEXT UNIQUE NOT NULL,"
+            " length INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term_id INTEGER NOT NULL,"
+            " chunk INTEGER NOT NULL,"
+            " tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term_id, chunk)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk);"
+        )
+        self._corpus_stats: Optional[Tuple[int, float]] = None
+        self._data_version: Optional[int] = None
+
+    def _lookup(self, terms: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+        """``{term: (term_id, document_frequency)}`` for the known ``terms``"""
+        terms = list(terms)
+        found = {}
+        # Stay under SQLite's host parameter limit
+        for start in range(0, len(terms), 500):
+            part = terms[start : start + 500]
+            placeholders = ",".join("?" * len(part))
+            found.update(
+                (term, (term_id, df))
+                for term_id, term, df in self._conn.execute(
+                    f"SELECT id, term, df FROM terms WHERE term IN ({placeholders})",
+                    part,
+                )
+            )
+        return found
+
+    def _delete(self, chunk_ids: Sequence[str]) -> int:
+        deleted = 0
+        for chunk_id in chunk_ids:
+            row = self._conn.execute(
+                "SELECT id FROM chunks WHERE chunk_id = ?", (chunk_id,)
+            ).fetchone()
+            if row is None:
+                continue
+            self._conn.execute(
+                "UPDATE terms SET df = df - 1"
+                " WHERE id IN (SELECT term_id FROM postings WHERE chunk = ?)",
+                row,
+            )
+            self._conn.execute("DELETE FROM postings WHERE chunk = ?", row)
+            self._conn.execute("DELETE FROM chunks WHERE id = ?", row)
+            deleted += 1
+        return deleted
+
+    def add(self, chunk_ids: Sequence[str], texts: Sequence[str]) -> None:
+        """Index chunks, replacing any already indexed under the same id"""
+        counts = [Counter(tokenize(text)) for text in texts]
+        vocabulary = set().union(*counts) if counts else set()
+        with self._lock, self._conn:
+            self._delete(chunk_ids)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO terms (term) VALUES (?)",
+                [(term,) for term in vocabulary],
+            )
+            term_ids = {
+                term: found[0] for term, found in self._lookup(vocabulary).items()
+            }
+            document_frequency: Counter = Counter()
+            for chunk_id, terms in zip(chunk_ids, counts):
+                chunk = self._conn.execute(
+                    "INSERT INTO chunks (chunk_id, length) VALUES (?, ?)",
+                    (chunk_id, sum(terms.values())),
+                ).lastrowid
+                self._conn.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    [(term_ids[term], chunk, tf) for term, tf in terms.items()],
+                )
+                document_frequency.update(term_ids[term] for term in terms)
+            self._conn.executemany(
+                "UPDATE terms SET df = df + ? WHERE id = ?",
+                [(df, term_id) for term_id, df in document_frequency.items()],
+            )
+            self._corpus_stats = None
+
+    def delete(self, chunk_ids: Sequence[str]) -> int:
+        with self._lock, self._conn:
+            deleted = self._delete(chunk_ids)
+            if deleted:
+                self._conn.execute("DELETE FROM terms WHERE df <= 0")
+                self._corpus_stats = None
+        return deleted
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute("DELETE FROM terms")
+            self._corpus_stats = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._stats()[0]
+
+    def _stats(self) -> Tuple[int, float]:
+        # Other processes (API workers) may write to the same file
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._corpus_stats = None
+        if self._corpus_stats is None:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks"
+            ).fetchone()
+            self._corpus_stats = (count, total / count if count else 0.0)
+        return self._corpus_stats
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[str, float]]:
+        """Top ``k`` ``(chunk_id, bm25_score)`` pairs for ``query``"""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            total, average_length = self._stats()
+            if not total:
+                return []
+            scores: Dict[int, float] = defaultdict(float)
+            for term_id, df in self._lookup(terms).values():
+                if df <= 0:
+                    continue
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                for chunk, tf, length in self._conn.execute(
+                    "SELECT p.chunk, p.tf, c.length FROM postings p"
+                    " JOIN chunks c ON c.id = p.chunk WHERE p.term_id = ?",
+                    (term_id,),
+                ):
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[chunk] += idf * tf * (self.k1 + 1) / (tf + norm)
+            top = nlargest(k, scores.items(), key=itemgetter(1))
+            if not top:
+                return []
+            placeholders = ",".join("?" * len(top))
+            chunk_ids = dict(
+                self._conn.execute(
+                    f"SELECT id, chunk_id FROM chunks WHERE id IN ({placeholders})",
+                    [chunk for chunk, _ in top],
+                )
+            )
+        return [(chunk_ids[chunk], score) for chunk, score in top]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
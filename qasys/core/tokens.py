@@ -0,0 +1,71 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Callable, List
+
+from qasys.config import ModelProvider, settings
+
+logger = logging.getLogger(__name__)
+
+_WORD_PIECES = re.compile(r"\w+|[^\w\s]")
+
+
+def _approximate_encode(text: str) -> List[str]:
+    return _WORD_PIECES.findall(text)
+
+
+class TokenCounter:
+    def __init__(self, encode: Callable[[str], List], name: str):
+        self._encode = encode
+        self.name = name
+
+    def encode(self, text: str) -> List:
+        return self._encode(text) if text else []
+
+    def count(self, text: str) -> int:
+        return len(self._encode(text)) if text else 0
+
+    def __call__(self, text: str) -> int:
+        return self.count(text)
+
+
+def _tiktoken_counter(model_name: str) -> TokenCounter:
+    import tiktoken
+
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return TokenCounter(
+        lambda text: encoding.encode(text, disallowed_special=()), encoding.name
+    )
+
+
+def _huggingface_counter(model_name: str) -> TokenCounter:
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return TokenCounter(
+        lambda text: tokenizer.encode(text, add_special_tokens=False), model_name
+    )
+
+
+@lru_cache(maxsize=1)
+def get_token_counter() -> TokenCounter:
+    """Token counter for the configured LLM.
+
+    Ollama does not ship its tokenizers, so its models are approximated with
+    ``cl100k_base``. If no tokenizer can be loaded (e.g. offline), a
+    word/punctuation split is used instead.
+    """
+    try:
+        match settings.MODEL_PROVIDER:
+            case ModelProvider.OPENAI:
+                return _tiktoken_counter(settings.OPENAI_LLM_MODEL_NAME)
+            case ModelProvider.HUGGINGFACE:
+                return _huggingface_counter(settings.HF_LLM_MODEL_NAME)
+            case _:
+                return _tiktoken_counter("cl100k_base")
+    except Exception as e:
+        logger.warning("Falling back to approximate token counts: %s", e)
+        return TokenCounter(_approximate_encode, "approximate")
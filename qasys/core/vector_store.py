@@ -1,10 +1,47 @@
-from typing import List, Type
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
+import chromadb
+from chromadb.api import ClientAPI
+from chromadb.config import Settings as ChromaSettings
+from chromadb.errors import InvalidCollectionException
 from langchain.embeddings.base import Embeddings
 from langchain.schema import Document
 from langchain.vectorstores.base import VectorStore
 from langchain_community.vectorstores import Chroma
 
+from qasys.core.sparse_index import SparseIndex
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# How the embedded Chroma client reports a missing collection. The HTTP client
+# raises a bare ``Exception``, so callers check ``_has_collection`` first.
+_MISSING_COLLECTION = (InvalidCollectionException, ValueError)
+
 
 def create_vector_store(
     documents: List[Document],
@@ -12,3 +49,352 @@ def create_vector_store(
     vector_store_cls: Type[VectorStore] = Chroma,
 ) -> VectorStore:
     return vector_store_cls.from_documents(documents, embedding_model)
+
+
+def user_collection_name(user_id: str) -> str:
+    # Chroma only accepts 3-63 character names from a restricted alphabet,
+    # so hash the user id rather than trying to sanitise it.
+    return "user-" + hashlib.sha256(user_id.encode()).hexdigest()[:40]
+
+
+def chunk_id(user_id: str, document: Document) -> str:
+    """Stable id of a chunk: the same text from the same file always maps to the
+    same id, so re-ingesting a file overwrites its chunks instead of adding
+    copies."""
+    content_hash = (
+        document.metadata.get("content_hash")
+        or hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
+    )
+    raw = json.dumps([user_id, document.metadata.get("source", ""), content_hash])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class VectorStoreManager:
+    """Shares one Chroma client across all users of the process.
+
+    The client is embedded over ``persist_directory`` unless one is passed
+    in, e.g. an ``HttpClient`` to a Chroma server shared by several API
+    workers. Each user gets their own collection. Open collection handles are kept in
+    an LRU so hot users skip the lookup, and handles idle for longer than
+    ``idle_seconds`` are dropped. With a ``sparse_directory`` each user also
+    gets a BM25 index, stored in one SQLite file per user.
+    """
+
+    def __init__(
+        self,
+        persist_directory: str,
+        embedding_provider: Callable[[], Embeddings],
+        max_open_collections: int = 128,
+        idle_seconds: float = 900,
+        sparse_directory: Optional[str] = None,
+        client: Optional[ClientAPI] = None,
+    ):
+        self.client = client or chromadb.PersistentClient(
+            path=persist_directory,
+            settings=ChromaSettings(anonymized_telemetry=False),
+        )
+        self._embedding_provider = embedding_provider
+        self.max_open_collections = max_open_collections
+        self.idle_seconds = idle_seconds
+        self._stores: OrderedDict[str, Tuple[Chroma, float]] = OrderedDict()
+        self.sparse_directory = sparse_directory
+        self._sparse_indexes: OrderedDict[str, SparseIndex] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_user_store(self, user_id: str) -> Chroma:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._stores.pop(user_id, None)
+            store = entry[0] if entry else None
+            if store is None:
+                store = Chroma(
+                    client=self.client,
+                    collection_name=user_collection_name(user_id),
+                    embedding_function=self._embedding_provider(),
+                )
+            self._stores[user_id] = (store, now)
+            self._evict(now)
+        return store
+
+    def _evict(self, now: float) -> None:
+        while len(self._stores) > self.max_open_collections:
+            self._stores.popitem(last=False)
+        while self._stores:
+            user_id, (_, last_used) = next(iter(self._stores.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self._stores[user_id]
+
+    def _sparse_path(self, user_id: str) -> str:
+        return os.path.join(
+            self.sparse_directory, user_collection_name(user_id) + ".sqlite"
+        )
+
+    def get_sparse_index(self, user_id: str) -> SparseIndex:
+        if self.sparse_directory is None:
+            raise RuntimeError("Sparse indexing is not enabled")
+        with self._lock:
+            index = self._sparse_indexes.pop(user_id, None)
+            created = index is None
+            if created:
+                index = SparseIndex(self._sparse_path(user_id))
+            self._sparse_indexes[user_id] = index
+            while len(self._sparse_indexes) > self.max_open_collections:
+                # Evicted connections close once in-flight users release them
+                self._sparse_indexes.popitem(last=False)
+        if created and not len(index):
+            self._backfill_sparse_index(user_id, index)
+        return index
+
+    def _has_collection(self, name: str) -> bool:
+        # Chroma 0.5 lists collections, later versions list their names
+        return any(
+            getattr(collection, "name", collection) == name
+            for collection in self.client.list_collections()
+        )
+
+    def _backfill_sparse_index(
+        self, user_id: str, index: SparseIndex, page_size: int = 1000
+    ) -> None:
+        # Collections ingested before sparse indexing existed are indexed once
+        name = user_collection_name(user_id)
+        if not self._has_collection(name):
+            return
+        try:
+            collection = self.client.get_collection(name)
+        except _MISSING_COLLECTION:
+            return
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            index.add(page["ids"], page["documents"])
+            offset += len(page["ids"])
+        if offset:
+            logger.info("Built sparse index of %d chunks for %s", offset, user_id)
+
+    def delete_chunks(
+        self, user_id: str, chunk_ids: Sequence[str], batch_size: int = 5000
+    ) -> None:
+        store = self.get_user_store(user_id)
+        for start in range(0, len(chunk_ids), batch_size):
+            store._collection.delete(ids=list(chunk_ids[start : start + batch_size]))
+        if self.sparse_directory is not None:
+            self.get_sparse_index(user_id).delete(chunk_ids)
+
+    def drop_user(self, user_id: str) -> None:
+        with self._lock:
+            self._stores.pop(user_id, None)
+            index = self._sparse_indexes.pop(user_id, None)
+        # Chroma calls run unlocked so other users' stores stay available
+        name = user_collection_name(user_id)
+        try:
+            # Skipped when the collection was never created for this user
+            if self._has_collection(name):
+                self.client.delete_collection(name)
+        except _MISSING_COLLECTION:
+            pass
+        if index is None and self.sparse_directory is not None:
+            if os.path.exists(self._sparse_path(user_id)):
+                index = SparseIndex(self._sparse_path(user_id))
+        if index is not None:
+            # Cleared rather than unlinked, other holders may still be writing
+            index.clear()
+
+    def open_collections(self) -> int:
+        return len(self._stores)
+
+
+@dataclass
+class IngestionStats:
+    chunks: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    seconds: float = 0.0
+    # Ids of every chunk written, including those of failed runs
+    chunk_ids: Set[str] = field(default_factory=set)
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "chunks": self.chunks,
+            "batches": self.batches,
+            "unique_chunks": len(self.chunk_ids),
+            "failed_batches": self.failed_batches,
+            "seconds": round(self.seconds, 3),
+            "chunks_per_second": round(self.chunks_per_second, 2),
+        }
+
+
+async def _abatched(
+    documents: Union[Iterable[Document], AsyncIterable[Document]], size: int
+) -> AsyncIterator[List[Document]]:
+    batch: List[Document] = []
+    if isinstance(documents, AsyncIterable):
+        async for document in documents:
+            batch.append(document)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    else:
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class IngestionPipeline:
+    """Embeds documents in fixed-size batches and writes each batch as soon as
+    it is ready.
+
+    Remote providers (OpenAI, Ollama) are called through their async API;
+    local models (``local=True``) run in a thread pool so they do not block
+    the event loop. With a ``user_id`` chunks get ids from ``chunk_id`` and
+    are upserted; otherwise every chunk is appended under a random id. At most ``max_concurrency`` batches are in flight, which
+    also bounds how far ahead of the writer the input iterable is consumed.
+    """
+
+    def __init__(
+        self,
+        vector_store: Chroma,
+        embedding_model: Embeddings,
+        batch_size: int = 64,
+        max_concurrency: int = 4,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5,
+        local: bool = False,
+        sparse_index: Optional[SparseIndex] = None,
+        user_id: Optional[str] = None,
+    ):
+        self.vector_store = vector_store
+        self.embedding_model = embedding_model
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.local = local
+        self.sparse_index = sparse_index
+        self.user_id = user_id
+
+    async def run(
+        self,
+        documents: Union[Iterable[Document], AsyncIterable[Document]],
+        on_progress: Optional[Callable[[List[Document]], None]] = None,
+        stats: Optional[IngestionStats] = None,
+    ) -> IngestionStats:
+        """Ingest ``documents``; pass ``stats`` to keep them if the run raises"""
+        stats = stats if stats is not None else IngestionStats()
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks = set()
+        executor = ThreadPoolExecutor(self.max_concurrency) if self.local else None
+
+        def on_done(task: asyncio.Task) -> None:
+            tasks.discard(task)
+            semaphore.release()
+
+        try:
+            async for batch in _abatched(documents, self.batch_size):
+                await semaphore.acquire()
+                task = asyncio.create_task(
+                    self._process_batch(batch, executor, stats, on_progress)
+                )
+                tasks.add(task)
+                task.add_done_callback(on_done)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+        stats.seconds = time.perf_counter() - start
+        logger.info(
+            "Ingested %d chunks in %d batches in %.2fs (%.1f chunks/s)",
+            stats.chunks,
+            stats.batches,
+            stats.seconds,
+            stats.chunks_per_second,
+        )
+        if stats.failed_batches:
+            raise RuntimeError(
+                f"{stats.failed_batches} of {stats.batches} embedding batches failed"
+            )
+        return stats
+
+    async def _process_batch(
+        self,
+        batch: List[Document],
+        executor: Optional[Executor],
+        stats: IngestionStats,
+        on_progress: Optional[Callable[[List[Document]], None]],
+    ) -> None:
+        stats.batches += 1
+        texts = [document.page_content for document in batch]
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.span("ingest.embed"):
+                    embeddings = await self._embed(texts, executor)
+                with metrics.span("ingest.write"):
+                    ids = await run_blocking(self._write_batch, batch, embeddings)
+                stats.chunk_ids.update(ids)
+                stats.chunks += len(batch)
+                if on_progress is not None:
+                    on_progress(batch)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error("Embedding batch failed after retries: %s", e)
+                    stats.failed_batches += 1
+                    return
+                logger.warning(
+                    "Embedding batch failed (attempt %d): %s", attempt + 1, e
+                )
+                await asyncio.sleep(self.retry_backoff * 2**attempt)
+
+    async def _embed(
+        self, texts: List[str], executor: Optional[Executor]
+    ) -> List[List[float]]:
+        if executor is None:
+            return await self.embedding_model.aembed_documents(texts)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, self.embedding_model.embed_documents, texts
+        )
+
+    def _write_batch(
+        self, batch: List[Document], embeddings: List[List[float]]
+    ) -> List[str]:
+        if self.user_id is None:
+            ids = [str(uuid.uuid4()) for _ in batch]
+        else:
+            ids = [chunk_id(self.user_id, document) for document in batch]
+            # Repeated text within a file (headers, footers) maps to one id;
+            # Chroma rejects duplicate ids within a single call.
+            unique = {}
+            for i, id_ in enumerate(ids):
+                unique.setdefault(id_, i)
+            if len(unique) < len(ids):
+                keep = sorted(unique.values())
+                ids = [ids[i] for i in keep]
+                batch = [batch[i] for i in keep]
+                embeddings = [embeddings[i] for i in keep]
+        texts = [document.page_content for document in batch]
+        metadatas = [document.metadata for document in batch]
+        self.vector_store._collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            documents=texts,
+            metadatas=metadatas if all(metadatas) else None,
+        )
+        if self.sparse_index is not None:
+            self.sparse_index.add(ids, texts)
+        return ids
@@ -1,24 +1,54 @@
-from typing import Literal, LiteralString
+import functools
+import os
+from typing import Optional
 
-from fastapi import Depends, HTTPException
-from firebase_admin import auth, db
+import chromadb
+from chromadb.api import ClientAPI
+from chromadb.config import Settings as ChromaSettings
+from fastapi import Depends, HTTPException, Request
+from firebase_admin import db
 from langchain.llms.base import BaseLanguageModel
+from langchain.schema import BaseRetriever
 from langchain.schema.embeddings import Embeddings
 from langchain_community.vectorstores import Chroma
-from langchain_huggingface.chat_models import ChatHuggingFace
-from langchain_huggingface.llms import HuggingFacePipeline
-from langchain_ollama.chat_models import ChatOllama
-from langchain_ollama.embeddings import OllamaEmbeddings
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
 
 from qasys.config import ModelProvider, StorageType, settings
+from qasys.core.answer_cache import (
+    AnswerCache,
+    MemoryAnswerCacheBackend,
+    SQLiteAnswerCacheBackend,
+)
+from qasys.core.batching import BatchedEmbeddings, BatchedLLM
+from qasys.core.chunking import TokenChunker
+from qasys.core.conversation import ConversationMemory
+from qasys.core.embedding_cache import CachedEmbeddings
+from qasys.core.inference import (
+    InferenceClient,
+    InferenceServer,
+    RemoteEmbeddings,
+    RemoteLLM,
+)
+from qasys.core.ingestion import IngestionQueue
+from qasys.core.job_store import JobStore
+from qasys.core.manifest import DocumentManifest
+from qasys.core.model_registry import ModelRegistry
+from qasys.core.prompt import PromptBuilder
+from qasys.core.reranker import CrossEncoderReranker, RerankingRetriever
+from qasys.core.retrieval import HybridRetriever
+from qasys.core.sparse_index import SparseIndex
+from qasys.core.tokens import get_token_counter
+from qasys.core.vector_store import IngestionPipeline, VectorStoreManager
+from qasys.utils.auth import SigningKeyCache, TokenVerifier, fetch_certs
+from qasys.utils.blob_cache import CachingStorage
+from qasys.utils import metrics
 from qasys.utils.storage import (
+    AsyncStorage,
     AuthenticatedStorage,
     AWSStorage,
     AzureStorage,
     GCPStorage,
     LocalStorage,
+    Storage,
 )
 
 
@@ -28,67 +58,430 @@ def get_openai_api_key():
     return settings.OPENAI_API_KEY
 
 
-def get_embedding_model() -> Embeddings:
+# Provider integrations are imported inside the factories: each pulls in a
+# large SDK (transformers alone takes seconds) and only one is ever used.
+
+
+def create_embedding_model() -> Embeddings:
     match settings.MODEL_PROVIDER:
         case ModelProvider.OPENAI:
+            from langchain_openai import OpenAIEmbeddings
+
             return OpenAIEmbeddings(
                 model=settings.OPENAI_EMBEDDINGS_MODEL_NAME,
                 openai_api_key=settings.OPENAI_API_KEY,
             )
         case ModelProvider.OLLAMA:
+            from langchain_ollama.embeddings import OllamaEmbeddings
+
             return OllamaEmbeddings(
                 model=settings.OLLAMA_EMBEDDINGS_MODEL_NAME,
             )
         case ModelProvider.HUGGINGFACE:
-            return ChatHuggingFace(model_name=settings.HF_EMBEDDINGS_MODEL_NAME)
+            from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+
+            return BatchedEmbeddings(
+                HuggingFaceEmbeddings(model_name=settings.HF_EMBEDDINGS_MODEL_NAME),
+                max_batch_size=settings.MODEL_BATCH_MAX_SIZE,
+                max_wait_ms=settings.MODEL_BATCH_MAX_WAIT_MS,
+            )
+        case _:
+            raise ValueError(f"Unsupported model provider: {settings.MODEL_PROVIDER}")
+
+
+def get_embedding_model_name() -> str:
+    match settings.MODEL_PROVIDER:
+        case ModelProvider.OPENAI:
+            return settings.OPENAI_EMBEDDINGS_MODEL_NAME
+        case ModelProvider.OLLAMA:
+            return settings.OLLAMA_EMBEDDINGS_MODEL_NAME
+        case ModelProvider.HUGGINGFACE:
+            return settings.HF_EMBEDDINGS_MODEL_NAME
         case _:
             raise ValueError(f"Unsupported model provider: {settings.MODEL_PROVIDER}")
 
 
-def get_storage():
+def create_cached_embedding_model(
+    embedding_model: Optional[Embeddings] = None,
+) -> Embeddings:
+    embedding_model = embedding_model or create_embedding_model()
+    if not settings.EMBEDDING_CACHE_ENABLED:
+        return embedding_model
+    return CachedEmbeddings(
+        embedding_model,
+        model_name=f"{settings.MODEL_PROVIDER.value}:{get_embedding_model_name()}",
+        path=settings.EMBEDDING_CACHE_PATH,
+        max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+    )
+
+
+def create_cloud_storage() -> Storage:
     match settings.STORAGE_TYPE:
-        case StorageType.LOCAL:
-            return LocalStorage(settings.PDF_STORAGE_PATH)
         case StorageType.GCP:
-            return GCPStorage(settings.STORAGE_BUCKET)
+            return GCPStorage(
+                settings.STORAGE_BUCKET,
+                chunk_size=settings.STORAGE_MULTIPART_CHUNK_SIZE,
+                spool_max_bytes=settings.STORAGE_SPOOL_MAX_BYTES,
+            )
         case StorageType.AWS:
-            return AWSStorage(settings.STORAGE_BUCKET)
+            return AWSStorage(
+                settings.STORAGE_BUCKET,
+                endpoint_url=settings.S3_ENDPOINT_URL,
+                max_pool_connections=settings.STORAGE_MAX_POOL_CONNECTIONS,
+                multipart_threshold=settings.STORAGE_MULTIPART_THRESHOLD,
+                multipart_chunk_size=settings.STORAGE_MULTIPART_CHUNK_SIZE,
+                transfer_concurrency=settings.STORAGE_TRANSFER_CONCURRENCY,
+                spool_max_bytes=settings.STORAGE_SPOOL_MAX_BYTES,
+            )
         case StorageType.AZURE:
             return AzureStorage(
-                settings.AZURE_CONNECTION_STRING, settings.STORAGE_BUCKET
+                settings.AZURE_CONNECTION_STRING,
+                settings.STORAGE_BUCKET,
+                transfer_concurrency=settings.STORAGE_TRANSFER_CONCURRENCY,
+                spool_max_bytes=settings.STORAGE_SPOOL_MAX_BYTES,
             )
         case _:
             raise ValueError(f"Unsupported storage type: {settings.STORAGE_TYPE}")
 
 
-def get_llm() -> BaseLanguageModel:
+@functools.lru_cache(maxsize=1)
+def get_storage() -> Storage:
+    # One backend per process so cloud clients and their connection pools
+    # are reused across requests
+    if settings.STORAGE_TYPE == StorageType.LOCAL:
+        return LocalStorage(settings.PDF_STORAGE_PATH)
+    storage = create_cloud_storage()
+    if not settings.STORAGE_CACHE_ENABLED:
+        return storage
+    return CachingStorage(
+        storage,
+        settings.STORAGE_CACHE_PATH,
+        max_bytes=settings.STORAGE_CACHE_MAX_BYTES,
+        validate_seconds=settings.STORAGE_CACHE_VALIDATE_SECONDS,
+    )
+
+
+def _encode_tokens(text: str) -> list:
+    # LangChain otherwise falls back to downloading a GPT-2 tokenizer whenever
+    # a chain (e.g. map_reduce) measures prompt length
+    return get_token_counter().encode(text)
+
+
+def create_llm() -> BaseLanguageModel:
     match settings.MODEL_PROVIDER:
         case ModelProvider.OPENAI:
+            from langchain_openai import ChatOpenAI
+
             return ChatOpenAI(
                 model=settings.OPENAI_LLM_MODEL_NAME,
                 api_key=settings.OPENAI_API_KEY,
+                custom_get_token_ids=_encode_tokens,
             )
         case ModelProvider.OLLAMA:
+            from langchain_ollama.chat_models import ChatOllama
+
             return ChatOllama(
                 model=settings.OLLAMA_LLM_MODEL_NAME,
+                custom_get_token_ids=_encode_tokens,
             )
         case ModelProvider.HUGGINGFACE:
+            from langchain_huggingface.llms import HuggingFacePipeline
+            from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+
             tokenizer = AutoTokenizer.from_pretrained(settings.HF_LLM_MODEL_NAME)
             model = AutoModelForCausalLM.from_pretrained(settings.HF_LLM_MODEL_NAME)
+            # Batched generation pads prompts; decoder-only models pad left
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            tokenizer.padding_side = "left"
             pipe = pipeline("text-generation", model=model, tokenizer=tokenizer)
-            return HuggingFacePipeline(pipeline=pipe)
+            return BatchedLLM.wrap(
+                HuggingFacePipeline(pipeline=pipe),
+                max_batch_size=settings.MODEL_BATCH_MAX_SIZE,
+                max_wait_ms=settings.MODEL_BATCH_MAX_WAIT_MS,
+                custom_get_token_ids=_encode_tokens,
+            )
+        case _:
+            raise ValueError(f"Unsupported model provider: {settings.MODEL_PROVIDER}")
+
+
+def get_llm_model_name() -> str:
+    match settings.MODEL_PROVIDER:
+        case ModelProvider.OPENAI:
+            return settings.OPENAI_LLM_MODEL_NAME
+        case ModelProvider.OLLAMA:
+            return settings.OLLAMA_LLM_MODEL_NAME
+        case ModelProvider.HUGGINGFACE:
+            return settings.HF_LLM_MODEL_NAME
         case _:
             raise ValueError(f"Unsupported model provider: {settings.MODEL_PROVIDER}")
 
 
-def get_vector_store(embedding_model=Depends(get_embedding_model)) -> Chroma:
-    return Chroma(embedding_function=embedding_model)
+def get_prompt_builder() -> PromptBuilder:
+    return PromptBuilder(
+        count_tokens=get_token_counter().count,
+        max_tokens=settings.PROMPT_TOKEN_BUDGETS.get(
+            get_llm_model_name(), settings.PROMPT_MAX_TOKENS
+        ),
+        answer_tokens=settings.PROMPT_ANSWER_TOKENS,
+    )
+
+
+def create_reranker() -> CrossEncoderReranker:
+    return CrossEncoderReranker(
+        settings.RERANK_MODEL_NAME, batch_size=settings.RERANK_BATCH_SIZE
+    )
+
+
+def get_inference_authkey() -> bytes:
+    if settings.INFERENCE_AUTHKEY is None:
+        raise ValueError("INFERENCE_AUTHKEY must be set to use the inference server")
+    return settings.INFERENCE_AUTHKEY.get_secret_value().encode()
+
+
+def create_inference_server() -> InferenceServer:
+    # Runs the configured local models; the embedding cache stays in workers
+    registry = ModelRegistry()
+    registry.register("llm", create_llm)
+    registry.register("embeddings", create_embedding_model)
+    return InferenceServer(
+        registry, settings.INFERENCE_SOCKET_PATH, get_inference_authkey()
+    )
+
+
+def create_inference_client() -> InferenceClient:
+    return InferenceClient(
+        settings.INFERENCE_SOCKET_PATH,
+        get_inference_authkey(),
+        max_connections=settings.INFERENCE_CONNECTIONS,
+    )
+
+
+def create_model_registry() -> ModelRegistry:
+    registry = ModelRegistry()
+    if settings.INFERENCE_SERVER_ENABLED:
+        registry.register("inference", create_inference_client)
+        registry.register(
+            "llm",
+            lambda: RemoteLLM(
+                client=registry.get("inference"),
+                custom_get_token_ids=_encode_tokens,
+            ),
+        )
+        registry.register(
+            "embeddings",
+            lambda: create_cached_embedding_model(
+                RemoteEmbeddings(registry.get("inference"))
+            ),
+        )
+    else:
+        registry.register("llm", create_llm)
+        registry.register("embeddings", create_cached_embedding_model)
+    if settings.RERANK_ENABLED:
+        registry.register("reranker", create_reranker)
+    return registry
+
+
+def get_model_registry(request: Request) -> ModelRegistry:
+    return request.app.state.model_registry
+
+
+def get_embedding_model(
+    registry: ModelRegistry = Depends(get_model_registry),
+) -> Embeddings:
+    return registry.get("embeddings")
+
+
+def get_llm(registry: ModelRegistry = Depends(get_model_registry)) -> BaseLanguageModel:
+    return registry.get("llm")
+
+
+def create_vector_db_client() -> Optional[ClientAPI]:
+    # None selects the embedded client over VECTOR_DB_PATH
+    if settings.VECTOR_DB_SERVER_HOST is None:
+        return None
+    return chromadb.HttpClient(
+        host=settings.VECTOR_DB_SERVER_HOST,
+        port=settings.VECTOR_DB_SERVER_PORT,
+        settings=ChromaSettings(anonymized_telemetry=False),
+    )
+
+
+def create_vector_store_manager(registry: ModelRegistry) -> VectorStoreManager:
+    return VectorStoreManager(
+        settings.VECTOR_DB_PATH,
+        embedding_provider=lambda: registry.get("embeddings"),
+        max_open_collections=settings.VECTOR_STORE_CACHE_SIZE,
+        idle_seconds=settings.VECTOR_STORE_IDLE_SECONDS,
+        sparse_directory=(
+            os.path.join(settings.VECTOR_DB_PATH, "sparse")
+            if settings.HYBRID_SEARCH_ENABLED
+            else None
+        ),
+        client=create_vector_db_client(),
+    )
+
+
+def get_vector_store_manager(request: Request) -> VectorStoreManager:
+    return request.app.state.vector_store_manager
+
+
+def get_vector_store(
+    request: Request,
+    manager: VectorStoreManager = Depends(get_vector_store_manager),
+) -> Chroma:
+    return manager.get_user_store(request.state.user_id)
+
+
+def get_retriever(
+    request: Request,
+    manager: VectorStoreManager = Depends(get_vector_store_manager),
+    vector_store: Chroma = Depends(get_vector_store),
+    registry: ModelRegistry = Depends(get_model_registry),
+) -> BaseRetriever:
+    # With re-ranking on, over-fetch candidates and let the cross-encoder pick
+    k = settings.RERANK_CANDIDATES if settings.RERANK_ENABLED else settings.RETRIEVAL_K
+    if settings.HYBRID_SEARCH_ENABLED:
+        retriever = HybridRetriever(
+            vector_store=vector_store,
+            sparse_index=manager.get_sparse_index(request.state.user_id),
+            k=k,
+            dense_k=max(settings.RETRIEVAL_DENSE_K, k),
+            sparse_k=max(settings.RETRIEVAL_SPARSE_K, k),
+            rrf_k=settings.RETRIEVAL_RRF_K,
+        )
+    else:
+        retriever = vector_store.as_retriever(search_kwargs={"k": k})
+    if not settings.RERANK_ENABLED:
+        return retriever
+    return RerankingRetriever(
+        base_retriever=retriever,
+        reranker=registry.get("reranker"),
+        top_n=settings.RERANK_TOP_N,
+    )
+
+
+def create_document_manifest() -> DocumentManifest:
+    return DocumentManifest(
+        settings.DOCUMENT_MANIFEST_PATH
+        or os.path.join(settings.VECTOR_DB_PATH, "manifest.sqlite")
+    )
+
+
+def get_document_manifest(request: Request) -> DocumentManifest:
+    return request.app.state.document_manifest
+
+
+def create_ingestion_pipeline(
+    vector_store: Chroma,
+    embedding_model: Embeddings,
+    sparse_index: SparseIndex | None = None,
+    user_id: str | None = None,
+) -> IngestionPipeline:
+    return IngestionPipeline(
+        vector_store,
+        embedding_model,
+        batch_size=settings.EMBEDDING_BATCH_SIZE,
+        max_concurrency=settings.EMBEDDING_MAX_CONCURRENCY,
+        max_retries=settings.EMBEDDING_MAX_RETRIES,
+        local=settings.MODEL_PROVIDER == ModelProvider.HUGGINGFACE,
+        sparse_index=sparse_index,
+        user_id=user_id,
+    )
 
 
-async def verify_token(token: str):
+def create_text_splitter() -> TokenChunker:
+    return TokenChunker(
+        chunk_size=settings.CHUNK_SIZE_TOKENS,
+        chunk_overlap=settings.CHUNK_OVERLAP_TOKENS,
+        # Resolved on first use so the tokenizer is not loaded at import time
+        length_function=lambda text: get_token_counter().count(text),
+    )
+
+
+def create_answer_cache() -> AnswerCache | None:
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    match settings.ANSWER_CACHE_BACKEND:
+        case "memory":
+            backend = MemoryAnswerCacheBackend(settings.ANSWER_CACHE_MAX_ENTRIES)
+        case "sqlite":
+            backend = SQLiteAnswerCacheBackend(
+                settings.ANSWER_CACHE_PATH, settings.ANSWER_CACHE_MAX_ENTRIES
+            )
+        case _:
+            raise ValueError(
+                f"Unsupported answer cache backend: {settings.ANSWER_CACHE_BACKEND}"
+            )
+    return AnswerCache(backend, ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS)
+
+
+def get_answer_cache(request: Request) -> AnswerCache | None:
+    return request.app.state.answer_cache
+
+
+def create_job_store() -> JobStore:
+    return JobStore(
+        settings.INGESTION_JOB_STORE_PATH
+        or os.path.join(settings.VECTOR_DB_PATH, "jobs.sqlite")
+    )
+
+
+def create_ingestion_queue(
+    registry: ModelRegistry,
+    vector_store_manager: VectorStoreManager,
+    answer_cache: AnswerCache | None = None,
+    manifest: DocumentManifest | None = None,
+    store: JobStore | None = None,
+) -> IngestionQueue:
+    return IngestionQueue(
+        pipeline_factory=lambda user_id: create_ingestion_pipeline(
+            vector_store_manager.get_user_store(user_id),
+            registry.get("embeddings"),
+            (
+                vector_store_manager.get_sparse_index(user_id)
+                if settings.HYBRID_SEARCH_ENABLED
+                else None
+            ),
+            user_id=user_id,
+        ),
+        storage_factory=get_authenticated_storage,
+        text_splitter=create_text_splitter(),
+        parse_workers=settings.PDF_PARSE_WORKERS,
+        parallel_min_pages=settings.PDF_PARALLEL_MIN_PAGES,
+        pages_per_task=settings.PDF_PAGES_PER_TASK,
+        max_concurrent_jobs=settings.INGESTION_MAX_CONCURRENT_JOBS,
+        max_jobs_per_user=settings.INGESTION_MAX_JOBS_PER_USER,
+        max_bulk_jobs_per_user=settings.BULK_UPLOAD_MAX_JOBS_PER_USER,
+        retention_seconds=settings.INGESTION_JOB_RETENTION_SECONDS,
+        on_corpus_changed=answer_cache.invalidate_user if answer_cache else None,
+        manifest=manifest,
+        delete_chunks=vector_store_manager.delete_chunks,
+        store=store,
+    )
+
+
+def get_ingestion_queue(request: Request) -> IngestionQueue:
+    return request.app.state.ingestion_queue
+
+
+def create_token_verifier() -> TokenVerifier:
+    keys = SigningKeyCache(
+        fetch=functools.partial(fetch_certs, settings.FIREBASE_CERTS_URL)
+    )
+    return TokenVerifier(
+        settings.PROJECT_ID,
+        keys,
+        issuer=settings.FIREBASE_TOKEN_ISSUER,
+        cache_size=settings.AUTH_TOKEN_CACHE_SIZE,
+    )
+
+
+async def verify_token(token: str, verifier: TokenVerifier):
     try:
         split_token = token.split("Bearer ")[-1]
-        decoded_token = auth.verify_id_token(id_token=split_token)
+        with metrics.span("auth.verify_token"):
+            decoded_token = await verifier.verify(split_token)
         return decoded_token["uid"]
     except Exception as e:
         raise HTTPException(
@@ -96,17 +489,33 @@ async def verify_token(token: str):
         )
 
 
-async def get_user_context(user_id: str) -> LiteralString | Literal[""]:
-    if not user_id:
-        return ""
-    try:
-        ref = db.reference(settings.FIREBASE_MESSAGES_PATH.format(uid=user_id))
-        messages = ref.get()
-        return "\n".join(messages) if messages else ""
-    except Exception as e:
-        return ""
+def create_conversation_memory(registry: ModelRegistry) -> ConversationMemory:
+    return ConversationMemory(
+        db.reference,
+        settings.FIREBASE_MESSAGES_PATH,
+        summary_path=settings.CONVERSATION_SUMMARY_PATH,
+        count_tokens=lambda text: get_token_counter().count(text),
+        llm_provider=(
+            (lambda: registry.get("llm"))
+            if settings.CONVERSATION_SUMMARY_ENABLED
+            else None
+        ),
+        max_turns=settings.CONVERSATION_MAX_TURNS,
+        max_tokens=settings.CONVERSATION_MAX_TOKENS,
+        summary_max_tokens=settings.CONVERSATION_SUMMARY_MAX_TOKENS,
+        refresh_seconds=settings.CONVERSATION_REFRESH_SECONDS,
+        cache_size=settings.CONVERSATION_CACHE_SIZE,
+    )
+
+
+def get_conversation_memory(request: Request) -> ConversationMemory:
+    return request.app.state.conversation_memory
 
 
 def get_authenticated_storage(user_id):
     base_storage = get_storage()
     return AuthenticatedStorage(base_storage, user_id)
+
+
+def get_async_storage(request: Request) -> AsyncStorage:
+    return AsyncStorage(get_authenticated_storage(request.state.user_id))
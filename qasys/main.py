@@ -1,23 +1,85 @@
+import logging
+import multiprocessing
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
+from typing import Any, List
+
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware import Middleware
 from fastapi.responses import JSONResponse
 from typing import Annotated
-from firebase_admin import credentials, initialize_app, auth
+from firebase_admin import credentials, get_app, initialize_app, auth
+from pydantic import SecretStr
 
 from qasys.config import settings
-from qasys.dependencies import verify_token
+from qasys.dependencies import (
+    create_answer_cache,
+    create_conversation_memory,
+    create_document_manifest,
+    create_inference_client,
+    create_inference_server,
+    create_ingestion_queue,
+    create_job_store,
+    create_model_registry,
+    create_token_verifier,
+    create_vector_db_client,
+    create_vector_store_manager,
+    verify_token,
+)
 from qasys.routes import pdf, qa, user
+from qasys.routes.metrics import router as metrics_router
+from qasys.utils import metrics
 
+logger = logging.getLogger(__name__)
 
-def main():
-    app = FastAPI()
 
-    cred = credentials.Certificate(
-        settings.FIREBASE_CREDENTIALS_FILENAME.get_secret_value()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.token_verifier = create_token_verifier()
+    app.state.token_verifier.keys.start()
+    app.state.model_registry = create_model_registry()
+    app.state.vector_store_manager = create_vector_store_manager(
+        app.state.model_registry
+    )
+    app.state.conversation_memory = create_conversation_memory(app.state.model_registry)
+    app.state.answer_cache = create_answer_cache()
+    app.state.document_manifest = create_document_manifest()
+    app.state.job_store = create_job_store()
+    app.state.ingestion_queue = create_ingestion_queue(
+        app.state.model_registry,
+        app.state.vector_store_manager,
+        app.state.answer_cache,
+        app.state.document_manifest,
+        app.state.job_store,
     )
-    initialize_app(cred, options={"projectId": settings.PROJECT_ID})
+    if settings.WARM_UP_MODELS:
+        await app.state.model_registry.awarm_up()
+    yield
+    await app.state.ingestion_queue.close()
+    app.state.job_store.close()
+    app.state.document_manifest.close()
+    await app.state.token_verifier.keys.close()
+    await app.state.conversation_memory.close()
+    if app.state.answer_cache is not None:
+        app.state.answer_cache.close()
+    app.state.model_registry.close()
+
+
+def create_app() -> FastAPI:
+    """Build the application; uvicorn calls this once in every worker process"""
+    app = FastAPI(lifespan=lifespan)
+
+    try:
+        get_app()
+    except ValueError:
+        cred = credentials.Certificate(
+            settings.FIREBASE_CREDENTIALS_FILENAME.get_secret_value()
+        )
+        initialize_app(cred, options={"projectId": settings.PROJECT_ID})
 
     app.add_middleware(
         CORSMiddleware,
@@ -33,7 +95,7 @@ def main():
         if auth_header and auth_header.startswith("Bearer "):
             token = auth_header.split("Bearer ")[1]
             try:
-                user_id = await verify_token(token)
+                user_id = await verify_token(token, request.app.state.token_verifier)
                 request.state.user_id = user_id
             except HTTPException as exc:
                 return JSONResponse(
@@ -42,8 +104,136 @@ def main():
         response = await call_next(request)
         return response
 
+    if metrics.enabled():
+        # Added last so it is outermost and also times authentication
+        @app.middleware("http")
+        async def record_timings(request: Request, call_next):
+            token = metrics.start_request()
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await call_next(request)
+                status = response.status_code
+                timings = metrics.request_timings()
+                if settings.METRICS_DEBUG_TIMINGS and timings:
+                    response.headers["Server-Timing"] = metrics.server_timing(timings)
+                return response
+            finally:
+                route = request.scope.get("route")
+                metrics.request_seconds.observe(
+                    time.perf_counter() - start,
+                    request.method,
+                    getattr(route, "path", "unmatched"),
+                    str(status),
+                )
+                metrics.end_request(token)
+
+        app.include_router(metrics_router, tags=["metrics"])
+
     app.include_router(pdf.router, prefix="/pdf", tags=["pdf"])
     app.include_router(qa.router, prefix="/qa", tags=["qa"])
     app.include_router(user.router, prefix="/user", tags=["user"])
+    return app
+
+
+def _share_setting(name: str, value: Any) -> None:
+    # Workers are spawned processes and read their settings from the
+    # environment; this process keeps using the settings object
+    os.environ[name] = (
+        value.get_secret_value() if isinstance(value, SecretStr) else str(value)
+    )
+    setattr(settings, name, value)
+
+
+def _run_inference_server() -> None:
+    server = create_inference_server()
+    server.registry.warm_up()
+    server.serve_forever()
+
+
+def _run_vector_db_server(path: str, host: str, port: int) -> None:
+    os.environ["IS_PERSISTENT"] = "TRUE"
+    os.environ["PERSIST_DIRECTORY"] = path
+    os.environ["ANONYMIZED_TELEMETRY"] = "False"
+    uvicorn.run("chromadb.app:app", host=host, port=port, log_level="warning")
+
+
+def _wait_for_vector_db(timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            create_vector_db_client().heartbeat()
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise TimeoutError("Vector DB server did not start")
+            time.sleep(0.2)
+
+
+def start_shared_services() -> List[multiprocessing.Process]:
+    """Start the processes that all workers share, before the workers.
+
+    Local models are loaded once in the inference server (if enabled), and
+    with more than one worker the Chroma index is served by a single process,
+    since an embedded Chroma client does not see other processes' writes.
+    Answers are then cached in SQLite, which all workers share.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    if settings.INFERENCE_SERVER_ENABLED:
+        if settings.INFERENCE_AUTHKEY is None:
+            _share_setting("INFERENCE_AUTHKEY", SecretStr(secrets.token_hex(32)))
+        process = context.Process(
+            target=_run_inference_server, name="qasys-inference", daemon=True
+        )
+        process.start()
+        processes.append(process)
+        client = create_inference_client()
+        try:
+            client.wait_ready(settings.INFERENCE_STARTUP_TIMEOUT)
+        finally:
+            client.close()
+        logger.info("Inference server ready")
+    if (
+        settings.WORKERS > 1
+        and settings.ANSWER_CACHE_ENABLED
+        and settings.ANSWER_CACHE_BACKEND == "memory"
+    ):
+        # Each worker would keep its own cache and never see the corpus
+        # changes, and so the invalidations, of the other workers
+        logger.warning("Using the sqlite answer cache, shared by all workers")
+        _share_setting("ANSWER_CACHE_BACKEND", "sqlite")
+    if settings.WORKERS > 1 and settings.VECTOR_DB_SERVER_HOST is None:
+        _share_setting("VECTOR_DB_SERVER_HOST", "127.0.0.1")
+        process = context.Process(
+            target=_run_vector_db_server,
+            args=(
+                settings.VECTOR_DB_PATH,
+                settings.VECTOR_DB_SERVER_HOST,
+                settings.VECTOR_DB_SERVER_PORT,
+            ),
+            name="qasys-vector-db",
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+        _wait_for_vector_db()
+        logger.info("Vector DB server ready")
+    return processes
+
 
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+def main(app: str = "qasys.main:create_app"):
+    """Start the shared services, then ``settings.WORKERS`` workers of ``app``"""
+    processes = start_shared_services()
+    try:
+        uvicorn.run(
+            app,
+            factory=True,
+            host=settings.HOST,
+            port=settings.PORT,
+            workers=settings.WORKERS,
+        )
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join(timeout=10)
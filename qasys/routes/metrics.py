@@ -0,0 +1,85 @@
+from typing import Any, Iterator, List
+
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+from qasys.dependencies import get_storage
+from qasys.utils import metrics
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _cache_samples(name: str, cache: Any) -> Iterator[metrics.Sample]:
+    if cache is None or not hasattr(cache, "hits"):
+        return
+    labels = {"cache": name}
+    yield ("qasys_cache_hits_total", "Cache hits", "counter", labels, cache.hits)
+    yield ("qasys_cache_misses_total", "Cache misses", "counter", labels, cache.misses)
+
+
+def _samples(request: Request) -> List[metrics.Sample]:
+    # Counters kept by the caches and batchers themselves, read at scrape time
+    state = request.app.state
+    registry = state.model_registry
+    samples = [
+        *_cache_samples("token", state.token_verifier),
+        *_cache_samples("answer", state.answer_cache),
+    ]
+    if registry.is_loaded("embeddings"):
+        samples.extend(_cache_samples("embedding", registry.get("embeddings")))
+    if get_storage.cache_info().currsize:
+        samples.extend(_cache_samples("storage", get_storage()))
+    for stats in registry.stats():
+        labels = {"model": stats["name"]}
+        if stats["load_seconds"] is not None:
+            samples.append(
+                (
+                    "qasys_model_load_seconds",
+                    "Time taken to load a model",
+                    "gauge",
+                    labels,
+                    stats["load_seconds"],
+                )
+            )
+        if stats["memory_bytes"] is not None:
+            samples.append(
+                (
+                    "qasys_model_memory_bytes",
+                    "Memory of a model's parameters, or growth of the process on load",
+                    "gauge",
+                    labels,
+                    stats["memory_bytes"],
+                )
+            )
+        batching = stats["batching"]
+        if batching is None:
+            continue
+        samples.append(
+            (
+                "qasys_batch_items_total",
+                "Inputs run through a micro-batched model",
+                "counter",
+                labels,
+                batching["items"],
+            )
+        )
+        samples.append(
+            (
+                "qasys_batches_total",
+                "Micro-batched model calls",
+                "counter",
+                labels,
+                batching["batches"],
+            )
+        )
+    return samples
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    """Metrics of this worker process in the Prometheus text format"""
+    return PlainTextResponse(
+        metrics.registry.render(_samples(request)), media_type=CONTENT_TYPE
+    )
@@ -1,35 +1,144 @@
+import logging
+from typing import List
+
 from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile
 from fastapi.responses import JSONResponse
-from langchain.schema.vectorstore import VectorStore
 
-from qasys.core.pdf_processor import process_pdf
-from qasys.dependencies import get_authenticated_storage, get_storage, get_vector_store
-from qasys.utils.storage import AuthenticatedStorage
+from qasys.config import settings
+from qasys.core.bulk_upload import BulkUpload, BulkUploadError, upload_filename
+from qasys.core.ingestion import IngestionQueue, TooManyJobsError
+from qasys.core.manifest import DocumentManifest
+from qasys.dependencies import get_document_manifest, get_ingestion_queue
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
-@router.post("/upload")
+@router.post("/upload", status_code=202)
 async def upload_pdf(
     file: UploadFile,
     request: Request,
-    vector_store: VectorStore = Depends(get_vector_store),
+    queue: IngestionQueue = Depends(get_ingestion_queue),
 ):
+    filename = upload_filename(file.filename)
+    if filename is None:
+        raise HTTPException(status_code=400, detail="Invalid filename")
     try:
         user_id = request.state.user_id
-        file_content = file.file
-        basic_storage = get_storage()
-        storage = AuthenticatedStorage(basic_storage, user_id)
-        file_path = storage.save_file(file.filename, file_content)
-        file_binary = storage.get_file(file_path)
-        pages = process_pdf(file_binary)
-        vector_store.add_documents(pages)
-        storage.delete_file(user_id, file_path)
-        return JSONResponse(
-            {
-                "message": "PDF processed and added to vector store successfully",
-            }
+        file_content = await file.read()
+        job = await queue.submit(user_id, filename, file_content)
+    except TooManyJobsError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception:
+        logger.exception("Upload of %s failed", filename)
+        raise HTTPException(status_code=500, detail="Upload failed")
+    return JSONResponse(
+        {
+            "message": "PDF accepted for processing",
+            "job_id": job.id,
+            "status_url": f"/pdf/jobs/{job.id}",
+        },
+        status_code=202,
+    )
+
+
+@router.post("/upload/bulk", status_code=202)
+async def upload_pdfs_bulk(
+    files: List[UploadFile],
+    request: Request,
+    queue: IngestionQueue = Depends(get_ingestion_queue),
+):
+    """Queue many PDFs as one job; each upload is a PDF or a ZIP of PDFs.
+
+    The job status lists the result of every file. Entries that are not
+    PDFs, encrypted or repeat an earlier filename are skipped and reported.
+    """
+    user_id = request.state.user_id
+    upload = BulkUpload(settings.BULK_UPLOAD_MAX_FILES, settings.BULK_UPLOAD_MAX_BYTES)
+    try:
+        for file in files:
+            await run_blocking(upload.add, file.filename, file.file)
+    except BulkUploadError as e:
+        upload.close()
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        upload.close()
+        logger.exception("Unreadable bulk upload")
+        raise HTTPException(status_code=400, detail=f"Unreadable upload: {e}")
+    if not upload.sources:
+        upload.close()
+        raise HTTPException(status_code=400, detail="No PDF files in the upload")
+
+    try:
+        job = await queue.submit_bulk(
+            user_id, upload.sources, skipped=upload.skipped, cleanup=upload.close
         )
+    except TooManyJobsError as e:
+        upload.close()
+        raise HTTPException(status_code=429, detail=str(e))
+    return JSONResponse(
+        {
+            "message": f"{len(upload.sources)} PDFs accepted for processing",
+            "job_id": job.id,
+            "status_url": f"/pdf/jobs/{job.id}",
+            "files": [source.filename for source in upload.sources],
+            "skipped": upload.skipped,
+        },
+        status_code=202,
+    )
+
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(
+    job_id: str,
+    request: Request,
+    queue: IngestionQueue = Depends(get_ingestion_queue),
+):
+    status = await queue.status(job_id, request.state.user_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+
+@router.get("/files")
+async def list_indexed_files(
+    request: Request,
+    manifest: DocumentManifest = Depends(get_document_manifest),
+):
+    files = await run_blocking(manifest.files, request.state.user_id)
+    return {"files": files}
+
+
+@router.post("/files/{filename}/reindex", status_code=202)
+async def reindex_file(
+    filename: str,
+    request: Request,
+    queue: IngestionQueue = Depends(get_ingestion_queue),
+):
+    job = await queue.submit(request.state.user_id, filename)
+    return JSONResponse(
+        {
+            "message": "PDF queued for re-indexing",
+            "job_id": job.id,
+            "status_url": f"/pdf/jobs/{job.id}",
+        },
+        status_code=202,
+    )
+
+
+@router.delete("/files/{filename}")
+async def delete_file(
+    filename: str,
+    request: Request,
+    queue: IngestionQueue = Depends(get_ingestion_queue),
+):
+    try:
+        result = await queue.delete_file(request.state.user_id, filename)
     except Exception as e:
-        print(e)
+        logger.exception("Failed to delete %s", filename)
         raise HTTPException(status_code=500, detail=str(e))
+    if not result["chunks_removed"] and not result["file_deleted"]:
+        raise HTTPException(status_code=404, detail="File not found")
+    return result
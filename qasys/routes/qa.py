@@ -1,16 +1,43 @@
+import asyncio
+import json
+import logging
+import time
+
 from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from langchain.schema import BaseRetriever
 from langchain.schema.language_model import BaseLanguageModel
 from pydantic import BaseModel
 
-from qasys.core import vector_store
-from qasys.core.qa_system import create_qa_system
-from qasys.dependencies import get_llm, get_user_context, get_vector_store
+from qasys.config import settings
+from qasys.core.answer_cache import AnswerCache
+from qasys.core.conversation import ConversationMemory
+from qasys.core.prompt import PromptBuilder
+from qasys.core.qa_system import ChainType, aanswer
+from qasys.dependencies import (
+    get_answer_cache,
+    get_conversation_memory,
+    get_llm,
+    get_llm_model_name,
+    get_prompt_builder,
+    get_retriever,
+)
+from qasys.utils import metrics
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
 class Query(BaseModel):
     question: str
+    # Streaming always uses the budgeted "stuff" prompt
+    chain_type: ChainType = "stuff"
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 @router.post("/ask")
@@ -18,15 +45,157 @@ async def ask_question(
     query: Query,
     request: Request,
     llm: BaseLanguageModel = Depends(get_llm),
-    vector_store: vector_store.Chroma = Depends(get_vector_store),
+    retriever: BaseRetriever = Depends(get_retriever),
+    answer_cache: AnswerCache | None = Depends(get_answer_cache),
+    memory: ConversationMemory = Depends(get_conversation_memory),
+    prompt_builder: PromptBuilder = Depends(get_prompt_builder),
 ):
     try:
-        qa_system = create_qa_system(vector_store, llm)
         user_id = request.state.user_id
-        user_context = await get_user_context(user_id)
+        if answer_cache is not None:
+            cache_key = await run_blocking(
+                answer_cache.key,
+                user_id,
+                query.question,
+                f"{get_llm_model_name()}:{query.chain_type}",
+            )
+            with metrics.span("answer_cache.lookup"):
+                cached = await run_blocking(answer_cache.get, cache_key)
+            if cached is not None:
+                return {"answer": cached, "cached": True}
+
+        user_context = await memory.context(user_id)
         context = f"Previous context: {user_context}\n\nQuestion: {query.question}"
-        response = qa_system.invoke(context)
-        return {"answer": response}
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=500, detail=str(e))
+        # The conversation only goes into the prompt; searched with the
+        # question, keyword and vector search match what is being asked
+        with metrics.span("retrieval"):
+            documents = await retriever.ainvoke(query.question)
+        result = await aanswer(
+            llm,
+            context,
+            documents,
+            prompt_builder,
+            chain_type=query.chain_type,
+            relevance_query=query.question,
+        )
+        logger.info(
+            "Answered with %s chain, prompt tokens: %s",
+            query.chain_type,
+            result.prompt_tokens,
+        )
+        response = {"query": context, "result": result.answer}
+        if answer_cache is not None:
+            await run_blocking(answer_cache.set, cache_key, response)
+        if settings.CONVERSATION_RECORD_TURNS:
+            await memory.add_turn(user_id, query.question, result.answer)
+        body = {
+            "answer": response,
+            "cached": False,
+            "prompt_tokens": result.prompt_tokens,
+        }
+        if settings.METRICS_DEBUG_TIMINGS:
+            body["timings"] = metrics.request_timings()
+        return body
+    except Exception:
+        logger.exception("Answering failed")
+        raise HTTPException(status_code=500, detail="Answering failed")
+
+
+@router.post("/ask/stream")
+async def ask_question_stream(
+    query: Query,
+    request: Request,
+    llm: BaseLanguageModel = Depends(get_llm),
+    retriever: BaseRetriever = Depends(get_retriever),
+    answer_cache: AnswerCache | None = Depends(get_answer_cache),
+    memory: ConversationMemory = Depends(get_conversation_memory),
+    prompt_builder: PromptBuilder = Depends(get_prompt_builder),
+):
+    """Stream the answer as Server-Sent Events.
+
+    Emits one ``sources`` event with the retrieved chunks, a ``token`` event
+    per generated token and a final ``done`` event with server-side timings.
+    If the client disconnects, Starlette cancels this generator, which closes
+    the LLM stream and stops generation.
+    """
+    user_id = request.state.user_id
+    cache_key = None
+    if answer_cache is not None:
+        cache_key = await run_blocking(
+            answer_cache.key, user_id, query.question, f"{get_llm_model_name()}:stuff"
+        )
+
+    async def events():
+        start = time.perf_counter()
+        if cache_key is not None:
+            with metrics.span("answer_cache.lookup"):
+                cached = await run_blocking(answer_cache.get, cache_key)
+            if cached is not None:
+                yield _sse("token", {"text": cached["result"]})
+                yield _sse("done", {"cached": True})
+                return
+
+        try:
+            user_context = await memory.context(user_id)
+            context = f"Previous context: {user_context}\n\nQuestion: {query.question}"
+            with metrics.span("retrieval"):
+                documents = await retriever.ainvoke(query.question)
+            with metrics.span("prompt.build"):
+                assembled = await run_blocking(
+                    prompt_builder.build, llm, context, documents, query.question
+                )
+            metrics.count_tokens("prompt", assembled.tokens)
+            documents = assembled.documents
+            yield _sse(
+                "sources",
+                [
+                    {"content": document.page_content, "metadata": document.metadata}
+                    for document in documents
+                ],
+            )
+
+            first_token_ms = None
+            parts = []
+            generate_start = time.perf_counter()
+            async for chunk in llm.astream(assembled.prompt):
+                token = getattr(chunk, "content", chunk)
+                if not token:
+                    continue
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                    logger.info("Time to first token: %.0fms", first_token_ms)
+                parts.append(token)
+                yield _sse("token", {"text": token})
+            # Includes the time spent sending each token to the client
+            metrics.observe("llm.generate", time.perf_counter() - generate_start)
+        except asyncio.CancelledError:
+            logger.info("Client disconnected, generation cancelled")
+            raise
+        except Exception as e:
+            logger.exception("Streaming answer failed")
+            yield _sse("error", {"detail": str(e)})
+            return
+
+        answer = "".join(parts)
+        if cache_key is not None:
+            await run_blocking(
+                answer_cache.set, cache_key, {"query": context, "result": answer}
+            )
+        if settings.CONVERSATION_RECORD_TURNS:
+            await memory.add_turn(user_id, query.question, answer)
+        done = {
+            "cached": False,
+            "prompt_tokens": assembled.tokens,
+            "time_to_first_token_ms": first_token_ms,
+            "total_ms": (time.perf_counter() - start) * 1000,
+        }
+        if settings.METRICS_DEBUG_TIMINGS:
+            # Headers are sent before streaming, so timings come with the event
+            done["timings"] = metrics.request_timings()
+        yield _sse("done", done)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,11 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from langchain.schema.vectorstore import VectorStore
 
+from qasys.core.answer_cache import AnswerCache
+from qasys.core.conversation import ConversationMemory
+from qasys.core.manifest import DocumentManifest
+from qasys.core.vector_store import VectorStoreManager
 from qasys.dependencies import (
-    get_authenticated_storage,
-    get_vector_store,
+    get_answer_cache,
+    get_async_storage,
+    get_conversation_memory,
+    get_document_manifest,
+    get_vector_store_manager,
 )
-from qasys.utils.storage import AuthenticatedStorage
+from qasys.utils.concurrency import run_blocking
+from qasys.utils.db import clear_user_data as clear_user_db_data
+from qasys.utils.storage import AsyncStorage
 
 router = APIRouter()
 
@@ -19,16 +27,22 @@ async def get_current_user(request: Request):
 @router.post("/clear_data")
 async def clear_user_data(
     request: Request,
-    storage: AuthenticatedStorage = Depends(get_authenticated_storage),
-    vector_store: VectorStore = Depends(get_vector_store),
+    storage: AsyncStorage = Depends(get_async_storage),
+    vector_store_manager: VectorStoreManager = Depends(get_vector_store_manager),
+    answer_cache: AnswerCache | None = Depends(get_answer_cache),
+    memory: ConversationMemory = Depends(get_conversation_memory),
+    manifest: DocumentManifest = Depends(get_document_manifest),
 ):
     try:
         user_id = request.state.user_id
-        files = storage.list_files(user_id)
+        files = await storage.list_files(user_id)
         for file in files:
-            storage.delete_file(user_id, file)
+            await storage.delete_file(user_id, file)
 
-        vector_store.clear_user_data(user_id)
+        await run_blocking(clear_user_db_data, user_id, vector_store_manager, manifest)
+        if answer_cache is not None:
+            await run_blocking(answer_cache.invalidate_user, user_id)
+        memory.forget(user_id)
 
         return {"message": "User data cleared successfully"}
     except Exception as e:
@@ -38,11 +52,11 @@ async def clear_user_data(
 @router.get("/files")
 async def list_user_files(
     request: Request,
-    storage=Depends(get_authenticated_storage),
+    storage: AsyncStorage = Depends(get_async_storage),
 ):
     try:
         user_id = request.state.user_id
-        files = storage.list_files(user_id)
+        files = await storage.list_files(user_id)
         return {"files": files}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+import urllib.request
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from google.auth import jwt
+
+from qasys.utils.concurrency import run_blocking
+
+logger = logging.getLogger(__name__)
+
+FIREBASE_CERTS_URL = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/"
+    "securetoken@system.gserviceaccount.com"
+)
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+def fetch_certs(url: str = FIREBASE_CERTS_URL) -> Tuple[Dict[str, str], float]:
+    """Fetch ``{kid: PEM certificate}`` and how long it may be cached for"""
+    with urllib.request.urlopen(url, timeout=10) as response:
+        certs = json.load(response)
+        match = _MAX_AGE.search(response.headers.get("Cache-Control", ""))
+    return certs, float(match.group(1)) if match else 3600.0
+
+
+class SigningKeyCache:
+    """Local copy of the issuer's signing certificates.
+
+    Keys are refreshed in the background shortly before the ``max-age`` the
+    issuer advertised runs out, so verification normally never waits on the
+    network. A token signed with an unknown key id forces one refresh to pick
+    up rotated keys.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], Tuple[Dict[str, str], float]] = fetch_certs,
+        refresh_margin: float = 300,
+        min_refresh_interval: float = 30,
+    ):
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
+        self._certs: Dict[str, str] = {}
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self) -> Dict[str, str]:
+        if not self._certs or time.time() >= self._expires_at:
+            await self.refresh()
+        return self._certs
+
+    async def refresh(self, force: bool = False) -> None:
+        async with self._lock:
+            now = time.time()
+            if force and now - self._fetched_at < self.min_refresh_interval:
+                return
+            if not force and self._certs and now < self._expires_at:
+                return
+            certs, max_age = await run_blocking(self._fetch)
+            self._certs = certs
+            self._fetched_at = now
+            self._expires_at = now + max_age
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                await self.refresh(force=bool(self._certs))
+            except Exception as e:
+                logger.warning("Failed to refresh signing keys: %s", e)
+            delay = self._expires_at - self.refresh_margin - time.time()
+            await asyncio.sleep(max(delay, self.min_refresh_interval))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class TokenVerifier:
+    """Verifies Firebase ID tokens locally and caches the decoded claims.
+
+    Claims are cached under the SHA-256 of the token until the token's own
+    ``exp``, so repeated requests with the same token skip signature checks.
+    Signature verification runs in the blocking thread pool.
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        keys: SigningKeyCache,
+        issuer: Optional[str] = None,
+        cache_size: int = 10_000,
+        clock_skew_seconds: int = 60,
+    ):
+        self.project_id = project_id
+        self.issuer = issuer or f"https://securetoken.google.com/{project_id}"
+        self.keys = keys
+        self.cache_size = cache_size
+        self.clock_skew_seconds = clock_skew_seconds
+        self._cache: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def verify(self, token: str) -> dict:
+        cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        claims = self._cache.get(cache_key)
+        if claims is not None:
+            if claims["exp"] > time.time():
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return claims
+            del self._cache[cache_key]
+        self.misses += 1
+
+        header = jwt.decode_header(token)
+        certs = await self.keys.get()
+        if header.get("kid") not in certs:
+            await self.keys.refresh(force=True)
+            certs = await self.keys.get()
+        claims = await run_blocking(self._decode, token, header, certs)
+
+        self._cache[cache_key] = claims
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return claims
+
+    def _decode(self, token: str, header: dict, certs: Dict[str, str]) -> dict:
+        if header.get("alg") != "RS256" or not header.get("kid"):
+            raise ValueError("ID token must be signed with RS256 and carry a kid")
+        claims = jwt.decode(
+            token,
+            certs=certs,
+            audience=self.project_id,
+            clock_skew_in_seconds=self.clock_skew_seconds,
+        )
+        if claims.get("iss") != self.issuer:
+            raise ValueError(f"Unexpected token issuer: {claims.get('iss')}")
+        subject = claims.get("sub")
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise ValueError("ID token has an invalid subject")
+        claims["uid"] = subject
+        return claims
@@ -0,0 +1,301 @@
+import fcntl
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from qasys.utils.storage import Storage
+
+# Hits mark a file as used on disk at most this often
+_TOUCH_SECONDS = 1.0
+# Downloads keep writing their .part file; older ones were left by a crash
+_STALE_PART_SECONDS = 600
+
+
+@dataclass
+class _Entry:
+    path: str
+    version: str
+    size: int
+    validated_at: float
+    touched_at: float = 0.0
+
+
+def _version(metadata: dict) -> str:
+    # ETags change on every write; fall back to modification time and size
+    etag = metadata.get("etag")
+    if etag:
+        return str(etag)
+    return f"{metadata.get('modified_at')}:{metadata.get('size')}"
+
+
+class CachingStorage(Storage):
+    """Read-through on-disk cache in front of another ``Storage``.
+
+    Files are downloaded once into ``cache_dir`` and served from there as
+    read-only memory maps. A cached copy is revalidated against the source's
+    ETag (or modification time) when it was last checked more than
+    ``validate_seconds`` ago, and the least recently used files are evicted
+    once the cache exceeds ``max_bytes``. Writes and deletes go straight to
+    the wrapped storage and drop the cached copy.
+
+    The directory may be shared by several processes, e.g. API workers.
+    Changes to it hold a lock on the directory and keep a shared count of the
+    bytes cached, so ``max_bytes`` applies to all of them, and a file cached
+    by one process is used by the others. When a file was last used is kept
+    as the modification time of its metadata file.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        cache_dir: str,
+        max_bytes: int = 2 * 1024**3,
+        validate_seconds: float = 30,
+    ):
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.validate_seconds = validate_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # Striped so concurrent reads of one file download it only once
+        self._path_locks = [threading.Lock() for _ in range(64)]
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock_path = os.path.join(cache_dir, ".lock")
+        self._size_path = os.path.join(cache_dir, ".size")
+        self._load_index()
+
+    def _blob_path(self, file_path: str) -> str:
+        name = hashlib.sha256(file_path.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    @contextmanager
+    def _disk_lock(self) -> Iterator[None]:
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _read_size(self) -> int:
+        try:
+            with open(self._size_path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _write_size(self, size: int) -> None:
+        with open(self._size_path, "w") as f:
+            f.write(str(size))
+        self._size = size
+
+    def _read_meta(self, meta_path: str) -> Optional[_Entry]:
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            used_at = os.stat(meta_path).st_mtime
+            blob_stat = os.stat(self._blob_path(meta["path"]))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            os.remove(meta_path)
+            return None
+        return _Entry(meta["path"], meta["version"], blob_stat.st_size, 0.0, used_at)
+
+    def _scan(self) -> List[Tuple[float, _Entry]]:
+        """Entries of every process on disk, least recently used first"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                entry = self._read_meta(os.path.join(self.cache_dir, name))
+                if entry is not None:
+                    entries.append((entry.touched_at, entry))
+        return sorted(entries, key=lambda item: item[0])
+
+    def _load_index(self) -> None:
+        # Rebuild the LRU from the previous run, oldest access first
+        with self._disk_lock(), self._lock:
+            stale = time.time() - _STALE_PART_SECONDS
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    if name.endswith(".part") and os.stat(path).st_mtime < stale:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            entries = self._scan()
+            for _, entry in entries:
+                self._entries[entry.path] = entry
+            self._write_size(sum(entry.size for _, entry in entries))
+            self._evict()
+
+    def _remove(self, file_path: str) -> None:
+        # Called with the directory locked
+        self._entries.pop(file_path, None)
+        blob_path = self._blob_path(file_path)
+        try:
+            os.remove(blob_path + ".json")
+        except FileNotFoundError:
+            pass
+        try:
+            size = os.stat(blob_path).st_size
+            # Open maps of the file stay valid after it is unlinked
+            os.remove(blob_path)
+        except FileNotFoundError:
+            return
+        self._write_size(max(self._read_size() - size, 0))
+
+    def _evict(self) -> None:
+        # Only scans the directory once the shared count is over the limit
+        size = self._read_size()
+        if size <= self.max_bytes:
+            self._size = size
+            return
+        entries = self._scan()
+        size = sum(entry.size for _, entry in entries)
+        for _, entry in entries:
+            if size <= self.max_bytes:
+                break
+            self._remove(entry.path)
+            size -= entry.size
+            self.evictions += 1
+        self._write_size(size)
+
+    def _path_lock(self, file_path: str) -> threading.Lock:
+        return self._path_locks[hash(file_path) % len(self._path_locks)]
+
+    def _download(self, file_path: str, version: str) -> None:
+        blob_path = self._blob_path(file_path)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self.storage.iter_file(file_path):
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        # Replaced rather than rewritten, as other processes may be reading it
+        fd, meta_temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"path": file_path, "version": version}, f)
+        with self._disk_lock(), self._lock:
+            try:
+                replaced = os.stat(blob_path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temp_path, blob_path)
+            os.replace(meta_temp_path, blob_path + ".json")
+            self._write_size(self._read_size() + size - replaced)
+            now = time.time()
+            self._entries.pop(file_path, None)
+            self._entries[file_path] = _Entry(file_path, version, size, now, now)
+            self._evict()
+
+    def _adopt(self, file_path: str, version: str) -> bool:
+        """Use a copy of ``version`` that another process already cached"""
+        with self._disk_lock(), self._lock:
+            entry = self._read_meta(self._blob_path(file_path) + ".json")
+            if entry is None or entry.version != version:
+                return False
+            entry.validated_at = time.time()
+            self._entries.pop(file_path, None)
+            self._entries[file_path] = entry
+        self._touch(entry)
+        return True
+
+    def _ensure_cached(self, file_path: str) -> None:
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None:
+                self._entries.move_to_end(file_path)
+                if time.time() - entry.validated_at < self.validate_seconds:
+                    self.hits += 1
+                    self._touch(entry)
+                    return
+        with self._path_lock(file_path):
+            version = _version(self.storage.get_file_metadata(file_path))
+            with self._lock:
+                entry = self._entries.get(file_path)
+                if entry is not None and entry.version == version:
+                    entry.validated_at = time.time()
+                    self.hits += 1
+                    self._touch(entry)
+                    return
+            if self._adopt(file_path, version):
+                with self._lock:
+                    self.hits += 1
+                return
+            with self._lock:
+                self.misses += 1
+            self._download(file_path, version)
+
+    def _touch(self, entry: _Entry) -> None:
+        now = time.time()
+        if now - entry.touched_at < _TOUCH_SECONDS:
+            return
+        entry.touched_at = now
+        try:
+            os.utime(self._blob_path(entry.path) + ".json")
+        except FileNotFoundError:
+            # Evicted by another process; get_file fetches it again
+            pass
+
+    def _open_cached(self, file_path: str) -> BinaryIO:
+        with open(self._blob_path(file_path), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return io.BytesIO()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _drop(self, file_path: str) -> None:
+        with self._disk_lock(), self._lock:
+            self._remove(file_path)
+
+    def get_file(self, file_path: str) -> BinaryIO:
+        self._ensure_cached(file_path)
+        try:
+            return self._open_cached(file_path)
+        except FileNotFoundError:
+            # Evicted between caching and opening; fetch it again
+            with self._lock:
+                self._entries.pop(file_path, None)
+            self._ensure_cached(file_path)
+            return self._open_cached(file_path)
+
+    def save_file(self, file_name: str, file_content: BinaryIO) -> str:
+        result = self.storage.save_file(file_name, file_content)
+        self._drop(file_name)
+        return result
+
+    def delete_file(self, file_path: str) -> bool:
+        self._drop(file_path)
+        return self.storage.delete_file(file_path)
+
+    def list_files(self, directory: str = "") -> List[str]:
+        return self.storage.list_files(directory)
+
+    def get_file_metadata(self, file_path: str) -> dict:
+        return self.storage.get_file_metadata(file_path)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "files": len(self._entries),
+            "bytes": self._size,
+        }
@@ -0,0 +1,27 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from qasys.config import settings
+
+T = TypeVar("T")
+
+_blocking_pool = ThreadPoolExecutor(
+    max_workers=settings.BLOCKING_POOL_SIZE, thread_name_prefix="qasys-blocking"
+)
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking call (Firebase, storage SDKs, SQLite) off the event loop.
+
+    The pool is bounded so a burst of slow calls queues up instead of spawning
+    an unbounded number of threads.
+    """
+    loop = asyncio.get_running_loop()
+    # Carry context variables (the request's timing breakdown) into the thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _blocking_pool, functools.partial(context.run, func, *args, **kwargs)
+    )
@@ -1,5 +1,4 @@
 import os
-import shutil
 
 from qasys.config import settings
 
@@ -14,15 +13,17 @@ def ensure_directory(path):
         os.makedirs(path)
 
 
-def clear_user_vector_db(user_id):
-    vector_db_path = get_user_vector_db_path(user_id)
-    if os.path.exists(vector_db_path):
-        shutil.rmtree(vector_db_path)
+def clear_user_vector_db(user_id, vector_store_manager):
+    # Dropping the collection is a single metadata operation in Chroma,
+    # no need to walk the persist directory.
+    vector_store_manager.drop_user(user_id)
 
 
-def clear_user_data(user_id):
+def clear_user_data(user_id, vector_store_manager, manifest=None):
     # Clear vector store data
-    clear_user_vector_db(user_id)
+    clear_user_vector_db(user_id, vector_store_manager)
+    if manifest is not None:
+        manifest.remove_user(user_id)
 
     # Here you would add any other database-related cleanup
     # For example, if you're using a separate database for user data:
@@ -0,0 +1,249 @@
+"""Per-stage latency histograms and per-request timing breakdowns.
+
+Code wraps each stage of the request path in ``span("stage")``. When metrics
+are enabled the duration is added to the ``qasys_stage_seconds`` histogram
+and to the breakdown of the current request (a ``ContextVar`` set by the
+HTTP middleware), which can be returned to the caller as a ``Server-Timing``
+header. When disabled, ``span`` returns a shared no-op context manager.
+
+Metrics are kept per process and rendered in the Prometheus text format.
+"""
+
+import bisect
+import contextvars
+import math
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from qasys.config import settings
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+_enabled = settings.METRICS_ENABLED
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = (
+    contextvars.ContextVar("qasys_request_timings", default=None)
+)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def set_enabled(value: bool) -> None:
+    global _enabled
+    _enabled = value
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> (per-bucket counts with a final +Inf bucket, sum)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def totals(self) -> Dict[Tuple[str, ...], Tuple[int, float]]:
+        """``(count, sum)`` of every label combination observed so far"""
+        with self._lock:
+            return {
+                labels: (sum(counts), total[0])
+                for labels, (counts, total) in self._series.items()
+            }
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = sorted(
+                (labels, (list(counts), total[0]))
+                for labels, (counts, total) in self._series.items()
+            )
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket = _labels(self.labelnames, labels, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            suffix = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {_number(total)}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+# A sample read at scrape time: (name, help, type, labels, value)
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List = []
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, samples: Iterable[Sample] = ()) -> str:
+        """Prometheus text format of all metrics plus ``samples``"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        # Samples of one metric must be rendered together, under one header
+        families: Dict[str, List[Sample]] = {}
+        for sample in samples:
+            families.setdefault(sample[0], []).append(sample)
+        for name, family in families.items():
+            lines.append(f"# HELP {name} {family[0][1]}")
+            lines.append(f"# TYPE {name} {family[0][2]}")
+            for _, _, _, labels, value in family:
+                suffix = _labels(list(labels), list(labels.values()))
+                lines.append(f"{name}{suffix} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+stage_seconds = registry.histogram(
+    "qasys_stage_seconds", "Latency of request and ingestion stages", ["stage"]
+)
+request_seconds = registry.histogram(
+    "qasys_request_seconds",
+    "HTTP request latency until the response starts",
+    ["method", "route", "status"],
+)
+tokens = registry.histogram(
+    "qasys_tokens", "Token counts per request", ["kind"], buckets=TOKEN_BUCKETS
+)
+
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        observe(self.stage, time.perf_counter() - self.start)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(stage: str):
+    """Time a ``with`` block as ``stage``"""
+    return _Span(stage) if _enabled else _NOOP_SPAN
+
+
+def observe(stage: str, seconds: float) -> None:
+    if not _enabled:
+        return
+    stage_seconds.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        # Stages repeated within a request (e.g. per page) are summed
+        timings[stage] = timings.get(stage, 0.0) + seconds * 1000
+
+
+def count_tokens(kind: str, count: int) -> None:
+    if not _enabled:
+        return
+    tokens.observe(count, kind)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[f"{kind}_tokens"] = count
+
+
+def start_request() -> Optional[contextvars.Token]:
+    """Begin collecting a breakdown for the current request"""
+    if not _enabled:
+        return None
+    return _request_timings.set({})
+
+
+def end_request(token: Optional[contextvars.Token]) -> None:
+    if token is not None:
+        _request_timings.reset(token)
+
+
+def request_timings() -> Optional[Dict[str, float]]:
+    """The current request's breakdown in milliseconds, if collected"""
+    timings = _request_timings.get()
+    if timings is None:
+        return None
+    return {stage: round(value, 2) for stage, value in timings.items()}
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """``Server-Timing`` header value for a breakdown"""
+    return ", ".join(
+        f"{stage.replace('.', '-')};dur={value}"
+        for stage, value in timings.items()
+        if not stage.endswith("_tokens")
+    )
@@ -1,14 +1,29 @@
 import io
+import mmap
 import os
+import shutil
 import tempfile
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import BinaryIO, List
+from typing import TYPE_CHECKING, BinaryIO, Iterable, Iterator, List, Optional
 
-import boto3
-import firebase_admin
-from azure.storage.blob import BlobServiceClient
-from google.cloud import storage as gcp_storage
+from qasys.utils.concurrency import run_blocking
+
+if TYPE_CHECKING:
+    from azure.storage.blob import BlobServiceClient
+    from google.cloud import storage as gcp_storage
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Downloads larger than this are spooled to a temporary file instead of memory
+DEFAULT_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+
+def spool(chunks: Iterable[bytes], max_size: int = DEFAULT_SPOOL_MAX_BYTES) -> BinaryIO:
+    file_obj = tempfile.SpooledTemporaryFile(max_size=max_size)
+    for chunk in chunks:
+        file_obj.write(chunk)
+    file_obj.seek(0)
+    return file_obj
 
 
 class Storage(ABC):
@@ -37,6 +52,17 @@ class Storage(ABC):
         """Get metadata of a file"""
         pass
 
+    def iter_file(
+        self, file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        """Yield a file in chunks of at most ``chunk_size`` bytes"""
+        file_obj = self.get_file(file_path)
+        try:
+            while chunk := file_obj.read(chunk_size):
+                yield chunk
+        finally:
+            file_obj.close()
+
 
 class LocalStorage(Storage):
     def __init__(self, base_path: str):
@@ -46,17 +72,29 @@ class LocalStorage(Storage):
     def save_file(self, file_name: str, file_content: BinaryIO) -> str:
         file_path = os.path.join(self.base_path, file_name)
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        if not os.path.isfile(file_path):
-            with open(file_path, "xb") as f:
-                f.write(file_content.read())
+        # Write then rename so a re-upload replaces the file atomically and
+        # readers holding the old mapping keep a consistent copy.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(file_content, f, DEFAULT_CHUNK_SIZE)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
         return file_path
 
-    def get_file(self, file_path: str) -> bytes:
-        return open(file_path, "rb").read()
+    def get_file(self, file_path: str) -> BinaryIO:
+        # Map the file instead of reading it so callers only page in what
+        # they touch. Empty files cannot be mapped.
+        with open(os.path.join(self.base_path, file_path), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return io.BytesIO()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
     def delete_file(self, file_path: str) -> bool:
         try:
-            os.remove(file_path)
+            os.remove(os.path.join(self.base_path, file_path))
             return True
         except OSError:
             return False
@@ -68,7 +106,7 @@ class LocalStorage(Storage):
         ]
 
     def get_file_metadata(self, file_path: str) -> dict:
-        stats = os.stat(file_path)
+        stats = os.stat(os.path.join(self.base_path, file_path))
         return {
             "size": stats.st_size,
             "created_at": datetime.fromtimestamp(stats.st_ctime),
@@ -77,21 +115,44 @@ class LocalStorage(Storage):
 
 
 class GCPStorage(Storage):
-    def __init__(self, bucket_name: str):
-        self.client = gcp_storage.Client()
+    """Google Cloud Storage; one client (and HTTP connection pool) per instance.
+
+    Uploads are resumable and sent in ``chunk_size`` pieces, downloads are
+    streamed in ranged reads.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        client: Optional["gcp_storage.Client"] = None,
+        chunk_size: int = 8 * 1024 * 1024,
+        spool_max_bytes: int = DEFAULT_SPOOL_MAX_BYTES,
+    ):
+        if client is None:
+            # Cloud SDKs are slow to import; only load the one in use
+            from google.cloud import storage as gcp_storage
+
+            client = gcp_storage.Client()
+        self.client = client
         self.bucket = self.client.bucket(bucket_name)
+        # GCS requires resumable chunks to be a multiple of 256 KiB
+        self.chunk_size = max(chunk_size // (256 * 1024), 1) * 256 * 1024
+        self.spool_max_bytes = spool_max_bytes
 
     def save_file(self, file_name: str, file_content: BinaryIO) -> str:
-        blob = self.bucket.blob(file_name)
+        blob = self.bucket.blob(file_name, chunk_size=self.chunk_size)
         blob.upload_from_file(file_content)
         return file_name
 
     def get_file(self, file_path: str) -> BinaryIO:
-        blob = self.bucket.blob(file_path)
-        file_obj = io.BytesIO()
-        blob.download_to_file(file_obj)
-        file_obj.seek(0)
-        return file_obj
+        return spool(self.iter_file(file_path), self.spool_max_bytes)
+
+    def iter_file(
+        self, file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        with self.bucket.blob(file_path).open("rb", chunk_size=chunk_size) as reader:
+            while chunk := reader.read(chunk_size):
+                yield chunk
 
     def delete_file(self, file_path: str) -> bool:
         blob = self.bucket.blob(file_path)
@@ -107,31 +168,79 @@ class GCPStorage(Storage):
             "size": blob.size,
             "created_at": blob.time_created,
             "modified_at": blob.updated,
+            "etag": blob.etag,
         }
 
 
 class AWSStorage(Storage):
-    def __init__(self, bucket_name: str):
-        self.s3 = boto3.client("s3")
+    """S3 or an S3-compatible service (``endpoint_url``, e.g. MinIO).
+
+    The client is thread-safe and keeps up to ``max_pool_connections`` open
+    connections. Files above ``multipart_threshold`` are uploaded as parallel
+    multipart uploads; downloads stream the response body.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        client=None,
+        endpoint_url: Optional[str] = None,
+        max_pool_connections: int = 32,
+        multipart_threshold: int = 8 * 1024 * 1024,
+        multipart_chunk_size: int = 8 * 1024 * 1024,
+        transfer_concurrency: int = 4,
+        spool_max_bytes: int = DEFAULT_SPOOL_MAX_BYTES,
+    ):
+        from boto3.s3.transfer import TransferConfig
+
+        if client is None:
+            import boto3
+            from botocore.config import Config as BotoConfig
+
+            client = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                config=BotoConfig(max_pool_connections=max_pool_connections),
+            )
+        self.s3 = client
         self.bucket_name = bucket_name
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunk_size,
+            max_concurrency=transfer_concurrency,
+        )
+        self.spool_max_bytes = spool_max_bytes
 
     def save_file(self, file_name: str, file_content: BinaryIO) -> str:
-        self.s3.upload_fileobj(file_content, self.bucket_name, file_name)
+        self.s3.upload_fileobj(
+            file_content, self.bucket_name, file_name, Config=self.transfer_config
+        )
         return file_name
 
     def get_file(self, file_path: str) -> BinaryIO:
-        file_obj = io.BytesIO()
-        self.s3.download_fileobj(self.bucket_name, file_path, file_obj)
-        file_obj.seek(0)
-        return file_obj
+        return spool(self.iter_file(file_path), self.spool_max_bytes)
+
+    def iter_file(
+        self, file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        body = self.s3.get_object(Bucket=self.bucket_name, Key=file_path)["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
 
     def delete_file(self, file_path: str) -> bool:
         self.s3.delete_object(Bucket=self.bucket_name, Key=file_path)
         return True
 
     def list_files(self, directory: str = "") -> List[str]:
-        response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=directory)
-        return [obj["Key"] for obj in response.get("Contents", [])]
+        # list_objects_v2 returns at most 1000 keys per call
+        paginator = self.s3.get_paginator("list_objects_v2")
+        return [
+            obj["Key"]
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=directory)
+            for obj in page.get("Contents", [])
+        ]
 
     def get_file_metadata(self, file_path: str) -> dict:
         response = self.s3.head_object(Bucket=self.bucket_name, Key=file_path)
@@ -139,29 +248,48 @@ class AWSStorage(Storage):
             "size": response["ContentLength"],
             "created_at": response["LastModified"],
             "modified_at": response["LastModified"],
+            "etag": response.get("ETag"),
         }
 
 
 class AzureStorage(Storage):
-    def __init__(self, connection_string: str, container_name: str):
-        self.blob_service_client = BlobServiceClient.from_connection_string(
-            connection_string
-        )
+    """Azure Blob Storage; blocks of large uploads are sent concurrently"""
+
+    def __init__(
+        self,
+        connection_string: str,
+        container_name: str,
+        client: Optional["BlobServiceClient"] = None,
+        transfer_concurrency: int = 4,
+        spool_max_bytes: int = DEFAULT_SPOOL_MAX_BYTES,
+    ):
+        if client is None:
+            from azure.storage.blob import BlobServiceClient
+
+            client = BlobServiceClient.from_connection_string(connection_string)
+        self.blob_service_client = client
         self.container_client = self.blob_service_client.get_container_client(
             container_name
         )
+        self.transfer_concurrency = transfer_concurrency
+        self.spool_max_bytes = spool_max_bytes
 
     def save_file(self, file_name: str, file_content: BinaryIO) -> str:
         blob_client = self.container_client.get_blob_client(file_name)
-        blob_client.upload_blob(file_content)
+        blob_client.upload_blob(
+            file_content, overwrite=True, max_concurrency=self.transfer_concurrency
+        )
         return file_name
 
     def get_file(self, file_path: str) -> BinaryIO:
+        return spool(self.iter_file(file_path), self.spool_max_bytes)
+
+    def iter_file(
+        self, file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> Iterator[bytes]:
         blob_client = self.container_client.get_blob_client(file_path)
-        stream = io.BytesIO()
-        blob_client.download_blob().readinto(stream)
-        stream.seek(0)
-        return stream
+        # Chunk size is fixed by the client's max_chunk_get_size
+        yield from blob_client.download_blob().chunks()
 
     def delete_file(self, file_path: str) -> bool:
         blob_client = self.container_client.get_blob_client(file_path)
@@ -181,6 +309,7 @@ class AzureStorage(Storage):
             "size": properties.size,
             "created_at": properties.creation_time,
             "modified_at": properties.last_modified,
+            "etag": properties.etag,
         }
 
 
@@ -193,20 +322,64 @@ class AuthenticatedStorage:
         return f"users/{self.user_id}/{file_path}"
 
     def save_file(self, file_path: str, file_content: BinaryIO) -> str:
-        return self.storage.save_file(file_path, file_content)
+        return self.storage.save_file(self._get_user_path(file_path), file_content)
 
-    def get_file(self, file_path: str) -> bytes:
-        return open(file_path, mode="rb").read()
+    def get_file(self, file_path: str) -> BinaryIO:
+        return self.storage.get_file(self._get_user_path(file_path))
 
     def delete_file(self, user_id: str, file_path: str) -> bool:
         return self.storage.delete_file(self._get_user_path(file_path))
 
     def list_files(self, user_id: str, directory: str = "") -> List[str]:
-        return self.storage.list_files(self._get_user_path(directory))
+        # Cloud backends return full object keys; hand back user-relative names
+        prefix = self._get_user_path("")
+        return [
+            name[len(prefix) :] if name.startswith(prefix) else name
+            for name in self.storage.list_files(self._get_user_path(directory))
+        ]
 
     def get_file_metadata(self, file_path: str) -> dict:
         return self.storage.get_file_metadata(self._get_user_path(file_path))
 
+    def iter_file(
+        self, file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        return self.storage.iter_file(self._get_user_path(file_path), chunk_size)
+
+
+class AsyncStorage:
+    """Async view of a ``Storage`` (or ``AuthenticatedStorage``).
+
+    Every call runs in the shared blocking pool, so request handlers can
+    await storage I/O without stalling the event loop.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def save_file(self, *args, **kwargs) -> str:
+        return await run_blocking(self.storage.save_file, *args, **kwargs)
+
+    async def get_file(self, *args, **kwargs) -> BinaryIO:
+        return await run_blocking(self.storage.get_file, *args, **kwargs)
+
+    async def delete_file(self, *args, **kwargs) -> bool:
+        return await run_blocking(self.storage.delete_file, *args, **kwargs)
+
+    async def list_files(self, *args, **kwargs) -> List[str]:
+        return await run_blocking(self.storage.list_files, *args, **kwargs)
+
+    async def get_file_metadata(self, *args, **kwargs) -> dict:
+        return await run_blocking(self.storage.get_file_metadata, *args, **kwargs)
+
+    async def iter_file(self, file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        chunks = self.storage.iter_file(file_path, chunk_size)
+        try:
+            while (chunk := await run_blocking(next, chunks, None)) is not None:
+                yield chunk
+        finally:
+            await run_blocking(chunks.close)
+
 
 def create_temp_file(content):
     temp_file = tempfile.NamedTemporaryFile(delete=False)
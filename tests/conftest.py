@@ -0,0 +1,8 @@
+import os
+
+# Settings() is instantiated at import time; give the required fields
+# harmless defaults so the package can be imported without a .env file.
+os.environ.setdefault("PROJECT_ID", "test-project")
+os.environ.setdefault("FIREBASE_CREDENTIALS_FILENAME", "credentials.json")
+os.environ.setdefault("FIREBASE_MESSAGES_PATH", "messages/{uid}")
+os.environ.setdefault("PDF_STORAGE_PATH", "/tmp/qasys-test/pdfs")
@@ -0,0 +1,177 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The settings are read once per process, so the app runs in a subprocess
+# configured by benchmarks.e2e, with its fake models and database.
+API_PROBE = """
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+
+import httpx
+from langchain.schema.output import GenerationChunk
+
+from benchmarks.e2e import FakeEmbeddings, FakeLLM, FakeReference, configure, make_pdf
+
+args = argparse.Namespace(answer_cache=True, record_turns=True)
+issuer = configure(sys.argv[1], args)
+
+
+class StreamingLLM(FakeLLM):
+    def _stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        for word in self._answer(prompt).split(" "):
+            yield GenerationChunk(text=word + " ")
+
+
+async def main():
+    from qasys.core.inference import InferenceClient, InferenceServer, RemoteLLM
+    from qasys.core.model_registry import ModelRegistry
+    from qasys.dependencies import create_cached_embedding_model
+    from qasys.main import create_app, lifespan
+
+    # The LLM is served by an inference server, as with several workers
+    models = ModelRegistry()
+    models.register("llm", lambda: StreamingLLM(latency=0))
+    address = os.path.join(sys.argv[1], "inference.sock")
+    server = InferenceServer(models, address, b"secret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    inference = InferenceClient(address, b"secret")
+    inference.wait_ready(timeout=10)
+
+    app = create_app()
+    database = {}
+    results = {}
+    async with lifespan(app):
+        app.state.model_registry.register("llm", lambda: RemoteLLM(client=inference))
+        app.state.model_registry.register(
+            "embeddings", lambda: create_cached_embedding_model(FakeEmbeddings(16))
+        )
+        app.state.conversation_memory._reference = lambda path: FakeReference(
+            database, path, 0
+        )
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://test",
+            headers={"Authorization": f"Bearer {issuer.token()}"},
+        ) as client:
+
+            async def call(name, method, url, **kwargs):
+                response = await client.request(method, url, **kwargs)
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = response.text
+                results[name] = [response.status_code, body]
+                return body
+
+            async def wait(name, body):
+                while True:
+                    job = await call(name, "GET", body["status_url"])
+                    if job["stage"] in ("completed", "failed"):
+                        return
+
+            pdf = make_pdf(["ERR-101 means the pump is dry", "ERR-202 is a jam"])
+            await call(
+                "bad_token", "GET", "/user/me", headers={"Authorization": "Bearer x"}
+            )
+            await call("me", "GET", "/user/me")
+            upload = await call(
+                "upload", "POST", "/pdf/upload", files={"file": ("a.pdf", pdf)}
+            )
+            await wait("upload_job", upload)
+            await call(
+                "upload_bad_name",
+                "POST",
+                "/pdf/upload",
+                files={"file": ("../.hidden.pdf", pdf)},
+            )
+            await call("unknown_job", "GET", "/pdf/jobs/unknown")
+            await call("files", "GET", "/pdf/files")
+            question = {"question": "What is ERR-101?"}
+            await call("ask", "POST", "/qa/ask", json=question)
+            await call("ask_again", "POST", "/qa/ask", json=question)
+            question = {"question": "What do ERR-101 and ERR-202 mean?"}
+            await call("ask_stream", "POST", "/qa/ask/stream", json=question)
+            await call(
+                "bulk_without_pdfs",
+                "POST",
+                "/pdf/upload/bulk",
+                files=[("files", ("notes.txt", b"not a pdf"))],
+            )
+            await wait(
+                "bulk_job",
+                await call(
+                    "bulk",
+                    "POST",
+                    "/pdf/upload/bulk",
+                    files=[("files", ("a.pdf", pdf)), ("files", ("b.pdf", pdf))],
+                ),
+            )
+            await wait(
+                "reindex_job",
+                await call("reindex", "POST", "/pdf/files/a.pdf/reindex"),
+            )
+            await call("metrics", "GET", "/metrics")
+            await call("delete", "DELETE", "/pdf/files/b.pdf")
+            await call("delete_again", "DELETE", "/pdf/files/b.pdf")
+            await call("clear_data", "POST", "/user/clear_data")
+            await call("files_after_clear", "GET", "/pdf/files")
+    print(json.dumps(results))
+
+
+asyncio.run(main())
+"""
+
+
+def test_api_routes(tmp_path):
+    result = subprocess.run(
+        [sys.executable, "-c", API_PROBE, str(tmp_path)],
+        cwd=ROOT,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    results = json.loads(result.stdout.splitlines()[-1])
+    status = {name: code for name, (code, _) in results.items()}
+    body = {name: body for name, (_, body) in results.items()}
+
+    assert status["bad_token"] == 401
+    assert body["me"]["user_id"]
+    assert status["upload"] == 202
+    assert body["upload_job"]["stage"] == "completed"
+    assert status["upload_bad_name"] == 400
+    assert status["unknown_job"] == 404
+    assert [file["filename"] for file in body["files"]["files"]] == ["a.pdf"]
+
+    assert body["ask"]["cached"] is False
+    assert "ERR-101" in body["ask"]["answer"]["result"]
+    assert body["ask_again"]["cached"] is True
+    events = [
+        line.split(": ", 1)[1]
+        for line in body["ask_stream"].splitlines()
+        if line.startswith("event: ")
+    ]
+    assert events[0] == "sources" and events[-1] == "done"
+    assert events.count("token") > 1
+
+    assert status["bulk_without_pdfs"] == 400
+    assert status["bulk"] == 202
+    assert body["bulk"]["files"] == ["a.pdf", "b.pdf"]
+    assert body["bulk_job"]["stage"] == "completed"
+    assert body["reindex_job"]["stage"] == "completed"
+
+    assert "qasys_stage_seconds_bucket" in body["metrics"]
+    assert 'qasys_model_load_seconds{model="llm"}' in body["metrics"]
+    assert 'qasys_model_memory_bytes{model="embeddings"}' in body["metrics"]
+    assert status["delete"] == 200 and body["delete"]["chunks_removed"] > 0
+    assert status["delete_again"] == 404
+    assert status["clear_data"] == 200
+    assert body["files_after_clear"]["files"] == []
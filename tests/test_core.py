@@ -0,0 +1,1099 @@
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+from langchain.schema import Document
+
+from benchmarks.e2e import FakeLLM, FakeReference, make_pdf
+from qasys.core.answer_cache import (
+    AnswerCache,
+    MemoryAnswerCacheBackend,
+    SQLiteAnswerCacheBackend,
+)
+from qasys.core.batching import BatchedLLM, MicroBatcher
+from qasys.core.bulk_upload import BulkUpload, BulkUploadError
+from qasys.core.chunking import TokenChunker
+from qasys.core.conversation import ConversationMemory
+from qasys.core.embedding_cache import CachedEmbeddings, _text_hash
+from qasys.core.inference import (
+    InferenceClient,
+    InferenceError,
+    InferenceServer,
+    RemoteEmbeddings,
+    RemoteLLM,
+)
+from qasys.core.ingestion import BulkSource, IngestionQueue, TooManyJobsError
+from qasys.core.job_store import JobStore
+from qasys.core.manifest import DocumentManifest
+from qasys.core.model_registry import ModelRegistry
+from qasys.core.pdf_processor import aiter_pdf_pages, open_pdf
+from qasys.core.prompt import PromptBuilder
+from qasys.core.retrieval import reciprocal_rank_fusion
+from qasys.core.sparse_index import SparseIndex, tokenize
+from qasys.core import vector_store
+from qasys.core.vector_store import (
+    IngestionPipeline,
+    IngestionStats,
+    VectorStoreManager,
+)
+from qasys.utils import blob_cache, metrics
+from qasys.utils.auth import SigningKeyCache, TokenVerifier
+from qasys.utils.blob_cache import CachingStorage
+from qasys.utils.concurrency import run_blocking
+from qasys.utils.storage import (
+    AsyncStorage,
+    AuthenticatedStorage,
+    AWSStorage,
+    LocalStorage,
+)
+
+PROJECT_ID = "test-project"
+ISSUER = f"https://securetoken.google.com/{PROJECT_ID}"
+
+
+class LocalIssuer:
+    """Stand-in for Google's token service, backed by a self-signed key"""
+
+    def __init__(self, kid: str = "key-1"):
+        self.kid = kid
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "local-issuer")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        self.cert_pem = cert.public_bytes(serialization.Encoding.PEM).decode()
+        key_pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        self.signer = crypt.RSASigner.from_string(key_pem, key_id=kid)
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return {self.kid: self.cert_pem}, 3600.0
+
+    def token(self, uid: str = "user-1", **overrides) -> str:
+        now = int(time.time())
+        payload = {
+            "iss": ISSUER,
+            "aud": PROJECT_ID,
+            "sub": uid,
+            "iat": now,
+            "exp": now + 3600,
+            "auth_time": now,
+        }
+        payload.update(overrides)
+        return jwt.encode(self.signer, payload).decode()
+
+
+def test_token_verifier_caches_verified_tokens():
+    issuer = LocalIssuer()
+    verifier = TokenVerifier(PROJECT_ID, SigningKeyCache(fetch=issuer.fetch))
+    token = issuer.token()
+
+    claims = asyncio.run(verifier.verify(token))
+    assert claims["uid"] == "user-1"
+    asyncio.run(verifier.verify(token))
+
+    assert (verifier.hits, verifier.misses) == (1, 1)
+    assert issuer.fetches == 1
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"aud": "other-project"},
+        {"iss": "https://securetoken.google.com/other-project"},
+        {"exp": int(time.time()) - 3600},
+    ],
+)
+def test_token_verifier_rejects_invalid_claims(overrides):
+    issuer = LocalIssuer()
+    verifier = TokenVerifier(PROJECT_ID, SigningKeyCache(fetch=issuer.fetch))
+
+    with pytest.raises(ValueError):
+        asyncio.run(verifier.verify(issuer.token(**overrides)))
+
+
+def test_token_verifier_rejects_foreign_signature():
+    issuer = LocalIssuer()
+    verifier = TokenVerifier(PROJECT_ID, SigningKeyCache(fetch=issuer.fetch))
+    forged = LocalIssuer(kid=issuer.kid).token()
+
+    with pytest.raises(ValueError):
+        asyncio.run(verifier.verify(forged))
+
+
+class FakeS3Client:
+    """Just enough of the boto3 S3 client for ``AWSStorage``"""
+
+    class Body(io.BytesIO):
+        def iter_chunks(self, chunk_size):
+            while chunk := self.read(chunk_size):
+                yield chunk
+
+    class Paginator:
+        def __init__(self, objects, page_size=2):
+            self.objects = objects
+            self.page_size = page_size
+
+        def paginate(self, Bucket, Prefix):
+            keys = sorted(
+                k for b, k in self.objects if b == Bucket and k.startswith(Prefix)
+            )
+            for start in range(0, len(keys), self.page_size):
+                yield {
+                    "Contents": [
+                        {"Key": k} for k in keys[start : start + self.page_size]
+                    ]
+                }
+
+    def __init__(self):
+        self.objects = {}
+        self.upload_configs = []
+        self.downloads = 0
+
+    def upload_fileobj(self, file_obj, bucket, key, Config=None):
+        self.upload_configs.append(Config)
+        self.objects[bucket, key] = file_obj.read()
+
+    def get_object(self, Bucket, Key):
+        self.downloads += 1
+        return {"Body": self.Body(self.objects[Bucket, Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return self.Paginator(self.objects)
+
+    def head_object(self, Bucket, Key):
+        body = self.objects[Bucket, Key]
+        return {
+            "ContentLength": len(body),
+            "LastModified": datetime.datetime.now(datetime.timezone.utc),
+            "ETag": hashlib.md5(body).hexdigest(),
+        }
+
+
+def test_aws_storage_streams_chunks_and_paginates():
+    client = FakeS3Client()
+    storage = AuthenticatedStorage(
+        AWSStorage("bucket", client=client, multipart_chunk_size=5 * 1024 * 1024),
+        "user-1",
+    )
+    content = os.urandom(3000)
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        storage.save_file(name, io.BytesIO(content))
+
+    assert client.upload_configs[0].multipart_chunksize == 5 * 1024 * 1024
+    assert [len(c) for c in storage.iter_file("a.pdf", chunk_size=1024)] == [
+        1024,
+        1024,
+        952,
+    ]
+    assert storage.get_file("b.pdf").read() == content
+    assert storage.list_files("user-1") == ["a.pdf", "b.pdf", "c.pdf"]
+    assert storage.get_file_metadata("c.pdf")["size"] == 3000
+
+
+def test_async_storage_wraps_local_storage(tmp_path):
+    storage = AsyncStorage(AuthenticatedStorage(LocalStorage(str(tmp_path)), "u"))
+
+    async def scenario():
+        await storage.save_file("doc.pdf", io.BytesIO(b"x" * 2500))
+        chunks = [chunk async for chunk in storage.iter_file("doc.pdf", 1000)]
+        files = await storage.list_files("u")
+        deleted = await storage.delete_file("u", "doc.pdf")
+        return chunks, files, deleted
+
+    chunks, files, deleted = asyncio.run(scenario())
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+    assert files == ["doc.pdf"]
+    assert deleted
+
+
+def test_caching_storage_revalidates_and_evicts(tmp_path, monkeypatch):
+    client = FakeS3Client()
+    backend = AWSStorage("bucket", client=client)
+    storage = CachingStorage(
+        backend, str(tmp_path), max_bytes=5000, validate_seconds=60
+    )
+    backend.save_file("a.pdf", io.BytesIO(b"a" * 3000))
+    backend.save_file("b.pdf", io.BytesIO(b"b" * 3000))
+
+    assert storage.get_file("a.pdf").read() == b"a" * 3000
+    assert storage.get_file("a.pdf").read() == b"a" * 3000
+    assert client.downloads == 1
+    assert storage.stats()["hits"] == 1
+
+    # A changed ETag is picked up once the entry is due for revalidation
+    backend.save_file("a.pdf", io.BytesIO(b"c" * 3000))
+    storage.validate_seconds = 0
+    assert storage.get_file("a.pdf").read() == b"c" * 3000
+    assert storage.get_file("a.pdf").read() == b"c" * 3000
+    assert client.downloads == 2
+
+    # Both files do not fit, so the least recently used one is evicted
+    assert storage.get_file("b.pdf").read() == b"b" * 3000
+    assert storage.stats()["evictions"] == 1
+    assert storage.stats()["files"] == 1
+
+    # The index survives a restart
+    reopened = CachingStorage(backend, str(tmp_path), max_bytes=5000)
+    assert reopened.get_file("b.pdf").read() == b"b" * 3000
+    assert client.downloads == 3
+
+    # Processes sharing the directory keep to the limit together
+    shared = str(tmp_path / "shared")
+    first = CachingStorage(backend, shared, max_bytes=5000)
+    second = CachingStorage(backend, shared, max_bytes=5000)
+    assert first.get_file("a.pdf").read() == b"c" * 3000
+    assert second.get_file("b.pdf").read() == b"b" * 3000
+    assert second.stats()["evictions"] == 1
+    assert second.stats()["bytes"] == 3000
+    assert first.get_file("a.pdf").read() == b"c" * 3000
+    assert client.downloads == 6
+    # A file another process cached is not downloaded again
+    assert second.get_file("a.pdf").read() == b"c" * 3000
+    assert client.downloads == 6
+
+    # Partial downloads left by a crash are removed on startup
+    part = tmp_path / "shared" / "crashed.part"
+    part.write_bytes(b"x" * 100)
+    os.utime(part, (0, 0))
+    CachingStorage(backend, shared, max_bytes=5000)
+    assert not part.exists()
+
+    # Hits keep a file from being evicted, whichever process evicts
+    monkeypatch.setattr(blob_cache, "_TOUCH_SECONDS", 0)
+    backend.save_file("c.pdf", io.BytesIO(b"d" * 3000))
+    lru = str(tmp_path / "lru")
+    reader = CachingStorage(backend, lru, max_bytes=7000)
+    evicting = CachingStorage(backend, lru, max_bytes=7000)
+    reader.get_file("a.pdf")
+    reader.get_file("b.pdf")
+    reader.get_file("a.pdf")
+    evicting.get_file("c.pdf")
+    assert evicting.stats()["evictions"] == 1
+    assert os.path.exists(reader._blob_path("a.pdf"))
+    assert not os.path.exists(reader._blob_path("b.pdf"))
+
+
+# Optional SDKs that must only be imported by the provider or backend in use
+LAZY_MODULES = (
+    "azure.storage.blob",
+    "boto3",
+    "google.cloud.storage",
+    "langchain_huggingface",
+    "langchain_ollama",
+    "langchain_openai",
+    "torch",
+    "transformers",
+)
+IMPORT_RSS_BUDGET_MB = int(os.environ.get("IMPORT_RSS_BUDGET_MB", "200"))
+
+IMPORT_PROBE = """
+import resource
+import qasys.main
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def test_app_import_is_lazy():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_PROBE],
+        cwd=root,
+        env={**os.environ, "PYTHONPATH": root},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # -X importtime lines: "import time: self [us] | cumulative | name"
+    timings = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and not line.endswith("package"):
+            _, cumulative, name = line.split("|")
+            timings[name.strip()] = int(cumulative)
+    slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:10]
+    report = "\n".join(f"{us / 1000:8.1f} ms  {name}" for name, us in slowest)
+
+    eager = [name for name in LAZY_MODULES if name in timings]
+    assert not eager, f"imported at startup: {eager}\n{report}"
+    rss_mb = int(result.stdout.split()[-1]) / 1024
+    assert rss_mb < IMPORT_RSS_BUDGET_MB, f"{rss_mb:.0f} MB after import\n{report}"
+
+
+def test_core_modules_import_on_demand():
+    probe = (
+        "import sys, qasys.core.job_store, qasys.core;"
+        "print(sorted(m for m in sys.modules if m.startswith('qasys.core.')));"
+        "print(qasys.core.PromptBuilder.__module__)"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-c", probe],
+        cwd=root,
+        env={**os.environ, "PYTHONPATH": root},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded, module = result.stdout.splitlines()
+    assert loaded == "['qasys.core.job_store']"
+    assert module == "qasys.core.prompt"
+
+
+class EchoLLM:
+    def invoke(self, prompt, stop=None):
+        if prompt == "fail":
+            raise ValueError("bad prompt")
+        return prompt.upper()
+
+    def stream(self, prompt, stop=None):
+        for word in self.invoke(prompt).split():
+            yield word + " "
+
+
+class LengthEmbeddings:
+    def embed_documents(self, texts):
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text))]
+
+
+def test_remote_models_share_one_inference_server(tmp_path):
+    registry = ModelRegistry()
+    registry.register("llm", EchoLLM)
+    registry.register("embeddings", LengthEmbeddings)
+    address = str(tmp_path / "inference.sock")
+    server = InferenceServer(registry, address, b"secret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    client = InferenceClient(address, b"secret", max_connections=2)
+    client.wait_ready(timeout=10)
+    llm = RemoteLLM(client=client)
+    embeddings = RemoteEmbeddings(client)
+
+    assert llm.invoke("hello") == "HELLO"
+    assert asyncio.run(llm.ainvoke("async")) == "ASYNC"
+    assert embeddings.embed_documents(["a", "bbb"]) == [[1.0], [3.0]]
+    assert embeddings.embed_query("cc") == [2.0]
+    with pytest.raises(InferenceError, match="bad prompt"):
+        llm.invoke("fail")
+
+    # Streams arrive chunk by chunk, also when the reader stops early
+    assert list(llm.stream("one two three")) == ["ONE ", "TWO ", "THREE "]
+
+    async def first_chunk():
+        async for chunk in llm.astream("four five six"):
+            return chunk
+
+    assert asyncio.run(first_chunk()) == "FOUR "
+    with pytest.raises(InferenceError, match="bad prompt"):
+        list(llm.stream("fail"))
+    assert llm.invoke("still serving") == "STILL SERVING"
+    # Calls from many threads share the bounded connection pool
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(embeddings.embed_query, ["x" * n for n in range(20)])) == [
+            [float(n)] for n in range(20)
+        ]
+    assert registry.is_loaded("llm") and registry.is_loaded("embeddings")
+    client.close()
+
+
+def test_micro_batcher_coalesces_concurrent_requests():
+    calls = []
+
+    def double(items):
+        calls.append(len(items))
+        time.sleep(0.01)
+        if "boom" in items:
+            raise ValueError("boom")
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, max_batch_size=8, max_wait_ms=20)
+    with ThreadPoolExecutor(16) as pool:
+        results = list(pool.map(lambda n: batcher.run([str(n)]), range(32)))
+    assert results == [[str(n) * 2] for n in range(32)]
+    assert max(calls) <= 8 and len(calls) < 32
+
+    # Larger requests run whole; failures reach every caller in the batch
+    assert batcher.run(list("abcdefghij")) == [c * 2 for c in "abcdefghij"]
+    with pytest.raises(ValueError):
+        batcher.run(["boom"])
+
+    stats = batcher.stats()
+    assert stats["requests"] == 34 and stats["items"] == 43
+    assert stats["batch_sizes"][10] == 1
+    assert stats["mean_batch_size"] > 1
+    batcher.close()
+
+
+def test_batched_llm_fans_out_generations():
+    from langchain_community.llms.fake import FakeListLLM, FakeStreamingListLLM
+
+    llm = BatchedLLM.wrap(FakeListLLM(responses=["ok"]), max_batch_size=4)
+    assert asyncio.run(llm.ainvoke("question")) == "ok"
+    assert llm.invoke("question", stop=["\n"]) == "ok"
+    assert llm.stats()["requests"] == 2
+    llm.close()
+
+    # Streams bypass the batcher and keep the wrapped model's chunks
+    streaming = BatchedLLM.wrap(FakeStreamingListLLM(responses=["abc"]))
+    assert list(streaming.stream("question")) == ["a", "b", "c"]
+
+    async def astream():
+        return [chunk async for chunk in streaming.astream("question")]
+
+    assert asyncio.run(astream()) == ["a", "b", "c"]
+    assert streaming.stats()["requests"] == 0
+    streaming.close()
+
+
+def test_metrics_collect_request_breakdown_and_render():
+    async def request():
+        token = metrics.start_request()
+        try:
+            with metrics.span("test.stage"):
+                await asyncio.sleep(0.01)
+            # Spans in the blocking pool still reach the request breakdown
+            await run_blocking(metrics.observe, "test.thread", 0.002)
+            metrics.count_tokens("test", 100)
+            return metrics.request_timings()
+        finally:
+            metrics.end_request(token)
+
+    timings = asyncio.run(request())
+    assert timings["test.stage"] >= 10
+    assert timings["test.thread"] == 2.0
+    assert timings["test_tokens"] == 100
+    header = metrics.server_timing(timings)
+    assert "test-stage;dur=" in header and "tokens" not in header
+    assert metrics.request_timings() is None
+
+    text = metrics.registry.render(
+        [
+            ("qasys_cache_hits_total", "Cache hits", "counter", {"cache": "a"}, 3),
+            ("qasys_cache_misses_total", "Cache misses", "counter", {"cache": "a"}, 1),
+            ("qasys_cache_hits_total", "Cache hits", "counter", {"cache": "b"}, 0),
+        ]
+    )
+    assert 'qasys_stage_seconds_bucket{stage="test.stage",le="+Inf"} 1' in text
+    assert 'qasys_stage_seconds_count{stage="test.thread"} 1' in text
+    assert text.count("# TYPE qasys_cache_hits_total counter") == 1
+    assert text.index('qasys_cache_hits_total{cache="b"} 0') < text.index(
+        "# HELP qasys_cache_misses_total"
+    )
+
+    metrics.set_enabled(False)
+    try:
+        assert metrics.span("off") is metrics.span("other")
+        assert metrics.start_request() is None
+    finally:
+        metrics.set_enabled(True)
+
+
+def test_cached_embeddings_skip_the_model_for_known_texts(tmp_path):
+    class CountingEmbeddings(LengthEmbeddings):
+        def __init__(self):
+            self.embedded = []
+
+        def embed_documents(self, texts):
+            self.embedded.extend(texts)
+            return super().embed_documents(texts)
+
+    model = CountingEmbeddings()
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = CachedEmbeddings(model, model_name="m", path=path)
+
+    assert cache.embed_documents(["a", "bb", "a"]) == [[1.0], [2.0], [1.0]]
+    assert model.embedded == ["a", "bb"]
+    assert cache.embed_documents(["bb", "ccc"]) == [[2.0], [3.0]]
+    assert model.embedded == ["a", "bb", "ccc"]
+    assert asyncio.run(cache.aembed_documents(["a", "ccc"])) == [[1.0], [3.0]]
+    assert model.embedded == ["a", "bb", "ccc"]
+    assert (cache.hits, cache.misses) == (4, 3)
+    cache.close()
+
+    # Vectors outlive the process, and are kept apart per model
+    reopened = CachedEmbeddings(model, model_name="m", path=path)
+    assert reopened.embed_documents(["a", "bb", "ccc"]) == [[1.0], [2.0], [3.0]]
+    assert reopened.stats()["hits"] == 3
+    reopened.close()
+    other = CachedEmbeddings(model, model_name="other", path=path)
+    other.embed_documents(["a"])
+    assert model.embedded == ["a", "bb", "ccc", "a"]
+    other.close()
+
+    # Storing vectors that are already cached does not trigger an eviction
+    small = CachedEmbeddings(model, model_name="m", path=path, max_entries=4)
+    small._store([_text_hash("a"), _text_hash("bb")], [[1.0], [2.0]])
+    assert small.stats()["entries"] == 4
+    assert small.embed_documents(["a", "bb", "ccc"]) == [[1.0], [2.0], [3.0]]
+    assert small.stats()["hits"] == 3
+    small.close()
+
+
+def test_conversation_memory_keeps_a_bounded_window_per_user():
+    data = {
+        "messages/u1": {f"k{i:02d}": f"m{i}" for i in range(1, 6)},
+        "messages/u2": {"k01": "other"},
+    }
+    memory = ConversationMemory(
+        lambda path: FakeReference(data, path, 0),
+        "messages/{uid}",
+        max_turns=3,
+        max_tokens=100,
+    )
+
+    async def run():
+        assert await memory.context("u1") == "m3\nm4\nm5"
+        assert await memory.context("u2") == "other"
+        await memory.add_turn("u1", "q", "a")
+        assert await memory.context("u1") == "m4\nm5\nQ: q\nA: a"
+        assert await memory.context("u2") == "other"
+        assert len(data["messages/u1"]) == 6 and len(data["messages/u2"]) == 1
+        # Only the newest messages that fit the token budget
+        memory.max_tokens = len("Q: q\nA: a") + len("m5")
+        assert await memory.context("u1") == "m5\nQ: q\nA: a"
+
+    asyncio.run(run())
+    assert memory.stats() == {"users": 2, "messages": 4}
+    memory.forget("u1")
+    assert memory.stats() == {"users": 1, "messages": 1}
+
+    # Messages written elsewhere between refreshes all reach the summary,
+    # also those beyond the window
+    data["messages/u3"] = {f"k{i:02d}": f"m{i}" for i in range(1, 4)}
+    memory.refresh_seconds = 0
+
+    async def catch_up():
+        await memory.context("u3")
+        data["messages/u3"].update({f"k{i:02d}": f"m{i}" for i in range(4, 11)})
+        return await memory.context("u3")
+
+    memory.max_tokens = 100
+    assert asyncio.run(catch_up()) == "m8\nm9\nm10"
+    pending = memory._conversations["u3"].pending
+    assert [message.text for message in pending] == [f"m{i}" for i in range(1, 8)]
+
+
+def test_sparse_index_ranks_replaces_and_deletes_chunks(tmp_path):
+    index = SparseIndex(str(tmp_path / "sparse.sqlite"))
+    assert len(index) == 0
+    assert index.search("pump") == []
+
+    index.add(
+        ["a", "b", "c"],
+        ["pump failure ERR-42 on the pump", "pump manual", "valve seal"],
+    )
+    ranked = index.search("pump ERR-42")
+    assert [chunk for chunk, _ in ranked] == ["a", "b"]
+    assert ranked[0][1] > ranked[1][1] > 0
+    # Compound identifiers are also indexed by their parts
+    assert tokenize("AB-1234/5") == ["ab-1234/5", "ab", "1234", "5"]
+    assert [chunk for chunk, _ in index.search("err")] == ["a"]
+    assert index.search("nothing matches") == []
+
+    # Adding an indexed id replaces its text
+    index.add(["b"], ["valve spring"])
+    assert [chunk for chunk, _ in index.search("pump")] == ["a"]
+    assert index.delete(["a", "missing"]) == 1
+    assert index.search("pump") == []
+    assert sorted(chunk for chunk, _ in index.search("valve")) == ["b", "c"]
+
+    # Another connection, as in another worker, sees every write
+    other = SparseIndex(index.path)
+    assert len(other) == 2
+    index.clear()
+    assert len(other) == 0
+    assert other.search("valve") == []
+    other.close()
+    index.close()
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+    assert [chunk for chunk, _ in fused] == ["b", "a", "d", "c"]
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_answer_cache_hits_expires_and_invalidates(tmp_path, backend):
+    def create_backend():
+        if backend == "memory":
+            return MemoryAnswerCacheBackend(max_entries=10)
+        return SQLiteAnswerCacheBackend(str(tmp_path / "answers.sqlite"), 10)
+
+    cache = AnswerCache(create_backend(), ttl_seconds=60)
+    key = cache.key("alice", "What does ERR-42 mean?", "llm")
+    assert cache.get(key) is None
+    cache.set(key, {"answer": "A seal failure"})
+    # Questions differing only in case, spacing and punctuation share answers
+    same = cache.key("alice", "  what does err-42   mean ", "llm")
+    assert same == key
+    assert cache.get(same) == {"answer": "A seal failure"}
+    assert cache.key("bob", "What does ERR-42 mean?", "llm") != key
+    assert cache.key("alice", "What does ERR-42 mean?", "other-llm") != key
+
+    # A corpus change moves the user to new keys; other users keep theirs
+    bob_key = cache.key("bob", "What does ERR-42 mean?", "llm")
+    cache.set(bob_key, {"answer": "cached for bob"})
+    cache.invalidate_user("alice")
+    assert cache.get(cache.key("alice", "What does ERR-42 mean?", "llm")) is None
+    assert cache.get(cache.key("bob", "What does ERR-42 mean?", "llm")) == {
+        "answer": "cached for bob"
+    }
+    assert (cache.hits, cache.misses) == (2, 2)
+    if backend == "sqlite":
+        # Workers sharing the file see the new version, and so miss too
+        other = AnswerCache(create_backend())
+        assert other.get(key) == {"answer": "A seal failure"}
+        assert other.key("alice", "What does ERR-42 mean?", "llm") != key
+
+    expiring = AnswerCache(cache.backend, ttl_seconds=0.05)
+    expiring.set("short-lived", {"answer": "soon gone"})
+    assert expiring.get("short-lived") == {"answer": "soon gone"}
+    time.sleep(0.1)
+    assert expiring.get("short-lived") is None
+
+
+def test_token_chunker_splits_by_tokens_within_sections():
+    text = (
+        "1. Introduction\n"
+        "The pump moves water. It runs.\n"
+        "Seals wear. Replace them yearly.\n"
+        "The seal wears out over time and must be replaced.\n"
+        "2. Faults\n"
+        "ERR-42 means the seal failed.\n"
+    )
+    # One token per word
+    chunker = TokenChunker(
+        chunk_size=8, chunk_overlap=3, length_function=lambda t: len(t.split())
+    )
+    documents = chunker.create_documents([text], [{"source": "a.pdf", "page": 3}])
+
+    assert [d.page_content for d in documents] == [
+        "1. Introduction The pump moves water. It runs.",
+        # Overlaps the previous chunk by its last whole sentence
+        "It runs. Seals wear. Replace them yearly.",
+        # A sentence longer than a chunk is split between words
+        "The seal wears out over time and must",
+        "be replaced.",
+        # A heading always starts a new chunk
+        "2. Faults ERR-42 means the seal failed.",
+    ]
+    assert chunker.split_text(text) == [d.page_content for d in documents]
+    assert [d.metadata["section"] for d in documents] == ["1. Introduction"] * 4 + [
+        "2. Faults"
+    ]
+    assert [d.metadata["offset"] for d in documents] == [
+        text.index(start)
+        for start in (
+            "1. Introduction",
+            "It runs.",
+            "The seal wears",
+            "be replaced.",
+            "2. Faults",
+        )
+    ]
+    assert [d.metadata["tokens"] for d in documents] == [8, 7, 8, 2, 7]
+    for index, document in enumerate(documents):
+        assert document.metadata["chunk_index"] == index
+        assert document.metadata["source"] == "a.pdf"
+        assert document.metadata["page"] == 3
+        assert (
+            document.metadata["content_hash"]
+            == hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
+        )
+
+
+def test_prompt_builder_fits_budget_in_rank_order():
+    llm = FakeLLM()
+    question = "What does ERR-42 mean for the pump?"
+    documents = [
+        Document(
+            page_content="ERR-42 means the pump seal failed. Replace the seal.",
+            metadata={"source": "a.pdf"},
+        ),
+        Document(
+            page_content="ERR-42 means the pump seal failed. Check the valve too.",
+            metadata={"source": "b.pdf"},
+        ),
+        Document(
+            page_content="Unrelated filler text here. The pump ERR-42 code"
+            " repeats often. More filler words again.",
+            metadata={"source": "c.pdf"},
+        ),
+        Document(page_content="Pump manual appendix.", metadata={"source": "d.pdf"}),
+    ]
+
+    # One token per word, and a budget of 21 tokens for the context
+    def count_tokens(text):
+        return len(text.split())
+
+    overhead = PromptBuilder(count_tokens).build(llm, question, []).tokens
+    builder = PromptBuilder(count_tokens, max_tokens=overhead + 121, answer_tokens=100)
+    assembled = builder.build(llm, question, documents)
+
+    # Sources stay in rank order, so citations follow the retriever's ranking
+    assert [d.metadata["source"] for d in assembled.documents] == [
+        "a.pdf",
+        "b.pdf",
+        "c.pdf",
+    ]
+    assert [d.page_content for d in assembled.documents] == [
+        "ERR-42 means the pump seal failed. Replace the seal.",
+        "Check the valve too.",
+        "The pump ERR-42 code repeats often.",
+    ]
+    assert assembled.compressed
+    assert assembled.dropped_documents == 1
+    assert assembled.tokens <= builder.max_tokens - builder.answer_tokens
+
+
+def test_parallel_pdf_extraction_matches_serial(tmp_path, monkeypatch):
+    # The copy the workers map is written to, and removed from, tmp_path
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    content = make_pdf([f"page {i} term{i}" for i in range(7)])
+    reader = open_pdf(content)
+
+    async def extract(executor, source=content):
+        pages = aiter_pdf_pages(
+            source,
+            reader,
+            source="a.pdf",
+            executor=executor,
+            min_parallel_pages=1,
+            pages_per_task=2,
+        )
+        return [(page.page_content, page.metadata) async for page in pages]
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+        parallel = asyncio.run(extract(executor))
+        # Stored files are passed as a stream or mapping instead of bytes
+        streamed = asyncio.run(extract(executor, io.BytesIO(content)))
+    serial = asyncio.run(extract(None))
+    assert parallel == serial == streamed
+    assert [metadata["page"] for _, metadata in parallel] == list(range(7))
+    assert "page 6 term6" in parallel[6][0]
+    assert os.listdir(tmp_path) == []
+
+
+def test_bulk_upload_reads_archives_lazily_and_applies_limits():
+    pdf = b"%PDF-1.4 test"
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("manuals/a.pdf", pdf + b" a")
+        zf.writestr("manuals/", b"")
+        zf.writestr("__MACOSX/manuals/._a.pdf", b"metadata")
+        zf.writestr("manuals/readme.txt", b"text")
+        zf.writestr("other/a.pdf", pdf)
+        zf.writestr("b.PDF", pdf + b" b")
+
+    upload = BulkUpload(max_files=10, max_bytes=1024)
+    upload.add("manuals.zip", io.BytesIO(archive.getvalue()))
+    upload.add("c.pdf", io.BytesIO(pdf + b" c"))
+    upload.add("notes.txt", io.BytesIO(b"plain text"))
+    upload.add("../../d.pdf", io.BytesIO(pdf + b" d"))
+    upload.add("C:\\Users\\me\\e.pdf", io.BytesIO(pdf + b" e"))
+    upload.add("uploads/.env", io.BytesIO(pdf))
+    upload.add("../", io.BytesIO(pdf))
+    assert [s.filename for s in upload.sources] == [
+        "a.pdf",
+        "b.PDF",
+        "c.pdf",
+        "d.pdf",
+        "e.pdf",
+    ]
+    assert [s.read() for s in upload.sources][:3] == [
+        pdf + b" a",
+        pdf + b" b",
+        pdf + b" c",
+    ]
+    assert upload.skipped == [
+        {"filename": "manuals.zip:manuals/readme.txt", "reason": "not a PDF"},
+        {"filename": "manuals.zip:other/a.pdf", "reason": "duplicate filename"},
+        {"filename": "notes.txt", "reason": "not a PDF or ZIP"},
+        {"filename": "uploads/.env", "reason": "invalid filename"},
+        {"filename": "../", "reason": "invalid filename"},
+    ]
+    upload.close()
+
+    with pytest.raises(BulkUploadError):
+        BulkUpload(max_files=1, max_bytes=1024).add(
+            "manuals.zip", io.BytesIO(archive.getvalue())
+        )
+    with pytest.raises(BulkUploadError):
+        BulkUpload(max_files=10, max_bytes=16).add(
+            "manuals.zip", io.BytesIO(archive.getvalue())
+        )
+
+    # An oversized upload is not read past the limit
+    oversized = io.BytesIO(pdf * (3 * 1024 * 1024 // len(pdf)))
+    with pytest.raises(BulkUploadError):
+        BulkUpload(max_files=10, max_bytes=1024).add("big.pdf", oversized)
+    assert oversized.tell() < len(oversized.getvalue())
+
+
+def test_document_manifest_tracks_chunks_per_file(tmp_path):
+    manifest = DocumentManifest(str(tmp_path / "manifest.sqlite"))
+    assert manifest.file_hash("alice", "a.pdf") is None
+    assert manifest.replace("alice", "a.pdf", ["1", "2"], "h1") == []
+    assert manifest.replace("alice", "b.pdf", ["3"], "h2") == []
+    assert manifest.replace("alice", "a.pdf", ["2", "4"], "h3") == ["1"]
+    assert manifest.file_hash("alice", "a.pdf") == "h3"
+
+    # A partial ingestion only adds ids, and is never skipped as unchanged
+    assert manifest.replace("alice", "a.pdf", ["5"], None) == []
+    assert sorted(manifest.chunk_ids("alice", "a.pdf")) == ["2", "4", "5"]
+    assert manifest.file_hash("alice", "a.pdf") is None
+    files = manifest.files("alice")
+    assert [(f["filename"], f["chunks"]) for f in files] == [
+        ("a.pdf", 3),
+        ("b.pdf", 1),
+    ]
+    assert manifest.files("bob") == []
+
+    assert manifest.remove("alice", "b.pdf") == ["3"]
+    manifest.remove_user("alice")
+    assert manifest.files("alice") == []
+    manifest.close()
+
+
+def test_reingestion_skips_unchanged_files_and_removes_stale_chunks(tmp_path):
+    embeddings = LengthEmbeddings()
+    manager = VectorStoreManager(str(tmp_path / "vector_db"), lambda: embeddings)
+    manifest = DocumentManifest(str(tmp_path / "manifest.sqlite"))
+    storage = LocalStorage(str(tmp_path / "pdfs"))
+    queue = IngestionQueue(
+        pipeline_factory=lambda user_id: IngestionPipeline(
+            manager.get_user_store(user_id), embeddings, local=True, user_id=user_id
+        ),
+        storage_factory=lambda user_id: AuthenticatedStorage(storage, user_id),
+        parse_workers=1,
+        manifest=manifest,
+        delete_chunks=manager.delete_chunks,
+    )
+    collection = manager.get_user_store("alice")._collection
+
+    async def ingest(pages):
+        # Without pages the stored file is re-indexed
+        content = make_pdf(pages) if pages else None
+        job = await queue.submit("alice", "a.pdf", content)
+        while not job.done:
+            await asyncio.sleep(0.01)
+        assert job.error is None
+        return job.ingestion
+
+    async def scenario():
+        first = await ingest(["alpha one", "beta two"])
+        unchanged = await ingest(["alpha one", "beta two"])
+        changed = await ingest(["alpha one", "gamma three"])
+        reindexed = await ingest(None)
+        indexed = collection.get()
+        deleted = await queue.delete_file("alice", "a.pdf")
+        await queue.close()
+        return first, unchanged, changed, reindexed, indexed, deleted
+
+    first, unchanged, changed, reindexed, indexed, deleted = asyncio.run(scenario())
+    assert first["chunks"] == 2
+    assert unchanged == {"unchanged": True}
+    assert changed["stale_chunks_removed"] == 1
+    assert reindexed["chunks"] == 2 and reindexed["stale_chunks_removed"] == 0
+    assert sorted(indexed["documents"]) == ["alpha one", "gamma three"]
+    assert deleted == {"chunks_removed": 2, "file_deleted": True}
+    assert collection.count() == 0
+    assert manifest.files("alice") == []
+    # Users without jobs do not keep a slot
+    assert queue._user_slots == {}
+
+
+def test_vector_store_manager_evicts_least_recent_and_idle_users(tmp_path, monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(
+        vector_store, "time", types.SimpleNamespace(monotonic=lambda: clock[0])
+    )
+    manager = VectorStoreManager(
+        str(tmp_path / "vector_db"),
+        LengthEmbeddings,
+        max_open_collections=2,
+        idle_seconds=60,
+    )
+    alice = manager.get_user_store("alice")
+    bob = manager.get_user_store("bob")
+    assert manager.get_user_store("alice") is alice
+    manager.get_user_store("carol")
+    # Bob was the least recently used of three
+    assert manager.open_collections() == 2
+    assert manager.get_user_store("bob") is not bob
+
+    clock[0] = 30
+    carol = manager.get_user_store("carol")
+    clock[0] = 70
+    # Bob, last used at 0, went idle while Carol was used 40 seconds ago
+    assert manager.get_user_store("carol") is carol
+    assert manager.open_collections() == 1
+
+    alice._collection.add(ids=["1"], embeddings=[[1.0]], documents=["a"])
+    manager.drop_user("alice")
+    manager.drop_user("nobody")
+    assert manager.get_user_store("alice")._collection.count() == 0
+
+
+def test_ingestion_pipeline_retries_batches_and_dedupes_chunks(tmp_path):
+    class FlakyEmbeddings(LengthEmbeddings):
+        def __init__(self, failures):
+            self.failures = failures
+
+        def embed_documents(self, texts):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("model unavailable")
+            return super().embed_documents(texts)
+
+    manager = VectorStoreManager(str(tmp_path / "vector_db"), LengthEmbeddings)
+    store = manager.get_user_store("alice")
+    documents = [
+        Document(page_content=text, metadata={"source": "a.pdf"})
+        for text in ["header", "one", "header", "two", "three"]
+    ]
+
+    def pipeline(embeddings):
+        return IngestionPipeline(
+            store,
+            embeddings,
+            batch_size=2,
+            max_concurrency=1,
+            max_retries=2,
+            retry_backoff=0,
+            local=True,
+            user_id="alice",
+        )
+
+    stats = asyncio.run(pipeline(FlakyEmbeddings(failures=2)).run(documents))
+    assert (stats.batches, stats.chunks, stats.failed_batches) == (3, 5, 0)
+    # The repeated header is stored once
+    assert len(stats.chunk_ids) == 4
+    assert sorted(store._collection.get()["documents"]) == [
+        "header",
+        "one",
+        "three",
+        "two",
+    ]
+
+    stats = IngestionStats()
+    with pytest.raises(RuntimeError, match="3 of 3 embedding batches failed"):
+        asyncio.run(pipeline(FlakyEmbeddings(failures=9)).run(documents, stats=stats))
+    assert stats.chunks == 0
+
+
+def test_job_status_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+
+    def unavailable_storage(user_id):
+        raise OSError("storage unavailable")
+
+    async def scenario():
+        # Two queues over one store stand in for two worker processes
+        worker = IngestionQueue(
+            None, unavailable_storage, parse_workers=1, store=JobStore(path)
+        )
+        other = IngestionQueue(
+            None, unavailable_storage, parse_workers=1, store=JobStore(path)
+        )
+        job = await worker.submit("alice", "a.pdf", b"%PDF-1.4")
+        # Read before the job gets a chance to run
+        queued = other.store.get(job.id, "alice")
+        while (finished := await other.status(job.id, "alice"))["stage"] == "queued":
+            await asyncio.sleep(0.01)
+        foreign = await other.status(job.id, "bob")
+        await worker.close()
+        await other.close()
+        return queued, finished, foreign
+
+    queued, finished, foreign = asyncio.run(scenario())
+    assert queued["stage"] == "queued"
+    assert finished["stage"] == "failed"
+    assert finished["error"] == "storage unavailable"
+    assert foreign is None
+
+    # A job last seen running long ago belonged to a worker that stopped
+    store = JobStore(path, stale_seconds=0)
+    store.add("lost", "alice", "file", {"stage": "parsing", "error": None})
+    time.sleep(0.01)
+    assert store.get("lost", "alice")["stage"] == "failed"
+    store.close()
+
+
+def test_bulk_job_limit_holds_across_workers(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    sources = [BulkSource(filename="a.pdf", read=lambda: b"%PDF-1.4")]
+
+    async def scenario():
+        first = IngestionQueue(None, None, parse_workers=1, store=JobStore(path))
+        second = IngestionQueue(None, None, parse_workers=1, store=JobStore(path))
+        await first.submit_bulk("alice", sources)
+        with pytest.raises(TooManyJobsError):
+            await first.submit_bulk("alice", sources)
+        with pytest.raises(TooManyJobsError):
+            await second.submit_bulk("alice", sources)
+        await second.submit_bulk("bob", sources)
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_e2e_benchmark_runs_against_the_full_app(tmp_path, bulk):
+    output = tmp_path / "e2e.json"
+    args = ["--documents", "2", "--pages", "2", "--requests", "8", "--warmup", "1"]
+    if bulk:
+        args.append("--bulk")
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks.e2e", *args, "--output", str(output)],
+        check=True,
+        capture_output=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    result = json.loads(output.read_text())
+    assert result["ingestion"]["failed_jobs"] == 0
+    assert result["ingestion"]["chunks"] > 0
+    assert result["qa"]["errors"] == 0
+    assert result["stages"]["auth.verify_token"]["count"] >= 9
+    assert result["memory"]["peak_rss_mb"] > 0